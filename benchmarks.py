@@ -0,0 +1,478 @@
+#!/usr/bin/python3
+"""
+Benchmark gitlab-trace against a local fake GitLab server.
+
+Runs the real gitlab-trace in a subprocess for a number of scenarios and
+measures wall time, number of API requests, bytes sent by the server and
+the peak RSS of the gitlab-trace process.
+"""
+
+import argparse
+import json
+import os
+import re
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+GROUP = 'group'
+PROJECT = f'{GROUP}/project'
+BRANCH = 'main'
+FINISHED_JOB = 1
+RUNNING_JOB = 2
+
+
+class Config(NamedTuple):
+    latency: float = 0.01
+    per_page_max: int = 100
+    projects: int = 20
+    pipelines: int = 50
+    jobs: int = 200
+    trace_size: int = 16 * 1024**2
+    trace_growth: int = 64 * 1024
+    trace_growth_steps: int = 3
+    artifacts_size: int = 256 * 1024**2
+    ranges: bool = True
+
+
+class Stats:
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+
+    def record(self, nbytes: int) -> None:
+        with self.lock:
+            self.bytes_sent += nbytes
+
+
+def make_trace(size: int, first_line: int = 0) -> bytes:
+    lines = []
+    total = 0
+    n = first_line
+    while total < size:
+        line = b'%08d: compiling module_%d.c ... ok\n' % (n, n % 1000)
+        lines.append(line)
+        total += len(line)
+        n += 1
+    return b''.join(lines)[:size]
+
+
+class FakeGitLab(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, config: Config) -> None:
+        super().__init__(('127.0.0.1', 0), FakeGitLabRequestHandler)
+        self.config = config
+        self.stats = Stats()
+        self.trace = make_trace(config.trace_size)
+        self.growing_trace = self.trace
+        self.growth_steps_left = config.trace_growth_steps
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host!s}:{port}'
+
+    def job(self, job_id: int) -> Dict[str, Any]:
+        running = job_id == RUNNING_JOB and self.growth_steps_left > 0
+        return {
+            'id': job_id,
+            'name': f'job_{job_id}',
+            'status': 'running' if running else 'success',
+            'created_at': '2020-09-16T06:16:49.180Z',
+            'started_at': '2020-09-16T06:16:51.066Z',
+            'finished_at': None if running else '2020-09-16T06:26:51.066Z',
+            'duration': 600,
+            'web_url': f'{self.url}/{PROJECT}/-/jobs/{job_id}',
+            'artifacts_file': {
+                'filename': 'artifacts.zip',
+                'size': self.config.artifacts_size,
+            },
+        }
+
+    def pipeline(self, pipeline_id: int) -> Dict[str, Any]:
+        return {
+            'id': pipeline_id,
+            'ref': BRANCH,
+            'status': 'success',
+            'web_url': f'{self.url}/{PROJECT}/-/pipelines/{pipeline_id}',
+        }
+
+    def get_trace(self, job_id: int) -> bytes:
+        if job_id != RUNNING_JOB:
+            return self.trace
+        with self.stats.lock:
+            if self.growth_steps_left > 0:
+                self.growth_steps_left -= 1
+                self.growing_trace += make_trace(
+                    self.config.trace_growth,
+                    first_line=len(self.growing_trace))
+            return self.growing_trace
+
+
+class FakeGitLabRequestHandler(BaseHTTPRequestHandler):
+
+    server: FakeGitLab
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        with self.server.stats.lock:
+            self.server.stats.requests += 1
+        time.sleep(self.server.config.latency)
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        path = [urllib.parse.unquote(p) for p in url.path.split('/')[1:]]
+        if path == ['api', 'v4', 'groups', GROUP, 'projects']:
+            projects = [
+                {'id': n + 1, 'path_with_namespace': f'{GROUP}/project{n}'}
+                for n in range(self.server.config.projects)
+            ]
+            return self.send_page(projects, query)
+        if path[:3] != ['api', 'v4', 'projects'] or len(path) < 4:
+            return self.send_json({'message': '404 Not Found'}, status=404)
+        route = path[4:]
+        server = self.server
+        if not route:
+            self.send_json({
+                'id': 1, 'path_with_namespace': path[3],
+                'web_url': f'{server.url}/{path[3]}',
+                'default_branch': BRANCH,
+            })
+        elif route == ['pipelines']:
+            pipelines = [
+                server.pipeline(1000 + server.config.pipelines - n)
+                for n in range(server.config.pipelines)
+            ]
+            self.send_page(pipelines, query)
+        elif len(route) == 2 and route[0] == 'pipelines':
+            self.send_json(server.pipeline(int(route[1])))
+        elif len(route) == 3 and route[::2] == ['pipelines', 'jobs']:
+            jobs = [server.job(n + 1) for n in range(server.config.jobs)]
+            scope = query.get('scope[]', query.get('scope'))
+            if scope:
+                jobs = [job for job in jobs if job['status'] in scope]
+            self.send_page(jobs, query)
+        elif len(route) == 2 and route[0] == 'jobs':
+            self.send_json(server.job(int(route[1])))
+        elif len(route) == 3 and route[::2] == ['jobs', 'trace']:
+            self.send_trace(server.get_trace(int(route[1])))
+        elif len(route) == 3 and route[::2] == ['jobs', 'artifacts']:
+            self.send_artifacts(server.config.artifacts_size)
+        else:
+            self.send_json({'message': '404 Not Found'}, status=404)
+
+    def send_page(
+        self, items: List[Dict[str, Any]], query: Dict[str, List[str]],
+    ) -> None:
+        per_page = min(int(query.get('per_page', ['20'])[0]),
+                       self.server.config.per_page_max)
+        page = int(query.get('page', ['1'])[0])
+        total_pages = max(1, -(-len(items) // per_page))
+        headers = {
+            'X-Page': str(page),
+            'X-Per-Page': str(per_page),
+            'X-Total': str(len(items)),
+            'X-Total-Pages': str(total_pages),
+        }
+        if page < total_pages:
+            next_query = {k: v[-1] for k, v in query.items()}
+            next_query.update(page=str(page + 1), per_page=str(per_page))
+            path = urllib.parse.urlsplit(self.path).path
+            next_url = (f'{self.server.url}{path}'
+                        f'?{urllib.parse.urlencode(next_query)}')
+            headers['X-Next-Page'] = str(page + 1)
+            headers['Link'] = f'<{next_url}>; rel="next"'
+        start = (page - 1) * per_page
+        self.send_json(items[start:start + per_page], headers=headers)
+
+    def send_json(
+        self, data: Any, status: int = 200,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        self.send_data(json.dumps(data).encode(), status=status,
+                       content_type='application/json', headers=headers)
+
+    def send_data(
+        self, data: bytes, status: int = 200,
+        content_type: str = 'text/plain',
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.stats.record(len(data))
+
+    def send_trace(self, data: bytes) -> None:
+        # honors Range: bytes=N- and bytes=-N, like nginx does for files
+        m = re.fullmatch(r'bytes=(\d+-|-\d+)', self.headers['Range'] or '')
+        if not m or not self.server.config.ranges:
+            self.send_data(data)
+            return
+        first, last = m.group(1).split('-')
+        start = int(first) if first else max(0, len(data) - int(last))
+        if start >= len(data):
+            self.send_data(b'', status=416,
+                           headers={'Content-Range': f'bytes */{len(data)}'})
+        else:
+            self.send_data(data[start:], status=206, headers={
+                'Content-Range': f'bytes {start}-{len(data) - 1}/{len(data)}',
+            })
+
+    def send_artifacts(self, size: int) -> None:
+        parts = list(make_artifacts(size))
+        total = sum(len(part) for part in parts)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(total))
+        self.end_headers()
+        for part in parts:
+            self.wfile.write(part)
+        self.server.stats.record(total)
+
+
+def make_artifacts(size: int, file_size: int = 16 * 1024**2) -> List[bytes]:
+    # A zip archive (with stored files of about size bytes in total), as a
+    # list of parts that mostly share the same 1 MiB chunk of file data
+    chunk = bytes(range(256)) * 4096
+    parts: List[bytes] = []
+    central_directory: List[bytes] = []
+    offset = 0
+    n = 0
+    while offset < size:
+        n += 1
+        name = f'file{n}.bin'.encode()
+        data = [chunk[:min(len(chunk), file_size - i)]
+                for i in range(0, file_size, len(chunk))]
+        crc = 0
+        for part in data:
+            crc = zlib.crc32(part, crc)
+        fields = (20, 0, 0, 0, 0x21, crc, file_size, file_size, len(name))
+        header = struct.pack('<4s5H3LH', b'PK\3\4', *fields) + b'\0\0'
+        central_directory.append(
+            struct.pack('<4sH', b'PK\1\2', 20)
+            + struct.pack('<5H3LH', *fields)
+            + struct.pack('<4HLL', 0, 0, 0, 0, 0, offset) + name)
+        parts += [header, name] + data
+        offset += len(header) + len(name) + file_size
+    cd = b''.join(central_directory)
+    parts += [cd, struct.pack('<4s4H2LH', b'PK\5\6', 0, 0, n, n, len(cd),
+                              offset, 0)]
+    return parts
+
+
+# Runs gitlab-trace and reports its peak RSS on exit.  We can't use
+# os.wait4() for this because on Linux ru_maxrss includes the memory of the
+# forked benchmark process before it exec()s the child.
+BOOTSTRAP = '''
+import atexit, os, resource, sys
+
+def report_peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    if sys.platform == 'darwin':
+        peak //= 1024
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    with open(os.environ['BENCHMARK_PEAK_RSS_FILE'], 'w') as f:
+        f.write(str(peak))
+
+atexit.register(report_peak_rss)
+
+import gitlab_trace
+gitlab_trace.main()
+'''
+
+
+class Result(NamedTuple):
+    scenario: str
+    wall_time: float
+    requests: int
+    bytes_sent: int
+    peak_rss: int
+    exit_code: int
+
+
+SCENARIOS: List[Tuple[str, List[str]]] = [
+    ('list', []),
+    ('trace', [f'--job={FINISHED_JOB}']),
+    ('tail', [f'--job={FINISHED_JOB}', '--tail']),
+    ('follow', [f'--job={RUNNING_JOB}', '--tail', '--follow']),
+    ('artifacts', [f'--job={FINISHED_JOB}', '--artifacts', '--print-url']),
+    ('extract', [f'--job={FINISHED_JOB}', '--extract=out', '--print-url']),
+    ('history', ['--history=10']),
+    ('group', [f'--group={GROUP}', '--parallel=8']),
+]
+
+
+def run_scenario(
+    name: str, extra_args: List[str], config: Config, tmpdir: str,
+) -> Result:
+    server = FakeGitLab(config)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        cfg = os.path.join(tmpdir, 'python-gitlab.cfg')
+        with open(cfg, 'w') as f:
+            f.write(f'[global]\ndefault = bench\n\n'
+                    f'[bench]\nurl = {server.url}\nprivate_token = bench\n')
+        workdir = tempfile.mkdtemp(prefix=f'{name}-', dir=tmpdir)
+        rss_file = os.path.join(workdir, 'peak-rss')
+        # a fresh, empty artifacts cache for every scenario, and no rate
+        # limiter state shared with your own gitlab-trace processes
+        env = dict(os.environ, PYTHON_GITLAB_CFG=cfg, PYTHONPATH=here,
+                   BENCHMARK_PEAK_RSS_FILE=rss_file,
+                   XDG_CACHE_HOME=os.path.join(workdir, 'cache'),
+                   XDG_RUNTIME_DIR=workdir)
+        # a gitlab-trace --daemon you're running would talk to your GitLab
+        command = [
+            sys.executable, '-c', BOOTSTRAP, '--no-daemon',
+            f'--project={PROJECT}', f'--branch={BRANCH}',
+        ] + extra_args
+        start = time.perf_counter()
+        exit_code = subprocess.call(command, cwd=workdir, env=env,
+                                    stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.DEVNULL)
+        wall_time = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+    try:
+        with open(rss_file) as f:
+            peak_rss = int(f.read())
+    except OSError:
+        peak_rss = 0
+    return Result(name, wall_time, server.stats.requests,
+                  server.stats.bytes_sent, peak_rss, exit_code)
+
+
+def fmt_bytes(size: float) -> str:
+    for unit in 'B', 'KiB', 'MiB', 'GiB':
+        if size < 1024:
+            break
+        size /= 1024
+    return f'{size:.1f} {unit}'
+
+
+def main() -> None:
+    defaults = Config()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "scenarios", nargs="*", metavar="SCENARIO",
+        help=("scenarios to run (default: all of "
+              f"{', '.join(name for name, args in SCENARIOS)})"),
+    )
+    parser.add_argument(
+        "--latency", type=float, default=defaults.latency, metavar="SECONDS",
+        help="delay every API response (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--per-page-max", type=int, default=defaults.per_page_max,
+        metavar="N", help="maximum page size (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--projects", type=int, default=defaults.projects, metavar="N",
+        help="number of projects in the group (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--pipelines", type=int, default=defaults.pipelines, metavar="N",
+        help="number of pipelines on the branch (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=defaults.jobs, metavar="N",
+        help="number of jobs in a pipeline (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--trace-size", type=int, default=defaults.trace_size,
+        metavar="BYTES", help="size of the trace log (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--trace-growth", type=int, default=defaults.trace_growth,
+        metavar="BYTES",
+        help="how much a running job's log grows per poll"
+             " (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--trace-growth-steps", type=int,
+        default=defaults.trace_growth_steps, metavar="N",
+        help="how many polls until a running job finishes"
+             " (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--artifacts-size", type=int, default=defaults.artifacts_size,
+        metavar="BYTES",
+        help="size of the artifacts archive (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-ranges", action="store_false", dest="ranges",
+        help="ignore Range headers when serving trace logs",
+    )
+    parser.add_argument(
+        "--json", metavar="FILENAME",
+        help="also save the results as JSON",
+    )
+    args = parser.parse_args()
+    config = Config(
+        latency=args.latency,
+        per_page_max=args.per_page_max,
+        projects=args.projects,
+        pipelines=args.pipelines,
+        jobs=args.jobs,
+        trace_size=args.trace_size,
+        trace_growth=args.trace_growth,
+        trace_growth_steps=args.trace_growth_steps,
+        artifacts_size=args.artifacts_size,
+        ranges=args.ranges,
+    )
+    scenarios = dict(SCENARIOS)
+    for name in args.scenarios:
+        if name not in scenarios:
+            sys.exit(f"Unknown scenario: {name}")
+    results = []
+    print(f"{'scenario':<12} {'time':>8} {'requests':>9} {'bytes':>12}"
+          f" {'peak RSS':>12}")
+    with tempfile.TemporaryDirectory(prefix='gitlab-trace-bench-') as tmpdir:
+        for name, extra_args in SCENARIOS:
+            if args.scenarios and name not in args.scenarios:
+                continue
+            result = run_scenario(name, extra_args, config, tmpdir)
+            results.append(result)
+            failed = f'  (exit code {result.exit_code})' \
+                if result.exit_code else ''
+            print(f"{name:<12} {result.wall_time:>7.2f}s"
+                  f" {result.requests:>9} {fmt_bytes(result.bytes_sent):>12}"
+                  f" {fmt_bytes(result.peak_rss):>12}{failed}", flush=True)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(
+                config=config._asdict(),
+                results=[result._asdict() for result in results],
+            ), f, indent=2)
+            f.write('\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -3,21 +3,111 @@
 gitlab-trace: show the status/trace of a GitLab CI pipeline/job.
 """
 
+from __future__ import annotations
+
 import argparse
+import array
+import codecs
+import collections
+import concurrent.futures
+import configparser
+import contextlib
+import difflib
+import errno
+import fnmatch
+import getpass
+import hashlib
+import importlib.util
+import io
 import itertools
 import json
+import math
+import os
+import re
+import shutil
+import socket
+import socketserver
+import stat
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
 import time
+import traceback
+import types
 import urllib.parse
+import zlib
 from functools import partial
-from typing import BinaryIO, Callable, List, Optional, TypeVar
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    NoReturn,
+    Optional,
+    Protocol,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Union,
+    cast,
+)
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """Import a module the first time one of its attributes is used.
+
+    Importing python-gitlab, requests and asyncio is most of the startup
+    time of gitlab-trace, and a client of the --daemon doesn't need them.
+    """
+    module = sys.modules.get(name)
+    if module is None:
+        spec = importlib.util.find_spec(name)
+        assert spec is not None and spec.loader is not None
+        spec.loader = importlib.util.LazyLoader(spec.loader)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    return module
 
-import colorama
-import gitlab
-import requests.exceptions
-from gitlab.v4.objects import ProjectJob
 
+if TYPE_CHECKING:
+    import asyncio
+    import cProfile
+    import pstats
+    import ssl
+    import tracemalloc
+    import zipfile
+
+    import colorama
+    import gitlab
+    import requests.adapters
+    import requests.exceptions
+    import requests.utils
+    from gitlab.v4.objects import Project, ProjectJob
+else:
+    asyncio = lazy_import('asyncio')
+    cProfile = lazy_import('cProfile')
+    pstats = lazy_import('pstats')
+    ssl = lazy_import('ssl')
+    tracemalloc = lazy_import('tracemalloc')
+    zipfile = lazy_import('zipfile')
+    colorama = lazy_import('colorama')
+    gitlab = lazy_import('gitlab')
+    requests = lazy_import('requests')
+
+if sys.platform != 'win32':
+    import fcntl
 
 __version__ = '0.9.0.dev0'
 __author__ = "Marius Gedminas <marius@gedmin.as>"
@@ -25,8 +115,80 @@ __author__ = "Marius Gedminas <marius@gedmin.as>"
 
 T = TypeVar('T')
 
+# Valid values of the 'scope' filter of the GitLab pipeline jobs API
+JOB_STATUSES = (
+    'created', 'pending', 'running', 'failed', 'success', 'canceled',
+    'skipped', 'waiting_for_resource', 'manual',
+)
+
+PROFILE_MODES = ('cpu', 'mem', 'all')
+
+# How many functions/lines to show in --profile reports
+PROFILE_TOP_N = 30
+
+# How many HTTP redirects to follow in --async mode
+MAX_REDIRECTS = 5
+
+# How much of a streamed trace to read at a time
+CHUNK_SIZE = 64 * 1024
+
+# How much of the end of the trace to ask for at first with --tail --follow
+# (four times more every time that's not enough lines)
+TAIL_CHUNK_SIZE = 16 * 1024
+
+# Default size limit of the artifacts cache, in MiB
+ARTIFACTS_CACHE_SIZE = 1024
+
+# The Linux ioctl for making a copy-on-write clone of a file
+FICLONE = 0x40049409
+
+# Where python-gitlab looks for its configuration (unless $PYTHON_GITLAB_CFG
+# is set)
+GITLAB_CONFIG_FILES = [
+    '/etc/python-gitlab.cfg',
+    os.path.expanduser('~/.python-gitlab.cfg'),
+]
+
+# Environment variables that change what a command does (which configuration
+# and caches it uses, how it connects): a --daemon started with different
+# values of these can't run our commands for us
+DAEMON_ENVIRON = [
+    'HOME', 'PYTHON_GITLAB_CFG', 'XDG_CACHE_HOME', 'XDG_CONFIG_HOME',
+    'XDG_RUNTIME_DIR', 'REQUESTS_CA_BUNDLE', 'CURL_CA_BUNDLE', 'SSL_CERT_FILE',
+    'SSL_CERT_DIR', 'http_proxy', 'https_proxy', 'all_proxy', 'no_proxy',
+    'HTTP_PROXY', 'HTTPS_PROXY', 'ALL_PROXY', 'NO_PROXY',
+]
+
+# How often (in seconds) the --daemon checks whether a client went away
+CLIENT_CHECK_INTERVAL = 0.5
 
-def fatal(msg: str) -> None:
+
+SECTION_MARKER_RX = re.compile(
+    rb'section_(?P<kind>start|end):(?P<timestamp>\d+):(?P<name>[-\w.]+)'
+    rb'(?:\[[^]\r\n]*\])?\r?(?:\033\[0K)?'
+)
+
+ANSI_ESCAPE_RX = re.compile(rb'\033\[[0-?]*[ -/]*[@-~]')
+
+# Things that differ between two runs of the same job, for --diff
+VOLATILE_RX = re.compile(
+    rb'\d{4}-\d\d-\d\d[T ]\d\d:\d\d:\d\d(?:[.,]\d+)?(?:Z|[+-]\d\d:?\d\d)?'
+    rb'|\b\d\d:\d\d:\d\d(?:[.,]\d+)?'
+    rb'|\b\d+(?:\.\d+)?\s?(?:ms|s|secs?|seconds?|m|mins?|minutes?)\b'
+)
+
+
+class Output(Protocol):
+
+    @property
+    def closed(self) -> bool: ...
+
+    def write(self, data: bytes) -> int: ...
+
+    def flush(self) -> None: ...
+
+
+def fatal(msg: str) -> NoReturn:
     sys.exit(msg)
 
 
@@ -73,6 +235,22 @@ def determine_branch() -> str:
     return pipe('git symbolic-ref HEAD --short'.split())
 
 
+def parse_job_ids(spec: str) -> List[int]:
+    # Accepts '123', '123,125' and ranges like '120-125' (inclusive)
+    job_ids: List[int] = []
+    for item in spec.split(','):
+        item = item.strip()
+        first, sep, last = item.partition('-')
+        if sep:
+            start, end = int(first), int(last)
+            if start > end:
+                raise ValueError(f"bad job ID range: {item}")
+            job_ids.extend(range(start, end + 1))
+        else:
+            job_ids.append(int(item))
+    return job_ids
+
+
 def fmt_status(status: str) -> str:
     colors = {
         'success': colorama.Fore.GREEN,
@@ -118,232 +296,3434 @@ def tail(s: bytes, n: Optional[int] = None) -> bytes:
     return b''.join(s.splitlines(True)[-n:])
 
 
-def follow(
-    job: ProjectJob, buffer: Optional[BinaryIO] = None, interval: float = 1.0,
-    tail: Optional[Callable[[bytes], bytes]] = None
-) -> None:
-    if buffer is None:
-        buffer = sys.stdout.buffer
-    if tail is None:
-        tail = lambda s: s  # noqa: E731
-    trace = job.trace()
-    buffer.write(tail(trace))
-    buffer.flush()
-    while not job.finished_at:
-        time.sleep(interval)
-        job.refresh()
-        new_trace = job.trace()
-        if not new_trace.startswith(trace):
-            # maybe the beginning got truncated?
-            warn("\n----- trace was truncated -----")
-            trace = ""
-        new_data = new_trace[len(trace):]
-        if new_data:
-            buffer.write(new_data)
-            buffer.flush()
-        trace = new_trace
+def section_markers(data: bytes) -> Iterator[Tuple[bytes, int, str]]:
+    for m in SECTION_MARKER_RX.finditer(data):
+        yield (m.group('kind'), int(m.group('timestamp')),
+               m.group('name').decode('ascii'))
 
 
-def _main() -> None:
-    colorama.init()
+def end_section(
+    stack: List[Tuple[str, int]], name: str, timestamp: int,
+) -> Optional[int]:
+    # Pops the section (and any unterminated sections nested inside it) off
+    # the stack and returns its duration.
+    for i, (section, start) in reversed(list(enumerate(stack))):
+        if section == name:
+            del stack[i:]
+            return timestamp - start
+    return None
 
-    parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument(
-        "--version", action="version",
-        version=", ".join([
-            f"%(prog)s version {__version__}",
-            f"python-gitlab version {gitlab.__version__}"
-        ]),
-    )
-    parser.add_argument(
-        "-v", "--verbose", action="store_true",
-        help="print more information",
-    )
-    parser.add_argument(
-        "--debug", action="store_true",
-        help="print even more information, for debugging",
-    )
-    parser.add_argument(
-        "-g", "--gitlab", metavar="NAME",
-        help="select configuration section in ~/.python-gitlab.cfg",
-    )
-    parser.add_argument(
-        "-p", "--project", metavar="ID",
-        help="select GitLab project ('group/project' or the numeric ID)",
-    )
-    parser.add_argument(
-        "--job", metavar="ID",
-        help="show the trace of GitLab CI job with this ID",
-    )
-    parser.add_argument(
-        "--running", action="store_true",
-        help=(
-            "show the trace of the currently running GitLab CI job,"
-            " if there is one (if there's more than one, picks the first one)"
-        ),
-    )
-    parser.add_argument(
-        "-b", "--branch", "--ref", metavar="NAME",
-        help=(
-            "show the last pipeline of this git branch"
-            " (default: the currently checked out branch)"
-        ),
-    )
-    parser.add_argument(
-        "-t", "--tail", metavar='N', nargs='?', type=int, const=10,
-        help="show the last N lines of the trace log",
-    )
-    parser.add_argument(
-        "-f", "--follow", action="store_true",
-        help="periodically poll and output additional logs as the job runs",
-    )
-    parser.add_argument(
-        "--print-url", "--print-uri", action="store_true",
-        help="print URL to job page on GitLab instead of printing job's log",
-    )
-    parser.add_argument(
-        "-a", "--artifacts", action="store_true",
-        help="download build artifacts",
-    )
-    parser.add_argument(
-        "pipeline", nargs="?", type=int, metavar="PIPELINE-ID",
-        help=(
-            "select a GitLab CI pipeline by ID"
-            " (default: the last pipeline of a git branch)"
-        ),
-    )
-    parser.add_argument(
-        "job_name", nargs="?", metavar="JOB-NAME",
-        help="select a GitLab CI pipeline job by name",
-    )
-    parser.add_argument(
-        "idx", nargs='?', metavar="NTH-JOB-OF-THAT-NAME", type=int,
-        help=(
-            "select n-th GitLab CI pipeline job by this name"
-            " (default: the last one)"
+
+def section_timings(trace: bytes) -> List[Tuple[str, int]]:
+    stack: List[Tuple[str, int]] = []
+    timings = []
+    for kind, timestamp, name in section_markers(trace):
+        if kind == b'start':
+            stack.append((name, timestamp))
+            continue
+        duration = end_section(stack, name, timestamp)
+        if duration is not None:
+            timings.append((name, duration))
+    return timings
+
+
+def print_timings(
+    traces: Iterable[Tuple[ProjectJob, bytes]], fmt: str = 'text',
+) -> None:
+    timings = sorted(
+        (
+            (duration, job.id, job.name, section)
+            for job, trace in traces
+            for section, duration in section_timings(trace)
         ),
+        key=lambda row: row[0], reverse=True,
     )
-    args = parser.parse_args()
+    if fmt == 'json':
+        print(json.dumps([
+            dict(job_id=job_id, job_name=job_name, section=section,
+                 duration=duration)
+            for duration, job_id, job_name, section in timings
+        ], indent=2))
+        return
+    for duration, job_id, job_name, section in timings:
+        print(f"{fmt_duration(duration):>10}  {section}"
+              f" (--job={job_id} - {job_name})")
 
-    if args.job and args.running:
-        warn(f"Ignoring --running because --job={args.job} was specified")
 
-    if args.job and args.pipeline:
-        warn(f"Ignoring pipeline ({args.pipeline})"
-             f" because --job={args.job} was specified")
+def print_history(
+    history: Sequence[Tuple[Any, Sequence[Any]]], scope: Sequence[str] = (),
+) -> None:
+    # a table of jobs by pipelines, newest pipeline first; with a scope,
+    # only the jobs that were e.g. failed in any of them, but all their runs
+    columns = [
+        # the last job (i.e. the last retry) of every name
+        (f"#{pipeline.id}", {job.name: job for job in jobs})
+        for pipeline, jobs in history
+    ]
+    names = list(dict.fromkeys(
+        name for title, jobs in columns for name, job in jobs.items()
+        if not scope or job.status in scope))
 
-    if not args.project:
-        args.project = determine_project()
-        if args.project:
-            info(f"GitLab project: {args.project}")
-        else:
-            fatal("Could not determine GitLab project ID")
+    def cell(job: Any) -> str:
+        if job.duration is None:
+            return str(job.status)
+        return f"{job.status} {fmt_duration(job.duration)}"
 
-    gl = gitlab.Gitlab.from_config(args.gitlab)
-    project = gl.projects.get(args.project)
+    name_width = max(map(len, names), default=0)
+    widths = [
+        max([len(title)] + [
+            len(cell(jobs[name])) for name in names if name in jobs])
+        for title, jobs in columns
+    ]
+    print(" " * name_width, *[
+        title.ljust(width) for (title, jobs), width in zip(columns, widths)
+    ], "failed", sep="  ")
+    for name in names:
+        row = [jobs.get(name) for title, jobs in columns]
+        cells = [
+            # colored, but aligned as if it wasn't
+            fmt_status(job.status) + cell(job)[len(job.status):]
+            + " " * (width - len(cell(job)))
+            if job is not None else "-".ljust(width)
+            for job, width in zip(row, widths)
+        ]
+        failed = sum(1 for job in row if job and job.status == 'failed')
+        seen = sum(1 for job in row if job)
+        print(name.ljust(name_width), *cells, f"{failed}/{seen}", sep="  ")
 
-    if not args.job and (not args.pipeline or args.pipeline < 0):
-        if not args.branch:
-            args.branch = determine_branch()
-            info(f"Current branch: {args.branch}")
 
-        which = -args.pipeline - 1 if args.pipeline else 0
-        pipelines = project.pipelines.list(ref=args.branch, iterator=True)
-        skipped = sum(1 for p in itertools.islice(pipelines, which))
-        pipeline = next(pipelines, None)
-        if pipeline is not None:
-            args.pipeline = pipeline.id
-            if not args.print_url or args.job_name:
-                info(f"{project.web_url}/pipelines/{pipeline.id}")
+def print_project_status(
+    status: 'ProjectStatus', width: int, scope: Sequence[str] = (),
+    events: bool = False,
+) -> None:
+    pipeline = status.pipeline
+    if scope and not status.error and (
+            pipeline is None or pipeline.status not in scope):
+        return
+    if events:
+        write_event(
+            sys.stdout.buffer, 'project', project=status.project,
+            ref=status.ref,
+            pipeline=pipeline.attributes if pipeline is not None else None,
+            jobs=[job.attributes for job in status.jobs],
+            error=status.error)
+        return
+    name = status.project.ljust(width)
+    if status.error:
+        print(name, f"error: {status.error}", sep="  ")
+        return
+    if pipeline is None:
+        print(name, "-".ljust(8), f"no pipelines for {status.ref}", sep="  ")
+        return
+    # the last job (i.e. the last retry) of every name
+    jobs = {job.name: job for job in status.jobs}
+    columns = [
+        name,
+        # colored, but aligned as if it wasn't
+        fmt_status(pipeline.status) + " " * (8 - len(pipeline.status)),
+        f"#{pipeline.id} ({status.ref})",
+    ]
+    for state in ('failed', 'running', 'pending'):
+        names = [job.name for job in jobs.values() if job.status == state]
+        if names:
+            columns.append(f"{state}: {', '.join(names)}")
+    print(*columns, sep="  ")
+
+
+class LineFilter:
+    """Base class for filters that process the trace log line by line.
+
+    Accepts arbitrary chunks of data via write(), so it can be passed as
+    the output buffer to follow().  Filters can be chained by passing one
+    filter as the buffer of another.  Call close() at the end to process
+    the last line, if it was missing a trailing newline.
+    """
+
+    def __init__(self, buffer: Output) -> None:
+        self.buffer = buffer
+        self.partial = b''
+        self.done = False
+
+    @property
+    def closed(self) -> bool:
+        return self.done or self.buffer.closed
+
+    def write(self, data: bytes) -> int:
+        if b'\n' not in data:
+            self.partial += data
+            return len(data)
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        for line in lines:
+            if self.closed:
+                break
+            self.process(line + b'\n')
+        return len(data)
+
+    def flush(self) -> None:
+        self.buffer.flush()
+
+    def close(self) -> None:
+        if self.partial and not self.closed:
+            self.process(self.partial)
+        self.partial = b''
+        self.done = True
+        if isinstance(self.buffer, LineFilter):
+            self.buffer.close()
         else:
-            if which == 0:
-                fatal(f"Project {args.project} doesn't have any pipelines"
-                      f" for branch {args.branch}")
-            else:
-                fatal(f"Project {args.project} has only {skipped} pipelines"
-                      f" for branch {args.branch}")
-    elif args.branch:
-        if args.job:
-            warn(f"Ignoring --branch={args.branch}"
-                 f" because --job={args.job} was specified")
+            self.buffer.flush()
+
+    def process(self, line: bytes) -> None:
+        raise NotImplementedError  # pragma: nocover
+
+
+class Grep(LineFilter):
+    """Output only lines matching a regexp, like grep(1).
+
+    Becomes closed once max_count matches (and their trailing context) have
+    been seen.
+    """
+
+    def __init__(
+        self, buffer: Output, pattern: 're.Pattern[bytes]',
+        before: int = 0, after: int = 0, max_count: Optional[int] = None,
+    ) -> None:
+        super().__init__(buffer)
+        self.pattern = pattern
+        self.context: Deque[bytes] = collections.deque(maxlen=before)
+        self.after = after
+        self.max_count = max_count
+        self.separators = bool(before or after)
+        self.count = 0
+        self.lineno = 0
+        self.last_printed = 0
+        self.pending_after = 0
+
+    def process(self, line: bytes) -> None:
+        self.lineno += 1
+        if self.count != self.max_count and self.pattern.search(line):
+            first = self.lineno - len(self.context)
+            if self.separators and 0 < self.last_printed < first - 1:
+                self.buffer.write(b'--\n')
+            self.buffer.write(b''.join(self.context))
+            self.buffer.write(line)
+            self.context.clear()
+            self.last_printed = self.lineno
+            self.pending_after = self.after
+            self.count += 1
+        elif self.pending_after:
+            self.buffer.write(line)
+            self.last_printed = self.lineno
+            self.pending_after -= 1
         else:
-            assert args.pipeline
-            warn(f"Ignoring --branch={args.branch}"
-                 f" because pipeline ({args.pipeline}) was specified")
+            self.context.append(line)
+        if self.count == self.max_count and not self.pending_after:
+            self.done = True
 
-    if not args.job:
-        pipeline = project.pipelines.get(args.pipeline)
-        jobs = list(pipeline.jobs.list(all=True))
-        if args.job_name:
-            found = [job.id for job in jobs if job.name == args.job_name]
-            if not found:
-                warn(f"Job {args.job_name} not found")
-            elif len(found) == 1:
-                args.job = found[0]
-                info(f"Job ID: {args.job}")
+
+class Tail(LineFilter):
+    """Output only the last n lines, like tail(1), once closed.
+
+    Goes after the filters that drop lines, so that it counts only the
+    lines they let through.
+    """
+
+    def __init__(self, buffer: Output, n: int) -> None:
+        super().__init__(buffer)
+        self.lines: Deque[bytes] = collections.deque(maxlen=n)
+
+    def process(self, line: bytes) -> None:
+        self.lines.append(line)
+
+    def close(self) -> None:
+        if self.partial and not self.closed:
+            self.process(self.partial)
+        self.partial = b''
+        self.buffer.write(b''.join(self.lines))
+        self.lines.clear()
+        super().close()
+
+
+class TraceFilter(LineFilter):
+    """Understand GitLab's section markers and ANSI escape sequences.
+
+    GitLab CI wraps each step of the job in a pair of markers like ::
+
+        section_start:1560896352:step_script\r\033[0K
+        ...
+        section_end:1560896353:step_script\r\033[0K
+
+    and the web UI uses them to show collapsible sections.  This filter
+    can strip them (together with colors and other ANSI escapes), show only
+    the contents of selected sections, or collapse all the sections, leaving
+    only their header lines.  It calls on_section_end(name, duration) for
+    every section it sees end.
+    """
+
+    def __init__(
+        self, buffer: Output, strip_ansi: bool = False,
+        sections: Optional[List[str]] = None, collapse: bool = False,
+        on_section_end: Optional[Callable[[str, int], None]] = None,
+    ) -> None:
+        super().__init__(buffer)
+        self.strip_ansi = strip_ansi
+        self.sections = sections
+        self.collapse = collapse
+        self.on_section_end = on_section_end
+        self.stack: List[Tuple[str, int]] = []
+
+    def visible(self) -> bool:
+        if self.sections:
+            return any(name in self.sections for name, start in self.stack)
+        if self.collapse:
+            return not self.stack
+        return True
+
+    def process(self, line: bytes) -> None:
+        if b'section_' not in line:
+            if self.visible():
+                self.output(line)
+            return
+        visible = self.visible()
+        for kind, timestamp, name in section_markers(line):
+            if kind == b'start':
+                self.stack.append((name, timestamp))
+                continue
+            duration = end_section(self.stack, name, timestamp)
+            if duration is not None and self.on_section_end is not None:
+                self.on_section_end(name, duration)
+        if visible or self.visible():
+            if self.strip_ansi:
+                line = SECTION_MARKER_RX.sub(b'', line)
+                if not line.strip():
+                    return
+            self.output(line)
+
+    def output(self, line: bytes) -> None:
+        if self.strip_ansi and b'\033' in line:
+            line = ANSI_ESCAPE_RX.sub(b'', line)
+        self.buffer.write(line)
+
+
+class Coalesce(LineFilter):
+    """Write out whole lines, a bunch at a time.
+
+    follow() writes whatever new data it got on every poll, which, when
+    stdout is a pipe, means a syscall per poll and lines split in the
+    middle.  This holds the data back and writes out complete lines only
+    when flush() is called (follow() does that on every poll) at least
+    max_delay seconds after the oldest data still held back arrived, or
+    when more than max_size bytes are pending.  The first flush() writes
+    out the backlog right away.  With interactive set (e.g. when stdout is
+    a terminal) every flush() writes out everything, partial lines
+    included.
+    """
+
+    def __init__(
+        self, buffer: Output, max_delay: float = 0,
+        max_size: int = CHUNK_SIZE, interactive: bool = False,
+    ) -> None:
+        super().__init__(buffer)
+        self.max_delay = max_delay
+        self.max_size = max_size
+        self.interactive = interactive
+        self.pending = bytearray()
+        # when the oldest pending data arrived
+        self.pending_since: Optional[float] = None
+        self.flushed = False
+
+    def write(self, data: bytes) -> int:
+        if not self.pending:
+            self.pending_since = time.monotonic()
+        self.pending += data
+        if len(self.pending) >= self.max_size:
+            self.emit()
+        return len(data)
+
+    def emit(self, everything: bool = False) -> None:
+        end = (len(self.pending) if everything
+               else self.pending.rfind(b'\n') + 1)
+        if end and not self.closed:
+            self.buffer.write(bytes(self.pending[:end]))
+            self.buffer.flush()
+        if end:
+            del self.pending[:end]
+            self.pending_since = time.monotonic() if self.pending else None
+
+    def flush(self) -> None:
+        if self.interactive:
+            self.emit(everything=True)
+        elif self.pending_since is not None and (
+                not self.flushed
+                or time.monotonic() - self.pending_since >= self.max_delay):
+            self.emit()
+        self.flushed = True
+
+    def close(self) -> None:
+        self.emit(everything=True)
+        self.done = True
+        self.buffer.flush()
+
+
+class TraceEvents(LineFilter):
+    """Write the trace log as --format=ndjson "trace" events.
+
+    Every flush() (e.g. every poll of follow()) turns the data written
+    since the last one into an event, and so does accumulating more than
+    max_size bytes, so long logs are streamed in pieces.  UTF-8 is decoded
+    incrementally, so characters split between chunks survive.
+    """
+
+    def __init__(
+        self, buffer: Output, job_id: int, max_size: int = CHUNK_SIZE,
+    ) -> None:
+        super().__init__(buffer)
+        self.job_id = job_id
+        self.max_size = max_size
+        self.pending = bytearray()
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+    def write(self, data: bytes) -> int:
+        self.pending += data
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        return len(data)
+
+    def emit(self, final: bool = False) -> None:
+        text = self.decoder.decode(bytes(self.pending), final)
+        del self.pending[:]
+        if text and not self.closed:
+            write_event(self.buffer, 'trace', job=self.job_id, data=text)
+
+    def flush(self) -> None:
+        self.emit()
+
+    def close(self) -> None:
+        self.emit(final=True)
+        self.done = True
+
+
+def write_event(buffer: Output, event: str, **fields: Any) -> None:
+    # one line of --format=ndjson output
+    line = json.dumps(dict(event=event, **fields), separators=(',', ':'))
+    buffer.write(line.encode() + b'\n')
+    buffer.flush()
+
+
+class IndexedTrace(LineFilter):
+    """Saves a trace log to a temporary file, hashing every line.
+
+    Keeps only the hashes and the offsets of the lines in memory, so two
+    traces can be compared (see print_diff()) using memory proportional to
+    the number of lines, not to their size.  The hashes ignore ANSI escape
+    sequences, section markers, timestamps and durations.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(tempfile.TemporaryFile())
+        self.offsets = array.array('q', [0])
+        self.hashes = array.array('q')
+
+    def process(self, line: bytes) -> None:
+        self.buffer.write(line)
+        self.offsets.append(self.offsets[-1] + len(line))
+        self.hashes.append(hash(normalize(line)))
+
+    def lines(self, start: int, stop: int) -> List[bytes]:
+        f = cast(IO[bytes], self.buffer)
+        f.seek(self.offsets[start])
+        data = f.read(self.offsets[stop] - self.offsets[start])
+        base = self.offsets[start]
+        return [data[self.offsets[i] - base:self.offsets[i + 1] - base]
+                for i in range(start, stop)]
+
+
+def normalize(line: bytes) -> bytes:
+    line = ANSI_ESCAPE_RX.sub(b'', SECTION_MARKER_RX.sub(b'', line))
+    return VOLATILE_RX.sub(b'#', line).strip()
+
+
+def print_diff(
+    a: Tuple[ProjectJob, IndexedTrace], b: Tuple[ProjectJob, IndexedTrace],
+    output: Output, context: int = 3,
+) -> None:
+    (job_a, trace_a), (job_b, trace_b) = a, b
+    matcher = difflib.SequenceMatcher(None, trace_a.hashes, trace_b.hashes)
+    colors = {b'-': colorama.Fore.RED, b'+': colorama.Fore.GREEN}
+    reset = colorama.Style.RESET_ALL
+    same = True
+    for group in matcher.get_grouped_opcodes(context):
+        if same:
+            output.write(f"--- job {job_a.id} ({job_a.name})\n"
+                         f"+++ job {job_b.id} ({job_b.name})\n".encode())
+            same = False
+        first, last = group[0], group[-1]
+        output.write(
+            f"{colorama.Fore.CYAN}@@ -{first[1] + 1},{last[2] - first[1]}"
+            f" +{first[3] + 1},{last[4] - first[3]} @@"
+            f"{reset}\n".encode())
+        for tag, i1, i2, j1, j2 in group:
+            lines = []
+            if tag != 'insert':
+                lines += [(b' ' if tag == 'equal' else b'-', line)
+                          for line in trace_a.lines(i1, i2)]
+            if tag in ('replace', 'insert'):
+                lines += [(b'+', line) for line in trace_b.lines(j1, j2)]
+            for prefix, line in lines:
+                line = prefix + line.rstrip(b'\n')
+                if prefix in colors:
+                    line = colors[prefix].encode() + line + reset.encode()
+                output.write(line + b'\n')
+    if same:
+        info(f"Jobs {job_a.id} and {job_b.id} have the same trace"
+             " (ignoring timestamps and durations)")
+    if isinstance(output, LineFilter):
+        output.close()
+    else:
+        output.flush()
+
+
+class ZipEntry:
+    """A file of a zip archive that ZipExtractor is extracting."""
+
+    def __init__(
+        self, name: str, method: int, crc: int, size: Optional[int],
+        data_descriptor: bool, zip64: bool, output: Optional[IO[bytes]],
+    ) -> None:
+        self.name = name
+        self.crc = crc
+        # size of the compressed data, if known before reading it
+        self.size = size
+        self.data_descriptor = data_descriptor
+        self.zip64 = zip64
+        self.output = output
+        self.decompressor = (
+            zlib.decompressobj(-zlib.MAX_WBITS) if method == 8 else None)
+        self.compressed = 0
+        self.uncompressed = 0
+        self.actual_crc = 0
+
+    @property
+    def complete(self) -> bool:
+        if self.size is not None:
+            return self.compressed == self.size
+        assert self.decompressor is not None
+        return self.decompressor.eof
+
+    def feed(self, data: bytes) -> bytes:
+        # returns the data after the end of the entry, if any
+        if self.decompressor is None:
+            assert self.size is not None
+            n = self.size - self.compressed
+            data, rest = data[:n], data[n:]
+            self.compressed += len(data)
+            self.write(data)
+            return rest
+        try:
+            output = self.decompressor.decompress(data)
+        except zlib.error as e:
+            raise zipfile.BadZipFile(f"Bad data for file {self.name!r}: {e}")
+        rest = self.decompressor.unused_data
+        self.compressed += len(data) - len(rest)
+        self.write(output)
+        return rest
+
+    def write(self, data: bytes) -> None:
+        self.uncompressed += len(data)
+        self.actual_crc = zlib.crc32(data, self.actual_crc)
+        if self.output is not None:
+            self.output.write(data)
+
+    def check(self) -> None:
+        if self.output is not None:
+            self.output.close()
+        if self.actual_crc != self.crc:
+            raise zipfile.BadZipFile(f"Bad CRC-32 for file {self.name!r}")
+
+
+class ZipExtractor:
+    """Extract a zip archive while it is being downloaded.
+
+    Pass it chunks of the archive via write(), and call close() at the end.
+    Uses the local file header in front of every entry, so files are
+    written out as soon as their data arrives, without saving the archive
+    first.  If an entry can't be extracted that way (compression methods
+    other than deflate, encryption, or stored entries with sizes known
+    only after the data), saves the rest of the archive to a temporary
+    file and extracts it using the central directory at the end.
+
+    Extracts only the files matching one of the glob patterns, if given.
+    """
+
+    LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+    END_SIGNATURES = (b'PK\1\2', b'PK\5\6', b'PK\6\6', b'PK\6\7')
+
+    def __init__(self, directory: str, patterns: Sequence[str] = ()) -> None:
+        self.directory = directory
+        self.patterns = patterns
+        self.buffer = bytearray()
+        self.entry: Optional[ZipEntry] = None
+        self.spool: Optional[IO[bytes]] = None
+        self.done = False
+        self.extracted = 0
+
+    def wanted(self, name: str) -> bool:
+        return not self.patterns or any(
+            fnmatch.fnmatchcase(name, pattern) for pattern in self.patterns)
+
+    def path(self, name: str) -> str:
+        # like zipfile does it: no absolute paths, no .. components
+        name = os.path.splitdrive(name.replace('/', os.path.sep))[1]
+        return os.path.join(self.directory, *[
+            part for part in name.split(os.path.sep)
+            if part not in ('', os.path.curdir, os.path.pardir)
+        ])
+
+    def write(self, data: bytes) -> int:
+        if self.spool is not None:
+            self.spool.write(data)
+            return len(data)
+        self.buffer += data
+        while not self.done and self.spool is None:
+            if self.entry is None:
+                if not self.read_header():
+                    break
+            elif not self.entry.complete:
+                rest = self.entry.feed(bytes(self.buffer))
+                self.buffer[:] = rest
+                if not self.entry.complete:
+                    break
+            elif not self.read_data_descriptor():
+                break
+        return len(data)
+
+    def read_header(self) -> bool:
+        if len(self.buffer) < 4:
+            return False
+        if self.buffer[:4] in self.END_SIGNATURES:
+            # the central directory: we've seen all the files
+            self.done = True
+            return False
+        if len(self.buffer) < self.LOCAL_HEADER.size:
+            return False
+        (signature, version, flags, method, mtime, mdate, crc, size, usize,
+         name_len, extra_len) = self.LOCAL_HEADER.unpack_from(self.buffer)
+        if signature != b'PK\3\4':
+            self.fall_back()
+            return False
+        header_len = self.LOCAL_HEADER.size + name_len + extra_len
+        if len(self.buffer) < header_len:
+            return False
+        raw_name = bytes(self.buffer[self.LOCAL_HEADER.size:][:name_len])
+        name = raw_name.decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = bytes(self.buffer[self.LOCAL_HEADER.size + name_len:][
+            :extra_len])
+        zip64 = False
+        while len(extra) >= 4:
+            tag, length = struct.unpack_from('<HH', extra)
+            if tag == 1 and length >= 16:
+                usize, size = struct.unpack_from('<QQ', extra, 4)
+                zip64 = True
+            extra = extra[4 + length:]
+        data_descriptor = bool(flags & 0x08)
+        is_dir = name.endswith('/')
+        if (flags & 0x01 or method not in (0, 8)
+                or (method == 0 and data_descriptor and not is_dir)):
+            self.fall_back()
+            return False
+        del self.buffer[:header_len]
+        output = None
+        if self.wanted(name):
+            path = self.path(name)
+            if is_dir:
+                os.makedirs(path, exist_ok=True)
             else:
-                info(f"Found multiple jobs: {' '.join(map(str, found))}")
-                if args.idx is not None:
-                    args.job = found[args.idx - 1]
-                    info(f"Selecting #{args.idx}: {args.job}")
-                else:
-                    args.job = found[-1]
-                    info(f"Selecting the last one: {args.job}")
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                output = open(path, 'wb')
+                self.extracted += 1
+        if data_descriptor and method == 8:
+            # the sizes will be in the data descriptor
+            size = None
+        elif data_descriptor:
+            # a directory
+            size = 0
+        self.entry = ZipEntry(name, method, crc, size, data_descriptor,
+                              zip64, output)
+        return True
+
+    def read_data_descriptor(self) -> bool:
+        entry = self.entry
+        assert entry is not None
+        if entry.data_descriptor:
+            if len(self.buffer) < 4:
+                return False
+            start = 4 if self.buffer[:4] == b'PK\7\x08' else 0
+            zip64 = (entry.zip64 or entry.compressed >= 0xFFFFFFFF
+                     or entry.uncompressed >= 0xFFFFFFFF)
+            fmt = '<LQQ' if zip64 else '<LLL'
+            if len(self.buffer) < start + struct.calcsize(fmt):
+                return False
+            entry.crc, size, usize = struct.unpack_from(
+                fmt, self.buffer, start)
+            del self.buffer[:start + struct.calcsize(fmt)]
+            if (size, usize) != (entry.compressed, entry.uncompressed):
+                raise zipfile.BadZipFile(
+                    f"Bad data descriptor for file {entry.name!r}")
+        entry.check()
+        self.entry = None
+        return True
+
+    def fall_back(self) -> None:
+        self.spool = tempfile.TemporaryFile()
+        self.spool.write(self.buffer)
+        self.buffer.clear()
+
+    def close(self) -> None:
+        if self.spool is not None:
+            # missing the beginning, but zipfile can cope with that
+            with self.spool, zipfile.ZipFile(self.spool) as archive:
+                for info in archive.infolist():
+                    if info.header_offset >= 0 and self.wanted(info.filename):
+                        archive.extract(info, self.directory)
+                        if not info.is_dir():
+                            self.extracted += 1
+        elif not self.done:
+            if self.entry is not None and self.entry.output is not None:
+                self.entry.output.close()
+            raise zipfile.BadZipFile("Truncated zip archive")
+
+
+def artifacts_cache_dir() -> str:
+    cache = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache, 'gitlab-trace', 'artifacts')
+
+
+class ArtifactsCache:
+    """Job artifacts archives downloaded earlier.
+
+    Archives are stored once under their SHA-256 checksum, even if several
+    jobs have identical artifacts, and every job has a small JSON file
+    saying which archive is its (and what its modification time was, to
+    notice if it got changed anyway).  When the cache grows over max_size
+    bytes, the archives that were used the longest time ago (according to
+    their access times) are removed.
+    """
+
+    def __init__(self, directory: str, max_size: int) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self.blobs = os.path.join(directory, 'blobs')
+        self.jobs = os.path.join(directory, 'jobs')
+        self.tmp = os.path.join(directory, 'tmp')
+
+    def job_path(self, server: str, job_id: int) -> str:
+        # job IDs are unique only within one GitLab server
+        host = urllib.parse.urlsplit(server).netloc
+        return os.path.join(self.jobs, host, f'{job_id}.json')
+
+    def get(self, server: str, job_id: int, size: int) -> Optional[str]:
+        # the cached archive of this job, if it's there and the size matches
+        try:
+            with open(self.job_path(server, job_id)) as f:
+                entry = json.load(f)
+            if not re.fullmatch('[0-9a-f]{64}', entry['sha256']):
+                return None
+            path = os.path.join(self.blobs, entry['sha256'])
+            st = os.stat(path)
+            if st.st_size != size or st.st_mtime_ns != entry['mtime_ns']:
+                return None
+            os.utime(path, ns=(time.time_ns(), st.st_mtime_ns))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return path
+
+    def add(self, server: str, job_id: int) -> 'CachedDownload':
+        return CachedDownload(self, server, job_id)
+
+    def store(
+        self, server: str, job_id: int, filename: str, sha256: str,
+    ) -> str:
+        path = os.path.join(self.blobs, sha256)
+        os.makedirs(self.blobs, exist_ok=True)
+        with contextlib.suppress(FileNotFoundError):
+            # same artifacts as some other job: replace them, in case they
+            # got changed, but keep their mtime, which that job expects
+            os.utime(filename, ns=(time.time_ns(),
+                                   os.stat(path).st_mtime_ns))
+        # read-only: nothing is supposed to change it
+        os.chmod(filename, 0o444)
+        os.replace(filename, path)
+        mtime_ns = os.stat(path).st_mtime_ns
+        job_path = self.job_path(server, job_id)
+        os.makedirs(os.path.dirname(job_path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            'w', dir=self.tmp, suffix='.json', delete=False,
+        ) as f:
+            json.dump({'sha256': sha256, 'mtime_ns': mtime_ns}, f)
+        os.replace(f.name, job_path)
+        return path
+
+    def evict(self) -> None:
+        try:
+            blobs = [(entry.stat(), entry.path)
+                     for entry in os.scandir(self.blobs)]
+        except FileNotFoundError:
+            return
+        total = sum(st.st_size for st, path in blobs)
+        for st, path in sorted(blobs, key=lambda blob: blob[0].st_atime):
+            if total <= self.max_size:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+            total -= st.st_size
+
+
+class CachedDownload:
+    """An artifacts archive being downloaded into an ArtifactsCache.
+
+    Pass it chunks of the archive via write(); if the download succeeds,
+    path tells where the archive was stored.
+    """
+
+    def __init__(self, cache: ArtifactsCache, server: str,
+                 job_id: int) -> None:
+        self.cache = cache
+        self.server = server
+        self.job_id = job_id
+        self.checksum = hashlib.sha256()
+        self.path: Optional[str] = None
+        os.makedirs(cache.tmp, exist_ok=True)
+        self.file = tempfile.NamedTemporaryFile(dir=cache.tmp, delete=False)
+
+    def write(self, data: bytes) -> None:
+        self.checksum.update(data)
+        self.file.write(data)
+
+    def __enter__(self) -> 'CachedDownload':
+        return self
+
+    def __exit__(self, exc_type: Any, *args: Any) -> None:
+        self.file.close()
+        if exc_type is not None:
+            os.unlink(self.file.name)
         else:
-            if args.debug:
-                info(json.dumps(pipeline.attributes, indent=2))
-            if args.print_url:
-                print(f"{project.web_url}/pipelines/{pipeline.id}")
-                sys.exit(0)
-        if not args.job:
-            print(f"Available jobs for pipeline #{pipeline.id}:")
-            for job in jobs:
-                status = fmt_status(job.status)
-                print(f"   --job={job.id} - {status} - {job.name}")
-                if args.running and job.status == 'running' and not args.job:
-                    args.job = job.id
-                    job_name = job.name
-            if args.job:
-                info(f"Automatically selected --job={args.job} ({job_name})")
-            else:
-                if args.running:
-                    warn("Ignoring --running because no job was running.")
-                if args.artifacts:
-                    warn("Ignoring --artifacts because no job was selected.")
-                if args.print_url:
-                    warn("Ignoring --print-url because no job was selected.")
-                sys.exit(0)
-
-    job = project.jobs.get(args.job)
-    if args.verbose:
-        info(f"Job created:    {job.created_at}")
-        info(f"Job started:    {job.started_at or 'not yet'}")
-        info(f"Job finished:   {job.finished_at or 'not yet'}")
-        info(f"Job duration:   {fmt_duration(job.duration)}")
-    if args.debug:
-        info(json.dumps(job.attributes, indent=2))
-    if args.print_url:
-        print(f"{project.web_url}/-/jobs/{job.id}")
-    elif args.follow:
-        follow(job, tail=partial(tail, n=args.tail))
-    else:
-        sys.stdout.buffer.write(tail(job.trace(), args.tail))
-    if args.artifacts:
-        if not hasattr(job, 'artifacts_file'):
-            warn("Job has no artifacts.")
-            sys.exit(1)
-        filename = job.artifacts_file['filename']
-        info(f"Artifacts: {filename} ({fmt_size(job.artifacts_file['size'])})")
-        with open(filename, "xb") as f:
-            job.artifacts(streamed=True, action=f.write)
-    sys.exit(0)
+            self.path = self.cache.store(
+                self.server, self.job_id, self.file.name,
+                self.checksum.hexdigest())
 
 
-def main() -> None:
-    try:
-        _main()
-    except requests.exceptions.RequestException as e:
-        sys.exit(str(e))
+def copy_file(source: str, destination: str) -> None:
+    # a copy-on-write clone if possible, which shares the disk space but
+    # (unlike a hard link) is a file of its own that can be changed freely
+    with open(source, 'rb') as src, open(destination, 'xb') as dst:
+        if sys.platform != 'win32':
+            with contextlib.suppress(OSError):
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return
+    # (into the empty file we just created, so as not to overwrite any other)
+    shutil.copyfile(source, destination)
+
+
+class ApiCall(NamedTuple):
+    endpoint: str
+    status: int
+    elapsed: float
+    raw: Any  # to find out how many bytes were read, after the fact
+    bytes_out: int
+
+
+class Stats:
+    """Collect statistics about GitLab API calls."""
+
+    def __init__(self) -> None:
+        self.calls: List[ApiCall] = []
+        self.slept = 0.0
+
+    def install(self, session: requests.Session) -> None:
+        session.hooks['response'].append(self.record)
+
+    def record(self, response: requests.Response, *args: Any,
+               **kwargs: Any) -> None:
+        request = response.request
+        self.calls.append(ApiCall(
+            endpoint=api_endpoint(request.method or 'GET', request.url or ''),
+            status=response.status_code,
+            elapsed=response.elapsed.total_seconds(),
+            raw=response.raw,
+            bytes_out=len(request.body or b''),
+        ))
+
+    def summary(self) -> Dict[str, Any]:
+        endpoints: Dict[str, Dict[str, Any]] = {}
+        for call in self.calls:
+            totals = endpoints.setdefault(call.endpoint, {
+                'requests': 0, 'latencies': [], 'status': {},
+                'bytes_in': 0, 'bytes_out': 0,
+            })
+            totals['requests'] += 1
+            totals['latencies'].append(call.elapsed)
+            status = str(call.status)
+            totals['status'][status] = totals['status'].get(status, 0) + 1
+            totals['bytes_in'] += bytes_read(call.raw)
+            totals['bytes_out'] += call.bytes_out
+        for totals in endpoints.values():
+            latencies = totals.pop('latencies')
+            totals['p50'] = percentile(latencies, 0.5)
+            totals['p95'] = percentile(latencies, 0.95)
+        return {
+            'requests': len(self.calls),
+            'bytes_in': sum(t['bytes_in'] for t in endpoints.values()),
+            'bytes_out': sum(t['bytes_out'] for t in endpoints.values()),
+            'sleep': self.slept,
+            'endpoints': endpoints,
+        }
+
+    def report(self) -> None:
+        summary = self.summary()
+        info(f"API calls: {summary['requests']},"
+             f" received {fmt_size(summary['bytes_in'])},"
+             f" sent {fmt_size(summary['bytes_out'])}")
+        for endpoint, stats in summary['endpoints'].items():
+            statuses = ', '.join(
+                f"{status} x{n}" for status, n in stats['status'].items())
+            info(f"  {endpoint}: {stats['requests']}"
+                 f" (p50 {stats['p50'] * 1000:.0f} ms,"
+                 f" p95 {stats['p95'] * 1000:.0f} ms; {statuses};"
+                 f" received {fmt_size(stats['bytes_in'])})")
+        if self.slept:
+            info(f"Waited for new data: {fmt_duration(self.slept)}")
+
+
+class RateLimiter:
+    """A token bucket shared by all gitlab-trace processes of this user.
+
+    Allows rate requests per second on average, with bursts of up to burst
+    requests.  The bucket lives in a small file that is locked while it's
+    being updated, so it doesn't matter how many processes use it.  If
+    that file is a symlink or belongs to someone else (it may be in /tmp),
+    there is no limit.
+    """
+
+    STATE = struct.Struct('<dd')  # tokens, time of last update
+
+    def __init__(self, path: str, rate: float, burst: float) -> None:
+        if rate <= 0 or burst < 1:
+            raise ValueError("rate_limit must be positive"
+                             " and rate_limit_burst at least 1")
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self.disabled = False
+
+    def reserve(self) -> float:
+        # take a token, returning how long to wait before using it; the
+        # bucket can go below zero, which queues the waiting processes
+        if self.disabled:
+            return 0.0
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW,
+                         0o600)
+        except OSError as e:
+            return self.disable(f"cannot open {self.path}: {e.strerror}")
+        try:
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid():
+                return self.disable(f"{self.path} is not our own file")
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            now = time.time()
+            data = os.pread(fd, self.STATE.size, 0)
+            if len(data) == self.STATE.size:
+                tokens, then = self.STATE.unpack(data)
+                tokens = min(self.burst,
+                             tokens + max(0.0, now - then) * self.rate)
+            else:
+                tokens = self.burst
+            tokens -= 1
+            os.pwrite(fd, self.STATE.pack(tokens, now), 0)
+        finally:
+            os.close(fd)
+        return max(0.0, -tokens / self.rate)
+
+    def disable(self, reason: str) -> float:
+        # don't let someone else's file stall (or trick into overwriting
+        # files) every one of our processes
+        warn(f"Ignoring rate_limit: {reason}")
+        self.disabled = True
+        return 0.0
+
+    def acquire(self) -> None:
+        time.sleep(self.reserve())
+
+    def install(self, session: requests.Session) -> None:
+        for prefix, adapter in list(session.adapters.items()):
+            session.mount(prefix, cast(requests.adapters.BaseAdapter,
+                                       RateLimitedAdapter(adapter, self)))
+
+
+class RateLimitedAdapter:
+    """Makes a requests transport adapter wait for a RateLimiter.
+
+    Has the methods of requests.adapters.BaseAdapter without subclassing
+    it, which would mean importing requests at startup.
+    """
+
+    def __init__(self, adapter: requests.adapters.BaseAdapter,
+                 limiter: RateLimiter) -> None:
+        self.adapter = adapter
+        self.limiter = limiter
+
+    def send(self, request: requests.PreparedRequest,
+             *args: Any, **kwargs: Any) -> requests.Response:
+        self.limiter.acquire()
+        return self.adapter.send(request, *args, **kwargs)
+
+    def close(self) -> None:
+        self.adapter.close()
+
+
+def rate_limiter(gitlab_id: Optional[str]) -> Optional[RateLimiter]:
+    # rate_limit (requests per second) and rate_limit_burst can be set in
+    # the server's section (or [global]) of ~/.python-gitlab.cfg
+    config = configparser.ConfigParser()
+    config.read(os.environ.get('PYTHON_GITLAB_CFG') or GITLAB_CONFIG_FILES,
+                encoding='utf-8')
+    section = gitlab_id or config.get('global', 'default', fallback=None)
+    if section is None or not config.has_section(section):
+        return None
+
+    def option(name: str) -> Optional[str]:
+        return config.get(section, name,
+                          fallback=config.get('global', name, fallback=None))
+
+    rate = option('rate_limit')
+    if rate is None:
+        return None
+    if sys.platform == 'win32':  # pragma: nocover
+        warn("Ignoring rate_limit: not supported on Windows")
+        return None
+    # budgets are per server, even if several sections point to it
+    host = urllib.parse.urlsplit(option('url') or '').netloc
+    directory = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    path = os.path.join(
+        directory, f'gitlab-trace-{user_name()}-{host}.ratelimit')
+    try:
+        return RateLimiter(path, rate=float(rate), burst=float(
+            option('rate_limit_burst') or max(1.0, float(rate))))
+    except ValueError as e:
+        fatal(f"Bad rate limit in [{section}] of ~/.python-gitlab.cfg: {e}")
+
+
+def api_endpoint(method: str, url: str) -> str:
+    # GET /api/v4/projects/:id/jobs/:id/trace
+    segments = urllib.parse.urlparse(url).path.split('/')
+    for i in range(1, len(segments)):
+        if segments[i].isdigit() or segments[i - 1] == 'projects':
+            segments[i] = ':id'
+    return f"{method} {'/'.join(segments)}"
+
+
+def bytes_read(raw: Any) -> int:
+    try:
+        return int(raw.tell())
+    except (AttributeError, OSError, ValueError):
+        return 0
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[max(0, math.ceil(p * len(values)) - 1)]
+
+
+class TraceCursor:
+    """How much of a growing trace log follow() has seen.
+
+    Asks for byte ranges, so that every poll downloads only the new data,
+    and, with tail=N, the first request downloads only the end of the log
+    (asking for more until it has N lines).  If the server ignores the
+    Range header, falls back to downloading the whole log every time and
+    comparing it with the previous one.
+    """
+
+    def __init__(self, tail: Optional[int] = None) -> None:
+        self.tail = tail
+        self.chunk_size = TAIL_CHUNK_SIZE
+        self.started = False
+        self.offset = 0
+        self.last_byte = b''
+        # the whole log, once we know the server doesn't do ranges
+        self.trace: Optional[bytes] = None
+
+    def range(self) -> Optional[str]:
+        # what to send in the Range header of the next request
+        if self.trace is not None:
+            return None
+        if not self.started and self.tail:
+            return f'bytes=-{self.chunk_size}'
+        # one byte we've seen already, to check that it still lines up
+        return f'bytes={max(0, self.offset - 1)}-'
+
+    def update(
+        self, status: int, content_range: Optional[str], data: bytes,
+    ) -> Optional[bytes]:
+        # returns the new data to output, or None if we need to ask again
+        m = re.fullmatch(r'bytes (\d+)-\d+/(?:\d+|\*)', content_range or '')
+        if status == 416:
+            # nothing in that range: an empty log, or it got shorter
+            if self.offset > 0:
+                return self.truncated()
+            self.started = True
+            return b''
+        if status != 206 or not m:
+            return self.update_all(data)
+        start = int(m.group(1))
+        if not self.started:
+            if start > 0 and len(data.splitlines()) <= (self.tail or 0):
+                self.chunk_size *= 4
+                return None
+            self.started = True
+            new_data = tail(data, self.tail)
+        elif start != max(0, self.offset - 1) or (
+                self.offset > 0 and data[:1] != self.last_byte):
+            return self.truncated()
+        else:
+            new_data = data[self.offset - start:]
+        self.offset = start + len(data)
+        self.last_byte = data[-1:] or self.last_byte
+        return new_data
+
+    def update_all(self, data: bytes) -> bytes:
+        if not self.started:
+            self.started = True
+            self.trace = data
+            return tail(data, self.tail)
+        if self.trace is None:
+            self.trace = data[:self.offset]
+        if not data.startswith(self.trace):
+            # maybe the beginning got truncated?
+            warn("\n----- trace was truncated -----")
+            self.trace = b""
+        new_data = data[len(self.trace):]
+        self.trace = data
+        return new_data
+
+    def truncated(self) -> Optional[bytes]:
+        # start over from the beginning; returns None so update() asks again
+        warn("\n----- trace was truncated -----")
+        self.offset = 0
+        self.last_byte = b''
+        return None
+
+
+def trace_range(
+    job: ProjectJob, range: Optional[str],
+) -> Tuple[int, Optional[str], bytes]:
+    # GET a job's trace log, or a byte range of it if range is not None;
+    # returns the HTTP status, the Content-Range header and the data
+    path = f"{job.manager.path}/{job.encoded_id}/trace"
+    headers = {'Range': range} if range else None
+    try:
+        response = job.manager.gitlab.http_get(path, raw=True,
+                                               extra_headers=headers)
+    except gitlab.exceptions.GitlabHttpError as e:
+        if e.response_code != 416:
+            raise
+        return 416, None, b''
+    assert isinstance(response, requests.Response)
+    return (response.status_code, response.headers.get('Content-Range'),
+            response.content)
+
+
+def follow(
+    job: ProjectJob, buffer: Optional[Output] = None, interval: float = 1.0,
+    tail: Optional[int] = None, stats: Optional['Stats'] = None,
+) -> None:
+    if buffer is None:
+        buffer = sys.stdout.buffer
+    cursor = TraceCursor(tail)
+
+    def new_data() -> bytes:
+        while True:
+            data = cursor.update(*trace_range(job, cursor.range()))
+            if data is not None:
+                return data
+
+    buffer.write(new_data())
+    buffer.flush()
+    while not job.finished_at and not buffer.closed:
+        time.sleep(interval)
+        if stats is not None:
+            stats.slept += interval
+        job.refresh()
+        data = new_data()
+        if data:
+            buffer.write(data)
+        # even without new data, for Coalesce to write out what it held back
+        buffer.flush()
+
+
+def report_section(
+    name: str, duration: int, sections: Optional[List[str]] = None,
+) -> None:
+    if not sections or name in sections:
+        info(f"Section {name} took {fmt_duration(duration)}")
+
+
+def fetch_traces(
+    project: Project, job_ids: List[int], workers: int = 4,
+) -> Iterator[Tuple[ProjectJob, bytes]]:
+    def fetch(job_id: int) -> Tuple[ProjectJob, bytes]:
+        job = project.jobs.get(job_id)
+        return job, job.trace()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        # results come back in the order of job_ids, but downloads overlap;
+        # only a few run ahead, so that a slow job doesn't make all the
+        # other traces pile up in memory
+        futures: Deque['concurrent.futures.Future[Tuple[ProjectJob, bytes]]']
+        futures = collections.deque()
+        for job_id in job_ids:
+            if len(futures) >= workers:
+                yield futures.popleft().result()
+            futures.append(pool.submit(fetch, job_id))
+        while futures:
+            yield futures.popleft().result()
+
+
+class PipelineNode(NamedTuple):
+    """A job, or a bridge job triggering a downstream pipeline."""
+
+    job: Any
+    pipeline: int
+    depth: int = 0
+    # jobs of downstream pipelines of other projects need --project=ID
+    project: Optional[str] = None
+    bridge: bool = False
+    # whether we may look at the bridge's downstream pipeline
+    accessible: bool = True
+
+
+# Pipeline IDs to (jobs, bridges), or None for pipelines of projects we
+# can't read
+PipelineTree = Dict[int, Optional[Tuple[List[Any], List[Any]]]]
+
+
+def pipeline_tree(
+    pipelines: PipelineTree, pipeline_id: int, project_id: int,
+    root_project_id: int, depth: int = 0,
+) -> List[PipelineNode]:
+    # the jobs of a pipeline, then every bridge followed by the jobs of its
+    # downstream pipeline
+    tree = pipelines[pipeline_id]
+    assert tree is not None
+    jobs, bridges = tree
+    project = None if project_id == root_project_id else str(project_id)
+    nodes = [PipelineNode(job, pipeline_id, depth, project) for job in jobs]
+    for bridge in bridges:
+        downstream = bridge.downstream_pipeline
+        accessible = not downstream or (
+            pipelines.get(downstream['id']) is not None)
+        nodes.append(PipelineNode(bridge, pipeline_id, depth, project,
+                                  bridge=True, accessible=accessible))
+        if downstream and accessible:
+            nodes += pipeline_tree(pipelines, downstream['id'],
+                                   downstream['project_id'], root_project_id,
+                                   depth + 1)
+    return nodes
+
+
+def downstream_pipelines(bridges: Iterable[Any]) -> List[Tuple[int, int]]:
+    # (project ID, pipeline ID) of the pipelines triggered by these bridges
+    return [
+        (bridge.downstream_pipeline['project_id'],
+         bridge.downstream_pipeline['id'])
+        for bridge in bridges if bridge.downstream_pipeline
+    ]
+
+
+def fetch_pipeline_tree(
+    gl: gitlab.Gitlab, project: Project, pipeline_id: int,
+    scope: Sequence[str] = (), workers: int = 4,
+) -> List[PipelineNode]:
+    # the jobs of a pipeline and of all its child and downstream pipelines;
+    # every level of the tree is fetched in parallel
+
+    def fetch(
+        ids: Tuple[int, int], downstream: bool,
+    ) -> Optional[Tuple[List[Any], List[Any]]]:
+        project_id, pipeline_id = ids
+        pipeline = gl.projects.get(project_id, lazy=True).pipelines.get(
+            pipeline_id, lazy=True)
+        try:
+            if scope:
+                jobs = pipeline.jobs.list(all=True, per_page=100, scope=scope)
+            else:
+                jobs = pipeline.jobs.list(all=True, per_page=100)
+            return list(jobs), list(pipeline.bridges.list(all=True,
+                                                          per_page=100))
+        except gitlab.exceptions.GitlabError:
+            # a pipeline of some other project we may not look at
+            if not downstream:
+                raise
+            return None
+
+    pipelines: PipelineTree = {}
+    level = [(project.id, pipeline_id)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        while level:
+            results = list(pool.map(
+                partial(fetch, downstream=bool(pipelines)), level))
+            pipelines.update(
+                (pipeline_id, result)
+                for (project_id, pipeline_id), result in zip(level, results))
+            level = [
+                ids for result in results if result is not None
+                for ids in downstream_pipelines(result[1])
+                if ids[1] not in pipelines
+            ]
+    return pipeline_tree(pipelines, pipeline_id, project.id, project.id)
+
+
+class ProjectStatus(NamedTuple):
+    project: str
+    ref: Optional[str]
+    pipeline: Any = None
+    jobs: Sequence[Any] = ()
+    error: Optional[str] = None
+
+
+def several_projects(args: argparse.Namespace) -> bool:
+    return bool(args.group) or len(args.projects) > 1
+
+
+def group_projects(gl: gitlab.Gitlab, group: str) -> List[str]:
+    return [
+        project.path_with_namespace
+        for project in gl.groups.get(group, lazy=True).projects.list(
+            iterator=True, per_page=100, include_subgroups=True,
+            archived=False)
+    ]
+
+
+def fetch_project_status(
+    gl: gitlab.Gitlab, name: str, ref: Optional[str] = None,
+) -> ProjectStatus:
+    try:
+        project = gl.projects.get(name)
+        ref = ref or project.default_branch
+        if not ref:
+            # an empty repository
+            return ProjectStatus(name, ref)
+        pipeline = next(
+            project.pipelines.list(ref=ref, iterator=True, per_page=1), None)
+        if pipeline is None:
+            return ProjectStatus(name, ref)
+        jobs = list(pipeline.jobs.list(all=True, per_page=100))
+    except (gitlab.exceptions.GitlabError,
+            requests.exceptions.RequestException) as e:
+        return ProjectStatus(name, ref, error=str(e) or type(e).__name__)
+    return ProjectStatus(name, ref, pipeline, jobs)
+
+
+def fetch_project_statuses(
+    gl: gitlab.Gitlab, names: Sequence[str], ref: Optional[str] = None,
+    workers: int = 4,
+) -> Iterator[ProjectStatus]:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(fetch_project_status, gl, name, ref) for name in names
+        ]
+        # in the order they finish, so slow projects don't hold up the rest
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+
+def fetch_indexed_trace(
+    project: Project, job_id: int,
+) -> Tuple[ProjectJob, IndexedTrace]:
+    job = project.jobs.get(job_id)
+    trace = IndexedTrace()
+    for chunk in job.trace(streamed=True, iterator=True,
+                           chunk_size=CHUNK_SIZE):
+        trace.write(chunk)
+    trace.close()
+    return job, trace
+
+
+def write_traces(
+    traces: Iterable[Tuple[ProjectJob, bytes]], n: Optional[int] = None,
+    output_dir: Optional[str] = None,
+    filters: Sequence[Callable[[Output], LineFilter]] = (),
+    events: bool = False,
+) -> None:
+    for job, trace in traces:
+        if output_dir:
+            filename = os.path.join(output_dir, f"{job.id}.log")
+            info(f"Job {job.id} ({job.name}): {filename}")
+            with open(filename, "wb") as f:
+                write_trace(f, trace, filters, n)
+        elif events:
+            write_event(sys.stdout.buffer, 'job', job=job.attributes)
+            write_trace(TraceEvents(sys.stdout.buffer, job.id), trace,
+                        filters, n)
+            write_event(sys.stdout.buffer, 'trace_end', job=job.id,
+                        status=job.status)
+        else:
+            print(f"==> job {job.id} ({job.name}) <==", flush=True)
+            write_trace(sys.stdout.buffer, trace, filters, n)
+            sys.stdout.buffer.flush()
+
+
+def apply_filters(
+    buffer: Output, filters: Sequence[Callable[[Output], LineFilter]],
+    n: Optional[int] = None,
+) -> Output:
+    # with n, keep only the last n lines that the filters let through
+    if n:
+        buffer = Tail(buffer, n)
+    for make_filter in reversed(filters):
+        buffer = make_filter(buffer)
+    return buffer
+
+
+def write_trace(
+    buffer: Output, trace: bytes,
+    filters: Sequence[Callable[[Output], LineFilter]] = (),
+    n: Optional[int] = None,
+) -> None:
+    output = apply_filters(buffer, filters, n)
+    output.write(trace)
+    if isinstance(output, LineFilter):
+        output.close()
+
+
+def follow_output(flush_interval: float) -> LineFilter:
+    # where --follow writes the trace log
+    return Coalesce(sys.stdout.buffer, max_delay=flush_interval,
+                    interactive=sys.stdout.isatty())
+
+
+class Prefix(LineFilter):
+    """Prefix every line, to tell apart interleaved logs of several jobs."""
+
+    def __init__(self, buffer: Output, prefix: bytes) -> None:
+        super().__init__(buffer)
+        self.prefix = prefix
+
+    def process(self, line: bytes) -> None:
+        if not line.endswith(b'\n'):
+            # don't let the last line of one job run into another job's log
+            line += b'\n'
+        self.buffer.write(self.prefix + line)
+        self.buffer.flush()
+
+    def close(self) -> None:
+        # the buffer is shared with the other jobs, so don't close it
+        if self.partial and not self.closed:
+            self.process(self.partial)
+        self.partial = b''
+        self.done = True
+
+
+async def read_timeout(
+    aw: Awaitable[T], timeout: Optional[float], url: str,
+) -> T:
+    # like the read timeout of requests: how long to wait for the server
+    try:
+        return await asyncio.wait_for(aw, timeout)
+    except asyncio.TimeoutError:
+        raise requests.exceptions.ReadTimeout(
+            f"Read timed out after {timeout} s: {url}")
+
+
+class AsyncResponse:
+    """A response of an AsyncGitlab request, with a lazily read body."""
+
+    def __init__(
+        self, url: str, status: int, reason: str, headers: Dict[str, str],
+        reader: asyncio.StreamReader, timeout: Optional[float] = None,
+    ) -> None:
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.reader = reader
+        self.timeout = timeout
+        self.keep_alive = headers.get('connection', '').lower() != 'close'
+        self.complete = False
+        self.bytes_read = 0
+
+    def tell(self) -> int:
+        # for Stats
+        return self.bytes_read
+
+    async def wait(self, aw: Awaitable[T]) -> T:
+        return await read_timeout(aw, self.timeout, self.url)
+
+    async def iter_chunks(self) -> AsyncIterator[bytes]:
+        reader = self.reader
+        if 'chunked' in self.headers.get('transfer-encoding', '').lower():
+            while True:
+                size = int((await self.wait(reader.readline())).split(b';')[0],
+                           16)
+                if size == 0:
+                    while (await self.wait(reader.readline())).strip():
+                        pass  # skip trailers
+                    break
+                data = await self.wait(reader.readexactly(size))
+                await self.wait(reader.readexactly(2))  # CRLF
+                self.bytes_read += len(data)
+                yield data
+        elif 'content-length' in self.headers:
+            left = int(self.headers['content-length'])
+            while left > 0:
+                data = await self.wait(reader.read(min(left, CHUNK_SIZE)))
+                if not data:
+                    raise requests.exceptions.ChunkedEncodingError(
+                        f"Connection closed early: {self.url}")
+                left -= len(data)
+                self.bytes_read += len(data)
+                yield data
+        else:
+            self.keep_alive = False
+            while True:
+                data = await self.wait(reader.read(CHUNK_SIZE))
+                if not data:
+                    break
+                self.bytes_read += len(data)
+                yield data
+        self.complete = True
+
+    async def read(self) -> bytes:
+        return b''.join([chunk async for chunk in self.iter_chunks()])
+
+    async def json(self) -> Any:
+        return json.loads(await self.read())
+
+
+Connection = Tuple['asyncio.StreamReader', 'asyncio.StreamWriter']
+
+
+def ssl_context(verify: Union[bool, str]) -> ssl.SSLContext:
+    # check certificates like requests does: verify is True for certifi's
+    # CA bundle, False for not at all, or a CA bundle file or directory
+    if not verify:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        return context
+    path = verify if isinstance(verify, str) else (
+        requests.utils.extract_zipped_paths(
+            requests.utils.DEFAULT_CA_BUNDLE_PATH))
+    if os.path.isdir(path):
+        return ssl.create_default_context(capath=path)
+    return ssl.create_default_context(cafile=path)
+
+
+class AsyncGitlab:
+    """A minimal asyncio GitLab API client, for the few endpoints we use.
+
+    Speaks just enough HTTP/1.1 (keep-alive connections, chunked encoding,
+    redirects) to not need any extra dependencies.  Reports errors by
+    raising the same exceptions as requests.  Doesn't do HTTP proxies.
+    """
+
+    def __init__(
+        self, api_url: str, headers: Dict[str, str],
+        ssl_verify: Union[bool, str] = True, max_connections: int = 8,
+        stats: Optional[Stats] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        timeout: Optional[float] = None,
+    ) -> None:
+        self.api_url = api_url.rstrip('/') + '/'
+        self.headers = headers
+        self.ssl_verify = ssl_verify
+        self.ssl_context: Optional[ssl.SSLContext] = None
+        self.semaphore = asyncio.Semaphore(max_connections)
+        self.idle: Dict[Tuple[str, str, int], List[Connection]] = (
+            collections.defaultdict(list))
+        self.stats = stats
+        self.rate_limiter = rate_limiter
+        self.timeout = timeout
+
+    @classmethod
+    def from_gitlab(cls, gl: gitlab.Gitlab, **kwargs: Any) -> 'AsyncGitlab':
+        headers = {'User-Agent': f'gitlab-trace/{__version__}'}
+        if gl.private_token:
+            headers['PRIVATE-TOKEN'] = gl.private_token
+        elif gl.oauth_token:
+            headers['Authorization'] = f'Bearer {gl.oauth_token}'
+        elif gl.job_token:
+            headers['JOB-TOKEN'] = gl.job_token
+        # e.g. $REQUESTS_CA_BUNDLE, like python-gitlab's own requests
+        verify = gl.session.merge_environment_settings(
+            gl.api_url, {}, None, gl.ssl_verify, None)['verify']
+        return cls(gl.api_url, headers,
+                   ssl_verify=cast(Union[bool, str], verify),
+                   timeout=gl.timeout, **kwargs)
+
+    async def connect(self, scheme: str, host: str, port: int) -> Connection:
+        try:
+            if scheme == 'https' and self.ssl_context is None:
+                self.ssl_context = ssl_context(self.ssl_verify)
+            return await asyncio.wait_for(
+                asyncio.open_connection(
+                    host, port,
+                    ssl=self.ssl_context if scheme == 'https' else None),
+                self.timeout)
+        except asyncio.TimeoutError:
+            # (before OSError: it's the same as TimeoutError since 3.11)
+            raise requests.exceptions.ConnectTimeout(
+                f"Connection to {host}:{port} timed out after"
+                f" {self.timeout} s")
+        except OSError as e:
+            raise requests.exceptions.ConnectionError(
+                f"Cannot connect to {host}:{port}: {e}")
+
+    async def send(
+        self, url: str, extra_headers: Optional[Dict[str, str]] = None,
+    ) -> Tuple[AsyncResponse, Connection]:
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme
+        host = parts.hostname or ''
+        port = parts.port or (443 if scheme == 'https' else 80)
+        target = parts.path or '/'
+        if parts.query:
+            target += f'?{parts.query}'
+        headers = {'Host': parts.netloc, 'Accept-Encoding': 'identity'}
+        if url.startswith(self.api_url):
+            # don't leak the token when redirected to e.g. S3
+            headers.update(self.headers)
+            headers.update(extra_headers or {})
+        request = f'GET {target} HTTP/1.1\r\n' + ''.join(
+            f'{name}: {value}\r\n' for name, value in headers.items()
+        ) + '\r\n'
+        idle = self.idle[scheme, host, port]
+        while True:
+            reused = bool(idle)
+            if idle:
+                reader, writer = idle.pop()
+            else:
+                reader, writer = await self.connect(scheme, host, port)
+            try:
+                writer.write(request.encode('latin-1'))
+                await writer.drain()
+                status_line = await read_timeout(
+                    reader.readline(), self.timeout, url)
+            except ConnectionError:
+                status_line = b''
+            except requests.exceptions.ReadTimeout:
+                writer.close()
+                raise
+            if status_line:
+                break
+            writer.close()
+            if not reused:
+                raise requests.exceptions.ConnectionError(
+                    f"Connection closed by {host}:{port}")
+            # the server closed an idle keep-alive connection, try another
+        version, status, reason = (
+            status_line.decode('latin-1').rstrip('\r\n') + '  ').split(' ', 2)
+        response_headers = {}
+        while True:
+            try:
+                line = await read_timeout(reader.readline(), self.timeout, url)
+            except requests.exceptions.ReadTimeout:
+                writer.close()
+                raise
+            if not line.strip():
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+        response = AsyncResponse(url, int(status), reason.strip(),
+                                 response_headers, reader, self.timeout)
+        return response, (reader, writer)
+
+    def release(self, response: AsyncResponse, connection: Connection,
+                url: str) -> None:
+        if response.complete and response.keep_alive:
+            parts = urllib.parse.urlsplit(url)
+            port = parts.port or (443 if parts.scheme == 'https' else 80)
+            self.idle[parts.scheme, parts.hostname or '', port].append(
+                connection)
+        else:
+            connection[1].close()
+
+    @contextlib.asynccontextmanager
+    async def get(
+        self, path: str, params: Optional[Dict[str, Any]] = None,
+        headers: Optional[Dict[str, str]] = None, accept: Sequence[int] = (),
+    ) -> AsyncIterator[AsyncResponse]:
+        # accept lists error statuses to return instead of raising HTTPError
+        url = self.api_url + path
+        if params:
+            url += '?' + urllib.parse.urlencode(params, doseq=True)
+        async with self.semaphore:
+            for redirect in range(MAX_REDIRECTS + 1):
+                if self.rate_limiter is not None:
+                    await asyncio.sleep(self.rate_limiter.reserve())
+                start = time.perf_counter()
+                response, connection = await self.send(url, headers)
+                if self.stats is not None:
+                    self.stats.calls.append(ApiCall(
+                        endpoint=api_endpoint('GET', url),
+                        status=response.status,
+                        elapsed=time.perf_counter() - start,
+                        raw=response,
+                        bytes_out=0,
+                    ))
+                try:
+                    if (response.status in (301, 302, 303, 307, 308)
+                            and 'location' in response.headers):
+                        await response.read()
+                        url = urllib.parse.urljoin(
+                            url, response.headers['location'])
+                        continue
+                    if response.status >= 400 and (
+                            response.status not in accept):
+                        await response.read()
+                        raise requests.exceptions.HTTPError(
+                            f"{response.status} {response.reason}"
+                            f" for url: {url}")
+                    yield response
+                    return
+                finally:
+                    self.release(response, connection, url)
+            raise requests.exceptions.TooManyRedirects(
+                f"Exceeded {MAX_REDIRECTS} redirects: {url}")
+
+    async def get_json(
+        self, path: str, params: Optional[Dict[str, Any]] = None,
+    ) -> Any:
+        async with self.get(path, params) as response:
+            return await response.json()
+
+    async def get_bytes(self, path: str) -> bytes:
+        async with self.get(path) as response:
+            return await response.read()
+
+    async def list(
+        self, path: str, params: Optional[Dict[str, Any]] = None,
+        limit: Optional[int] = None,
+    ) -> List[Any]:
+        params = dict(params or {})
+        params['per_page'] = min(limit or 100, 100)
+        items: List[Any] = []
+        page = '1'
+        while page and (limit is None or len(items) < limit):
+            params['page'] = page
+            async with self.get(path, params) as response:
+                items.extend(await response.json())
+                page = response.headers.get('x-next-page', '')
+        return items[:limit]
+
+    def close(self) -> None:
+        for connections in self.idle.values():
+            for reader, writer in connections:
+                writer.close()
+        self.idle.clear()
+
+    # The GitLab API endpoints we use
+
+    async def project(self, project: str) -> Any:
+        return as_object(await self.get_json(f'projects/{quote(project)}'))
+
+    async def group_projects(self, group: str) -> List[str]:
+        return [
+            project['path_with_namespace'] for project in await self.list(
+                f'groups/{quote(group)}/projects',
+                {'include_subgroups': 'true', 'archived': 'false'})
+        ]
+
+    async def pipelines(self, project: str, ref: str, limit: int) -> List[Any]:
+        return [
+            as_object(pipeline) for pipeline in await self.list(
+                f'projects/{quote(project)}/pipelines', {'ref': ref},
+                limit=limit)
+        ]
+
+    async def pipeline(self, project: str, pipeline_id: int) -> Any:
+        return as_object(await self.get_json(
+            f'projects/{quote(project)}/pipelines/{pipeline_id}'))
+
+    async def pipeline_jobs(
+        self, project: str, pipeline_id: int, scope: Sequence[str] = (),
+    ) -> List[Any]:
+        params = {'scope[]': list(scope)} if scope else None
+        return [
+            as_object(job) for job in await self.list(
+                f'projects/{quote(project)}/pipelines/{pipeline_id}/jobs',
+                params)
+        ]
+
+    async def pipeline_bridges(
+        self, project: str, pipeline_id: int,
+    ) -> List[Any]:
+        return [
+            as_object(bridge) for bridge in await self.list(
+                f'projects/{quote(project)}/pipelines/{pipeline_id}/bridges')
+        ]
+
+    async def job(self, project: str, job_id: int) -> Any:
+        return as_object(await self.get_json(
+            f'projects/{quote(project)}/jobs/{job_id}'))
+
+    async def trace(self, project: str, job_id: int) -> bytes:
+        return await self.get_bytes(
+            f'projects/{quote(project)}/jobs/{job_id}/trace')
+
+    async def trace_range(
+        self, project: str, job_id: int, range: Optional[str],
+    ) -> Tuple[int, Optional[str], bytes]:
+        # like the trace_range() function for python-gitlab jobs
+        async with self.get(
+            f'projects/{quote(project)}/jobs/{job_id}/trace',
+            headers={'Range': range} if range else None, accept=(416,),
+        ) as response:
+            data = await response.read()
+            if response.status == 416:
+                data = b''
+            return response.status, response.headers.get('content-range'), data
+
+    async def job_with_trace(
+        self, project: str, job_id: int,
+    ) -> Tuple[Any, bytes]:
+        return await asyncio.gather(
+            self.job(project, job_id), self.trace(project, job_id))
+
+    def stream(self, project: str, job_id: int, what: str = 'trace') -> Any:
+        # what can be 'trace' or 'artifacts'
+        return self.get(f'projects/{quote(project)}/jobs/{job_id}/{what}')
+
+
+def quote(project: str) -> str:
+    return urllib.parse.quote(str(project), safe='')
+
+
+def as_object(attributes: Dict[str, Any]) -> Any:
+    # Looks enough like a python-gitlab object for our purposes
+    obj = types.SimpleNamespace(**attributes)
+    obj.attributes = attributes
+    return obj
+
+
+async def follow_async(
+    client: AsyncGitlab, project: str, job: Any, buffer: Output,
+    interval: float = 1.0, tail: Optional[int] = None,
+    stats: Optional[Stats] = None,
+) -> Any:
+    # Returns the job as last seen, to know how it finished
+    cursor = TraceCursor(tail)
+
+    async def new_data() -> bytes:
+        while True:
+            data = cursor.update(*await client.trace_range(
+                project, job.id, cursor.range()))
+            if data is not None:
+                return data
+
+    buffer.write(await new_data())
+    buffer.flush()
+    while not job.finished_at and not buffer.closed:
+        await asyncio.sleep(interval)
+        if stats is not None:
+            stats.slept += interval
+        # NB: not concurrently, to get the full trace of a job that finished
+        job = await client.job(project, job.id)
+        data = await new_data()
+        if data:
+            buffer.write(data)
+        # even without new data, for Coalesce to write out what it held back
+        buffer.flush()
+    return job
+
+
+class Engine(Protocol):
+    """How run() talks to GitLab.
+
+    Projects are passed by name (or ID), after a call to open_project(),
+    so that an engine can look them up however it likes; jobs are the
+    objects returned by jobs().
+    """
+
+    api_url: str
+    # whether follow() can follow several jobs at once
+    follows_several: bool
+
+    def close(self) -> None: ...
+
+    def open_project(self, project: str) -> None: ...
+
+    def web_url(self, project: str) -> str: ...
+
+    def group_projects(self, group: str) -> List[str]: ...
+
+    def project_statuses(
+        self, names: Sequence[str], ref: Optional[str],
+    ) -> Iterator[ProjectStatus]: ...
+
+    def indexed_traces(
+        self, project: str, job_ids: Sequence[int],
+    ) -> List[Tuple[Any, IndexedTrace]]: ...
+
+    def pipelines(self, project: str, ref: str, limit: int) -> List[Any]: ...
+
+    def pipeline_jobs(
+        self, project: str, pipelines: Sequence[Any],
+    ) -> List[List[Any]]: ...
+
+    def pipeline_tree(
+        self, project: str, pipeline_id: int, scope: Sequence[str] = (),
+        recursive: bool = False,
+    ) -> Tuple[Any, List[PipelineNode]]: ...
+
+    def traces(
+        self, project: str, job_ids: List[int],
+    ) -> Iterator[Tuple[Any, bytes]]: ...
+
+    def jobs(self, project: str, job_ids: Sequence[int]) -> List[Any]: ...
+
+    def follow(
+        self, project: str, jobs: Sequence[Any], outputs: Sequence[Output],
+        tail: Optional[int] = None, stats: Optional[Stats] = None,
+    ) -> List[Any]: ...
+
+    def trace_chunks(self, project: str, job: Any) -> Iterator[bytes]: ...
+
+    def trace(self, project: str, job: Any) -> bytes: ...
+
+    def artifacts(
+        self, project: str, job: Any, write: Callable[[bytes], None],
+    ) -> None: ...
+
+
+class GitlabEngine:
+    """An Engine using python-gitlab, and threads for parallel API calls."""
+
+    follows_several = False
+
+    def __init__(self, gl: gitlab.Gitlab, workers: int = 4) -> None:
+        self.gl = gl
+        self.api_url = gl.api_url
+        self.workers = workers
+        self.projects: Dict[str, Project] = {}
+
+    def close(self) -> None:
+        pass
+
+    def project(self, name: str) -> Project:
+        if name not in self.projects:
+            self.projects[name] = self.gl.projects.get(name)
+        return self.projects[name]
+
+    def open_project(self, project: str) -> None:
+        self.project(project)
+
+    def web_url(self, project: str) -> str:
+        return str(self.project(project).web_url)
+
+    def group_projects(self, group: str) -> List[str]:
+        return group_projects(self.gl, group)
+
+    def project_statuses(
+        self, names: Sequence[str], ref: Optional[str],
+    ) -> Iterator[ProjectStatus]:
+        return fetch_project_statuses(self.gl, names, ref,
+                                      workers=self.workers)
+
+    def indexed_traces(
+        self, project: str, job_ids: Sequence[int],
+    ) -> List[Tuple[Any, IndexedTrace]]:
+        fetch = partial(fetch_indexed_trace, self.project(project))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+            return list(pool.map(fetch, job_ids))
+
+    def pipelines(self, project: str, ref: str, limit: int) -> List[Any]:
+        return list(itertools.islice(
+            self.project(project).pipelines.list(
+                ref=ref, iterator=True, per_page=min(limit, 100)),
+            limit))
+
+    def pipeline_jobs(
+        self, project: str, pipelines: Sequence[Any],
+    ) -> List[List[Any]]:
+        def fetch(pipeline: Any) -> List[Any]:
+            return list(pipeline.jobs.list(all=True, per_page=100))
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers) as pool:
+            return list(pool.map(fetch, pipelines))
+
+    def pipeline_tree(
+        self, project: str, pipeline_id: int, scope: Sequence[str] = (),
+        recursive: bool = False,
+    ) -> Tuple[Any, List[PipelineNode]]:
+        pipeline = self.project(project).pipelines.get(pipeline_id)
+        if recursive:
+            return pipeline, fetch_pipeline_tree(
+                self.gl, self.project(project), pipeline_id, scope,
+                workers=self.workers)
+        if scope:
+            jobs = pipeline.jobs.list(all=True, scope=scope)
+        else:
+            jobs = pipeline.jobs.list(all=True)
+        return pipeline, [PipelineNode(job, pipeline_id) for job in jobs]
+
+    def traces(
+        self, project: str, job_ids: List[int],
+    ) -> Iterator[Tuple[Any, bytes]]:
+        return fetch_traces(self.project(project), job_ids,
+                            workers=self.workers)
+
+    def jobs(self, project: str, job_ids: Sequence[int]) -> List[Any]:
+        return [self.project(project).jobs.get(job_id) for job_id in job_ids]
+
+    def follow(
+        self, project: str, jobs: Sequence[Any], outputs: Sequence[Output],
+        tail: Optional[int] = None, stats: Optional[Stats] = None,
+    ) -> List[Any]:
+        # one after the other, which is why run() only gives us one job
+        for job, output in zip(jobs, outputs):
+            follow(job, buffer=output, tail=tail, stats=stats)
+        return list(jobs)
+
+    def trace_chunks(self, project: str, job: Any) -> Iterator[bytes]:
+        return iter(job.trace(streamed=True, iterator=True,
+                              chunk_size=CHUNK_SIZE))
+
+    def trace(self, project: str, job: Any) -> bytes:
+        return bytes(job.trace())
+
+    def artifacts(
+        self, project: str, job: Any, write: Callable[[bytes], None],
+    ) -> None:
+        job.artifacts(streamed=True, action=write)
+
+
+class AsyncEngine:
+    """An Engine using AsyncGitlab, which overlaps independent API calls.
+
+    Every call runs an event loop until its result is there; requests
+    started earlier in the background, like the project's, make progress
+    meanwhile.
+    """
+
+    follows_several = True
+
+    def __init__(self, client: AsyncGitlab, workers: int = 4) -> None:
+        self.client = client
+        self.api_url = client.api_url
+        self.workers = workers
+        self.loop = asyncio.new_event_loop()
+        self.projects: Dict[str, 'asyncio.Task[Any]'] = {}
+
+    def wait(self, aw: Awaitable[T]) -> T:
+        return self.loop.run_until_complete(aw)
+
+    def iterate(self, items: AsyncGenerator[T, None]) -> Iterator[T]:
+        try:
+            while True:
+                try:
+                    yield self.wait(anext(items))
+                except StopAsyncIteration:
+                    return
+        finally:
+            # (close() takes care of generators left over after errors)
+            if not self.loop.is_closed():
+                self.wait(items.aclose())
+
+    def close(self) -> None:
+        self.client.close()
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            self.wait(asyncio.gather(*tasks, return_exceptions=True))
+        self.wait(self.loop.shutdown_asyncgens())
+        self.loop.close()
+
+    def open_project(self, project: str) -> None:
+        task = self.loop.create_task(self.client.project(project))
+        # we might not need it; errors will show up in other API calls anyway
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self.projects[project] = task
+
+    def web_url(self, project: str) -> str:
+        return str(self.wait(self.projects[project]).web_url)
+
+    def group_projects(self, group: str) -> List[str]:
+        return self.wait(self.client.group_projects(group))
+
+    def project_statuses(
+        self, names: Sequence[str], ref: Optional[str],
+    ) -> Iterator[ProjectStatus]:
+        return self.iterate(fetch_project_statuses_async(self.client, names,
+                                                         ref))
+
+    def indexed_traces(
+        self, project: str, job_ids: Sequence[int],
+    ) -> List[Tuple[Any, IndexedTrace]]:
+        return self.wait(gather(
+            fetch_indexed_trace_async(self.client, project, job_id)
+            for job_id in job_ids))
+
+    def pipelines(self, project: str, ref: str, limit: int) -> List[Any]:
+        return self.wait(self.client.pipelines(project, ref=ref, limit=limit))
+
+    def pipeline_jobs(
+        self, project: str, pipelines: Sequence[Any],
+    ) -> List[List[Any]]:
+        # the client limits the number of concurrent requests
+        return self.wait(gather(
+            self.client.pipeline_jobs(project, pipeline.id)
+            for pipeline in pipelines))
+
+    def pipeline_tree(
+        self, project: str, pipeline_id: int, scope: Sequence[str] = (),
+        recursive: bool = False,
+    ) -> Tuple[Any, List[PipelineNode]]:
+        async def nodes() -> List[PipelineNode]:
+            if recursive:
+                return await fetch_pipeline_tree_async(
+                    self.client, await self.projects[project], pipeline_id,
+                    scope)
+            return [
+                PipelineNode(job, pipeline_id) for job in
+                await self.client.pipeline_jobs(project, pipeline_id, scope)
+            ]
+
+        async def fetch() -> Tuple[Any, List[PipelineNode]]:
+            return await asyncio.gather(
+                self.client.pipeline(project, pipeline_id), nodes())
+        return self.wait(fetch())
+
+    def traces(
+        self, project: str, job_ids: List[int],
+    ) -> Iterator[Tuple[Any, bytes]]:
+        return self.iterate(fetch_traces_async(self.client, project, job_ids,
+                                               workers=self.workers))
+
+    def jobs(self, project: str, job_ids: Sequence[int]) -> List[Any]:
+        return self.wait(gather(
+            self.client.job(project, job_id) for job_id in job_ids))
+
+    def follow(
+        self, project: str, jobs: Sequence[Any], outputs: Sequence[Output],
+        tail: Optional[int] = None, stats: Optional[Stats] = None,
+    ) -> List[Any]:
+        return self.wait(gather(
+            follow_async(self.client, project, job, buffer=output, tail=tail,
+                         stats=stats)
+            for job, output in zip(jobs, outputs)))
+
+    def trace_chunks(self, project: str, job: Any) -> Iterator[bytes]:
+        return self.iterate(stream_async(self.client, project, job.id))
+
+    def trace(self, project: str, job: Any) -> bytes:
+        return self.wait(self.client.trace(project, job.id))
+
+    def artifacts(
+        self, project: str, job: Any, write: Callable[[bytes], None],
+    ) -> None:
+        for chunk in self.iterate(stream_async(self.client, project, job.id,
+                                               'artifacts')):
+            write(chunk)
+
+
+async def gather(aws: Iterable[Awaitable[T]]) -> List[T]:
+    # asyncio.gather() of a list, from outside of the event loop
+    return list(await asyncio.gather(*aws))
+
+
+async def stream_async(
+    client: AsyncGitlab, project: str, job_id: int, what: str = 'trace',
+) -> AsyncGenerator[bytes, None]:
+    async with client.stream(project, job_id, what) as response:
+        async for chunk in response.iter_chunks():
+            yield chunk
+
+
+class VersionAction(argparse.Action):
+    """Like action="version", but imports python-gitlab only when used."""
+
+    def __init__(self, option_strings: List[str], dest: str,
+                 help: Optional[str] = None) -> None:
+        super().__init__(option_strings, dest=argparse.SUPPRESS,
+                         default=argparse.SUPPRESS, nargs=0, help=help)
+
+    def __call__(self, parser: argparse.ArgumentParser, *args: Any) -> None:
+        print(", ".join([
+            f"{parser.prog} version {__version__}",
+            f"python-gitlab version {gitlab.__version__}"
+        ]))
+        parser.exit()
+
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--version", action=VersionAction,
+        help="show program's version number and exit",
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true",
+        help="print more information",
+    )
+    parser.add_argument(
+        "--debug", action="store_true",
+        help="print even more information, for debugging",
+    )
+    parser.add_argument(
+        "-g", "--gitlab", metavar="NAME",
+        help="select configuration section in ~/.python-gitlab.cfg",
+    )
+    parser.add_argument(
+        "-p", "--project", metavar="ID", action="append", dest="projects",
+        default=[],
+        help=(
+            "select GitLab project ('group/project' or the numeric ID);"
+            " can be repeated to show the status of the last pipeline of"
+            " each project"
+        ),
+    )
+    parser.add_argument(
+        "--group", metavar="NAME",
+        help=(
+            "show the status of the last pipeline of every project in this"
+            " GitLab group and its subgroups (on --branch, or on the default"
+            " branch of each project; --running, --failed and --status show"
+            " only the pipelines with these statuses)"
+        ),
+    )
+    parser.add_argument(
+        "--job", metavar="ID",
+        help=(
+            "show the trace of GitLab CI job with this ID"
+            " (or several jobs, e.g. --job=101,103,110-115)"
+        ),
+    )
+    parser.add_argument(
+        "--running", action="store_true",
+        help=(
+            "show the trace of the currently running GitLab CI job,"
+            " if there is one (if there's more than one, picks the first one)"
+        ),
+    )
+    parser.add_argument(
+        "--failed", action="store_true",
+        help=(
+            "show the trace of the failed GitLab CI job,"
+            " if there is one (if there's more than one, picks the first one)"
+        ),
+    )
+    parser.add_argument(
+        "--status", metavar="STATUS[,STATUS...]",
+        help=(
+            "list only GitLab CI jobs with this status"
+            f" ({', '.join(JOB_STATUSES)})"
+        ),
+    )
+    parser.add_argument(
+        "-b", "--branch", "--ref", metavar="NAME",
+        help=(
+            "show the last pipeline of this git branch"
+            " (default: the currently checked out branch)"
+        ),
+    )
+    parser.add_argument(
+        "--diff", metavar="JOB-ID", type=int, nargs=2,
+        help=(
+            "show the differences between the traces of two jobs, ignoring"
+            " timestamps, durations and colors (-C N sets the number of"
+            " context lines; default: 3)"
+        ),
+    )
+    parser.add_argument(
+        "-r", "--recursive", action="store_true",
+        help=(
+            "also list (and select from) the jobs of child and downstream"
+            " pipelines triggered by the pipeline"
+        ),
+    )
+    parser.add_argument(
+        "--history", metavar="N", type=int,
+        help=(
+            "show which jobs passed or failed in each of the last N"
+            " pipelines of the git branch"
+        ),
+    )
+    parser.add_argument(
+        "-t", "--tail", metavar='N', nargs='?', type=int, const=10,
+        help="show the last N lines of the trace log",
+    )
+    parser.add_argument(
+        "-f", "--follow", action="store_true",
+        help="periodically poll and output additional logs as the job runs",
+    )
+    parser.add_argument(
+        "--flush-interval", metavar="SECONDS", type=float, default=5,
+        help=(
+            "with --follow, when stdout is not a terminal, write out new"
+            " complete lines in batches, holding them back for at most"
+            " SECONDS seconds"
+            " (default: %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "--print-url", "--print-uri", action="store_true",
+        help="print URL to job page on GitLab instead of printing job's log",
+    )
+    parser.add_argument(
+        "--grep", metavar="PATTERN",
+        help="show only the lines of the trace log matching this regexp",
+    )
+    parser.add_argument(
+        "-A", "--after-context", metavar="N", type=int, default=0,
+        help="with --grep, also show N lines after each matching line",
+    )
+    parser.add_argument(
+        "-B", "--before-context", metavar="N", type=int, default=0,
+        help="with --grep, also show N lines before each matching line",
+    )
+    parser.add_argument(
+        "-C", "--context", metavar="N", type=int,
+        help="with --grep, also show N lines around each matching line",
+    )
+    parser.add_argument(
+        "-m", "--max-count", metavar="N", type=int,
+        help="with --grep, stop after N matching lines",
+    )
+    parser.add_argument(
+        "--section", metavar="NAME", action="append",
+        help=(
+            "show only this section of the trace log, e.g. step_script"
+            " (can be repeated)"
+        ),
+    )
+    parser.add_argument(
+        "--collapse", action="store_true",
+        help="show only the header lines of trace log sections",
+    )
+    parser.add_argument(
+        "--timings", metavar="FORMAT", nargs="?", const="text",
+        choices=["text", "json"],
+        help=(
+            "instead of the trace log, show how long each section of the job"
+            " (or of every job in the pipeline) took, slowest first"
+            " (FORMAT can be text or json; default: text)"
+        ),
+    )
+    parser.add_argument(
+        "--color", "--colour", choices=["auto", "always", "never"],
+        default="auto",
+        help=(
+            "keep colors and other escape sequences in the trace log"
+            " (default: %(default)s, i.e. only when stdout is a terminal)"
+        ),
+    )
+    parser.add_argument(
+        "--format", choices=["text", "ndjson"], default="text",
+        help=(
+            "output format: text, or ndjson for a stream of JSON objects,"
+            " one per line, describing pipelines, jobs and chunks of the"
+            " trace log as they arrive (default: %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "-a", "--artifacts", action="store_true",
+        help="download build artifacts",
+    )
+    parser.add_argument(
+        "--extract", metavar="DIR",
+        help=(
+            "download build artifacts and extract them into DIR while they"
+            " are being downloaded"
+        ),
+    )
+    parser.add_argument(
+        "--extract-only", metavar="PATTERN", action="append", default=[],
+        help=(
+            "with --extract, extract only the files matching this wildcard"
+            " pattern, e.g. 'reports/*.xml' (can be repeated)"
+        ),
+    )
+    parser.add_argument(
+        "--cache-size", metavar="MiB", type=int, default=ARTIFACTS_CACHE_SIZE,
+        help=(
+            "keep up to this many MiB of artifacts downloaded with"
+            " --artifacts in ~/.cache/gitlab-trace/artifacts, so they don't"
+            " need to be downloaded again (default: %(default)s; 0 disables"
+            " the cache)"
+        ),
+    )
+    parser.add_argument(
+        "-o", "--output-dir", metavar="DIR",
+        help=(
+            "when showing several jobs, save each trace to DIR/JOB-ID.log"
+            " instead of printing them all"
+        ),
+    )
+    parser.add_argument(
+        "--parallel", metavar="N", type=int, default=4,
+        help=(
+            "download up to N traces (or look at up to N projects) at once"
+            " (default: %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "--async", action="store_true", dest="use_async",
+        help=(
+            "talk to GitLab using asyncio, making independent API calls"
+            " concurrently; with --follow, follow several jobs at once"
+        ),
+    )
+    parser.add_argument(
+        "--stats", action="store_true",
+        help="print statistics about GitLab API calls made",
+    )
+    parser.add_argument(
+        "--stats-json", metavar="FILENAME",
+        help="save statistics about GitLab API calls made to a JSON file",
+    )
+    add_profile_arguments(parser)
+    add_daemon_arguments(parser)
+    parser.add_argument(
+        "pipeline", nargs="?", type=int, metavar="PIPELINE-ID",
+        help=(
+            "select a GitLab CI pipeline by ID"
+            " (default: the last pipeline of a git branch)"
+        ),
+    )
+    parser.add_argument(
+        "job_name", nargs="?", metavar="JOB-NAME",
+        help=(
+            "select a GitLab CI pipeline job by name"
+            " (or several jobs with a wildcard pattern, e.g. 'test_*')"
+        ),
+    )
+    parser.add_argument(
+        "idx", nargs='?', metavar="NTH-JOB-OF-THAT-NAME", type=int,
+        help=(
+            "select n-th GitLab CI pipeline job by this name"
+            " (default: the last one)"
+        ),
+    )
+    return parser
+
+
+def _main(
+    argv: Optional[List[str]] = None, daemon: Optional['Daemon'] = None,
+) -> None:
+    args = make_parser().parse_args(argv)
+    args.project = args.projects[0] if args.projects else None
+
+    if args.profile and args.profile not in PROFILE_MODES:
+        fatal(f"Unknown --profile mode: {args.profile}")
+
+    if args.color == 'auto':
+        strip_ansi = not sys.stdout.isatty()
+        colorama_strip = None
+    else:
+        strip_ansi = args.color == 'never'
+        colorama_strip = strip_ansi
+    if daemon is None:
+        colorama.init(strip=colorama_strip)
+    else:
+        daemon.init_colorama(strip=colorama_strip)
+
+    if args.job:
+        try:
+            parse_job_ids(args.job)
+        except ValueError:
+            fatal(f"Invalid job ID list: {args.job}")
+
+    if args.job and args.running:
+        warn(f"Ignoring --running because --job={args.job} was specified")
+
+    if args.job and args.failed:
+        warn(f"Ignoring --failed because --job={args.job} was specified")
+
+    filters: List[Callable[[Output], LineFilter]] = []
+    if strip_ansi or args.section or args.collapse:
+        filters.append(partial(
+            TraceFilter, strip_ansi=strip_ansi, sections=args.section,
+            collapse=args.collapse,
+            on_section_end=(
+                partial(report_section, sections=args.section)
+                if args.section or args.collapse else None
+            ),
+        ))
+    if args.parallel < 1:
+        fatal(f"--parallel must be at least 1: {args.parallel}")
+    if args.history is not None and args.history < 1:
+        fatal(f"--history must be at least 1: {args.history}")
+    for option, value in [("-A", args.after_context),
+                          ("-B", args.before_context), ("-C", args.context)]:
+        if value is not None and value < 0:
+            fatal(f"{option} can't be negative: {value}")
+    if args.grep:
+        try:
+            pattern = re.compile(args.grep.encode())
+        except re.error as e:
+            fatal(f"Invalid --grep pattern: {e}")
+        if args.context is not None:
+            args.before_context = args.after_context = args.context
+        filters.append(partial(
+            Grep, pattern=pattern, before=args.before_context,
+            after=args.after_context, max_count=args.max_count,
+        ))
+
+    # filter the job list on the server side: huge pipelines have lots of jobs
+    scope = args.status.split(',') if args.status else []
+    for status in scope:
+        if status not in JOB_STATUSES:
+            fatal(f"Unknown job status: {status}")
+    autoselect = []
+    if args.running:
+        autoselect.append('running')
+    if args.failed:
+        autoselect.append('failed')
+    if not args.job_name:
+        # with JOB-NAME, --running and --failed mustn't hide the named job
+        scope.extend(status for status in autoselect if status not in scope)
+
+    if args.format == 'ndjson':
+        for option, value in [("--print-url", args.print_url),
+                              ("--timings", args.timings),
+                              ("--diff", args.diff),
+                              ("--history", args.history)]:
+            if value:
+                fatal(f"--format=ndjson can't be combined with {option}")
+
+    if args.extract_only and not args.extract:
+        warn("Ignoring --extract-only because --extract wasn't specified")
+
+    if several_projects(args) and (
+            args.job or args.pipeline or args.diff or args.history):
+        fatal("--group and several --project options can't be combined"
+              " with --job, --diff, --history or a pipeline ID")
+
+    if args.diff and args.job:
+        warn(f"Ignoring --job={args.job} because --diff was specified")
+        args.job = None
+    if args.diff and args.pipeline:
+        warn(f"Ignoring pipeline ({args.pipeline})"
+             f" because --diff was specified")
+        args.pipeline = None
+    if args.diff and args.history:
+        warn("Ignoring --history because --diff was specified")
+        args.history = None
+
+    if args.history and args.job:
+        warn(f"Ignoring --history because --job={args.job} was specified")
+        args.history = None
+    elif args.history and args.pipeline:
+        warn(f"Ignoring --history"
+             f" because pipeline ({args.pipeline}) was specified")
+        args.history = None
+
+    if args.job and args.pipeline:
+        warn(f"Ignoring pipeline ({args.pipeline})"
+             f" because --job={args.job} was specified")
+    if args.job and args.recursive:
+        warn(f"Ignoring --recursive because --job={args.job} was specified")
+
+    if not args.project and not several_projects(args):
+        args.project = determine_project()
+        if args.project:
+            info(f"GitLab project: {args.project}")
+        else:
+            fatal("Could not determine GitLab project ID")
+
+    stats = Stats() if args.stats or args.stats_json else None
+    limiter = rate_limiter(args.gitlab)
+    if daemon is not None and stats is None:
+        # reuse the keep-alive connections and cached objects of earlier runs
+        gl = daemon.gitlab(args.gitlab)
+    else:
+        gl = gitlab.Gitlab.from_config(args.gitlab)
+        if limiter is not None:
+            limiter.install(gl.session)
+    if stats is not None:
+        stats.install(gl.session)
+    if args.use_async and (
+            gl.session.proxies
+            or requests.utils.get_environ_proxies(gl.api_url)):
+        warn("Ignoring --async because an HTTP proxy is configured")
+        args.use_async = False
+    engine: Engine
+    if args.use_async:
+        engine = AsyncEngine(
+            AsyncGitlab.from_gitlab(gl, stats=stats, rate_limiter=limiter,
+                                    max_connections=args.parallel),
+            workers=args.parallel)
+    else:
+        engine = GitlabEngine(gl, workers=args.parallel)
+    try:
+        run(args, engine, filters=filters, scope=scope,
+            autoselect=autoselect, stats=stats)
+    finally:
+        engine.close()
+        if stats is not None:
+            if args.stats:
+                stats.report()
+            if args.stats_json:
+                with open(args.stats_json, "w") as f:
+                    json.dump(stats.summary(), f, indent=2)
+                    f.write("\n")
+
+
+def run(
+    args: argparse.Namespace, engine: 'Engine',
+    filters: Sequence[Callable[[Output], LineFilter]] = (),
+    scope: Sequence[str] = (), autoselect: Sequence[str] = (),
+    stats: Optional['Stats'] = None,
+) -> None:
+    if several_projects(args):
+        names = list(args.projects)
+        if args.group:
+            names += engine.group_projects(args.group)
+        names = list(dict.fromkeys(names))
+        width = max(map(len, names), default=0)
+        for status in engine.project_statuses(names, args.branch):
+            print_project_status(status, width, scope,
+                                 events=args.format == 'ndjson')
+        sys.exit(0)
+
+    engine.open_project(args.project)
+
+    if args.diff:
+        a, b = engine.indexed_traces(args.project, args.diff)
+        print_diff(a, b, apply_filters(sys.stdout.buffer, filters),
+                   context=3 if args.context is None else args.context)
+        sys.exit(0)
+
+    if args.history:
+        if not args.branch:
+            args.branch = determine_branch()
+            info(f"Current branch: {args.branch}")
+        pipelines = engine.pipelines(args.project, args.branch, args.history)
+        if not pipelines:
+            fatal(f"Project {args.project} doesn't have any pipelines"
+                  f" for branch {args.branch}")
+        print_history(list(zip(pipelines, engine.pipeline_jobs(
+            args.project, pipelines))), scope)
+        sys.exit(0)
+
+    if not args.job and (not args.pipeline or args.pipeline < 0):
+        if not args.branch:
+            args.branch = determine_branch()
+            info(f"Current branch: {args.branch}")
+
+        which = -args.pipeline - 1 if args.pipeline else 0
+        pipelines = engine.pipelines(args.project, args.branch, which + 1)
+        if len(pipelines) > which:
+            args.pipeline = pipelines[which].id
+            if not args.print_url or args.job_name:
+                info(f"{engine.web_url(args.project)}"
+                     f"/pipelines/{args.pipeline}")
+        elif which == 0:
+            fatal(f"Project {args.project} doesn't have any pipelines"
+                  f" for branch {args.branch}")
+        else:
+            fatal(f"Project {args.project} has only {len(pipelines)}"
+                  f" pipelines for branch {args.branch}")
+    elif args.branch:
+        if args.job:
+            warn(f"Ignoring --branch={args.branch}"
+                 f" because --job={args.job} was specified")
+        else:
+            assert args.pipeline
+            warn(f"Ignoring --branch={args.branch}"
+                 f" because pipeline ({args.pipeline}) was specified")
+
+    if not args.job:
+        pipeline, nodes = engine.pipeline_tree(
+            args.project, args.pipeline, scope, recursive=args.recursive)
+        name = args.project
+        select_job(args, engine.web_url(args.project), pipeline, nodes,
+                   autoselect)
+        if args.project != name:
+            engine.open_project(args.project)
+
+    job_ids = parse_job_ids(str(args.job))
+    if args.timings:
+        print_timings(engine.traces(args.project, job_ids), fmt=args.timings)
+        sys.exit(0)
+    if len(job_ids) > 1:
+        if args.print_url:
+            web_url = engine.web_url(args.project)
+            for job_id in job_ids:
+                print(f"{web_url}/-/jobs/{job_id}")
+            sys.exit(0)
+        if args.follow and not engine.follows_several:
+            warn("Ignoring --follow because several jobs were selected.")
+            args.follow = False
+        if artifacts_option(args):
+            warn(f"Ignoring {artifacts_option(args)}"
+                 " because several jobs were selected.")
+            args.artifacts = False
+            args.extract = None
+        if not args.follow:
+            write_traces(engine.traces(args.project, job_ids), n=args.tail,
+                         output_dir=args.output_dir, filters=filters,
+                         events=args.format == 'ndjson')
+            sys.exit(0)
+
+    jobs = engine.jobs(args.project, job_ids)
+    for job in jobs:
+        describe_job(args, job)
+    if args.print_url:
+        print(f"{engine.web_url(args.project)}/-/jobs/{jobs[0].id}")
+    elif args.follow and args.format == 'ndjson':
+        # the events say which job they're about, no need for prefixes
+        outputs = [
+            apply_filters(TraceEvents(sys.stdout.buffer, job.id), filters)
+            for job in jobs
+        ]
+        jobs = engine.follow(args.project, jobs, outputs, tail=args.tail,
+                             stats=stats)
+        for job, output in zip(jobs, outputs):
+            assert isinstance(output, LineFilter)
+            output.close()
+            write_event(sys.stdout.buffer, 'trace_end', job=job.id,
+                        status=job.status)
+    elif args.follow:
+        sink = follow_output(args.flush_interval)
+        outputs = [
+            apply_filters(
+                Prefix(sink, f"[{job.name}] ".encode())
+                if len(jobs) > 1 else sink,
+                filters)
+            for job in jobs
+        ]
+        engine.follow(args.project, jobs, outputs, tail=args.tail,
+                      stats=stats)
+        for output in outputs:
+            assert isinstance(output, LineFilter)
+            output.close()
+        sink.close()
+    else:
+        job = jobs[0]
+        events = (TraceEvents(sys.stdout.buffer, job.id)
+                  if args.format == 'ndjson' else None)
+        if filters or events or args.tail:
+            output = apply_filters(events or sys.stdout.buffer, filters,
+                                   args.tail)
+            assert isinstance(output, LineFilter)
+            # stream the trace so we can stop downloading it after
+            # --max-count matches
+            for chunk in engine.trace_chunks(args.project, job):
+                output.write(chunk)
+                if output.closed:
+                    break
+            output.close()
+        else:
+            write_trace(sys.stdout.buffer, engine.trace(args.project, job))
+        if events:
+            write_event(sys.stdout.buffer, 'trace_end', job=job.id,
+                        status=job.status)
+    if artifacts_option(args):
+        with artifacts_output(args, jobs[0], engine.api_url) as write:
+            if write is not None:
+                engine.artifacts(args.project, jobs[0], write)
+    sys.exit(0)
+
+
+def artifacts_option(args: argparse.Namespace) -> Optional[str]:
+    # which option asked for the artifacts, for warnings
+    if args.artifacts:
+        return "--artifacts"
+    if args.extract:
+        return "--extract"
+    return None
+
+
+@contextlib.contextmanager
+def artifacts_output(
+    args: argparse.Namespace, job: Any, server: str,
+) -> Iterator[Optional[Callable[[bytes], None]]]:
+    # where to write the artifacts archive: a file, a ZipExtractor, the
+    # cache, or several of these; or None if it doesn't need downloading
+    if not hasattr(job, 'artifacts_file'):
+        warn("Job has no artifacts.")
+        sys.exit(1)
+    filename = job.artifacts_file['filename']
+    size = job.artifacts_file['size']
+    cache = None
+    path = None
+    if args.cache_size > 0 and size <= args.cache_size * 1024**2:
+        # (archives that wouldn't fit would only push everything else out)
+        cache = ArtifactsCache(artifacts_cache_dir(),
+                               max_size=args.cache_size * 1024**2)
+        path = cache.get(server, job.id, size)
+    description = f"{filename} ({fmt_size(size)}{', cached' if path else ''})"
+    if args.artifacts:
+        if os.path.lexists(filename):
+            fatal(f"{filename} already exists")
+        info(f"Artifacts: {description}")
+    extractor = None
+    if args.extract:
+        info(f"Extracting {description} into {args.extract}")
+        extractor = ZipExtractor(args.extract, args.extract_only)
+    if path is not None:
+        yield None
+        if args.artifacts:
+            copy_file(path, filename)
+        if extractor is not None:
+            with open(path, 'rb') as f:
+                for chunk in iter(partial(f.read, CHUNK_SIZE), b''):
+                    extractor.write(chunk)
+    else:
+        actions: List[Callable[[bytes], Any]] = []
+        with contextlib.ExitStack() as stack:
+            if args.artifacts:
+                actions.append(stack.enter_context(open(filename, "xb")).write)
+            if args.artifacts and cache is not None:
+                # into the cache at the same time, rather than copying it
+                # there afterwards (not for --extract alone, which needs no
+                # disk space for the archive)
+                actions.append(stack.enter_context(
+                    cache.add(server, job.id)).write)
+            if extractor is not None:
+                actions.append(extractor.write)
+
+            def write(data: bytes) -> None:
+                for action in actions:
+                    action(data)
+
+            yield write
+    if cache is not None:
+        cache.evict()
+    if extractor is not None:
+        extractor.close()
+        info(f"Extracted {extractor.extracted} files")
+
+
+def select_job(
+    args: argparse.Namespace, web_url: str, pipeline: Any,
+    nodes: Sequence[PipelineNode], autoselect: Sequence[str] = (),
+) -> None:
+    # Sets args.job (and args.project, for jobs of downstream pipelines of
+    # other projects), or lists the jobs and exits if none could be selected
+    events = args.format == 'ndjson'
+    if events:
+        write_event(sys.stdout.buffer, 'pipeline',
+                    pipeline=pipeline.attributes)
+    jobs = [node for node in nodes if not node.bridge]
+    if args.job_name:
+        # exact names first: parallel:matrix jobs are named e.g. test: [3.10]
+        matching = [node for node in jobs if node.job.name == args.job_name]
+        if not matching:
+            matching = [node for node in jobs if fnmatch.fnmatchcase(
+                node.job.name, args.job_name)]
+        found = [node.job.id for node in matching]
+        # the last job (i.e. the last retry) of every matching name
+        latest = {(node.pipeline, node.job.name): node.job.id
+                  for node in matching}
+        if not found:
+            warn(f"Job {args.job_name} not found")
+        elif len(latest) > 1:
+            args.job = ','.join(map(str, latest.values()))
+            info(f"Found {len(latest)} matching jobs: {args.job}")
+        elif len(found) == 1:
+            args.job = found[0]
+            info(f"Job ID: {args.job}")
+        else:
+            info(f"Found multiple jobs: {' '.join(map(str, found))}")
+            if args.idx is not None:
+                args.job = found[args.idx - 1]
+                info(f"Selecting #{args.idx}: {args.job}")
+            else:
+                args.job = found[-1]
+                info(f"Selecting the last one: {args.job}")
+    else:
+        if args.debug:
+            info(json.dumps(pipeline.attributes, indent=2))
+        if args.print_url:
+            print(f"{web_url}/pipelines/{pipeline.id}")
+            sys.exit(0)
+    if not args.job and args.timings and jobs:
+        args.job = ','.join(str(node.job.id) for node in jobs)
+    if not args.job:
+        if not events:
+            print(f"Available jobs for pipeline #{pipeline.id}:")
+        for node in nodes:
+            job = node.job
+            indent = '   ' * (node.depth + 1)
+            if events:
+                write_event(sys.stdout.buffer, 'job', job=job.attributes)
+            elif node.bridge:
+                downstream = job.downstream_pipeline
+                target = (f"pipeline #{downstream['id']}" if downstream
+                          else "not triggered")
+                if not node.accessible:
+                    target += " (not accessible)"
+                print(f"{indent}{job.name} - {fmt_status(job.status)}"
+                      f" - {target}")
+            else:
+                project = f" --project={node.project}" if node.project else ""
+                print(f"{indent}--job={job.id}{project}"
+                      f" - {fmt_status(job.status)} - {job.name}")
+            if (job.status in autoselect and not node.bridge
+                    and not args.job):
+                args.job = job.id
+                job_name = job.name
+        if args.job:
+            info(f"Automatically selected --job={args.job} ({job_name})")
+        else:
+            if args.running:
+                warn("Ignoring --running because no job was running.")
+            if args.failed:
+                warn("Ignoring --failed because no job has failed.")
+            if artifacts_option(args):
+                warn(f"Ignoring {artifacts_option(args)}"
+                     " because no job was selected.")
+            if args.print_url:
+                warn("Ignoring --print-url because no job was selected.")
+            sys.exit(0)
+    select_project(args, jobs)
+
+
+def select_project(
+    args: argparse.Namespace, jobs: Sequence[PipelineNode],
+) -> None:
+    # Jobs of multi-project downstream pipelines can only be looked at
+    # via their own project, so keep only the jobs of one project
+    job_ids = set(parse_job_ids(str(args.job)))
+    selected = [node for node in jobs if int(node.job.id) in job_ids]
+    project = selected[0].project
+    if any(node.project != project for node in selected):
+        ignored = [str(node.job.id) for node in selected
+                   if node.project != project]
+        warn(f"Ignoring jobs of other projects: {', '.join(ignored)}")
+        args.job = ','.join(str(node.job.id) for node in selected
+                            if node.project == project)
+    if project is not None:
+        args.project = project
+        info(f"GitLab project: {project}")
+
+
+async def fetch_pipeline_tree_async(
+    client: AsyncGitlab, project: Any, pipeline_id: int,
+    scope: Sequence[str] = (),
+) -> List[PipelineNode]:
+    # Same as fetch_pipeline_tree(), but doesn't wait for a whole level
+    pipelines: PipelineTree = {}
+
+    async def fetch(
+        project_id: int, pipeline_id: int, downstream: bool = False,
+    ) -> None:
+        try:
+            jobs, bridges = pipelines[pipeline_id] = await asyncio.gather(
+                client.pipeline_jobs(str(project_id), pipeline_id, scope),
+                client.pipeline_bridges(str(project_id), pipeline_id))
+        except requests.exceptions.HTTPError:
+            if not downstream:
+                raise
+            pipelines[pipeline_id] = None
+            return
+        await asyncio.gather(*[
+            fetch(*ids, downstream=True)
+            for ids in downstream_pipelines(bridges)
+        ])
+
+    await fetch(project.id, pipeline_id)
+    return pipeline_tree(pipelines, pipeline_id, project.id, project.id)
+
+
+async def fetch_project_status_async(
+    client: AsyncGitlab, name: str, ref: Optional[str] = None,
+) -> 'ProjectStatus':
+    try:
+        ref = ref or (await client.project(name)).default_branch
+        if not ref:
+            # an empty repository
+            return ProjectStatus(name, ref)
+        pipelines = await client.pipelines(name, ref=ref, limit=1)
+        if not pipelines:
+            return ProjectStatus(name, ref)
+        jobs = await client.pipeline_jobs(name, pipelines[0].id)
+    except requests.exceptions.RequestException as e:
+        return ProjectStatus(name, ref, error=str(e) or type(e).__name__)
+    return ProjectStatus(name, ref, pipelines[0], jobs)
+
+
+async def fetch_traces_async(
+    client: AsyncGitlab, project: str, job_ids: List[int], workers: int = 4,
+) -> AsyncGenerator[Tuple[Any, bytes], None]:
+    # like fetch_traces()
+    tasks: Deque['asyncio.Task[Tuple[Any, bytes]]'] = collections.deque()
+    try:
+        for job_id in job_ids:
+            if len(tasks) >= workers:
+                yield await tasks.popleft()
+            tasks.append(asyncio.ensure_future(
+                client.job_with_trace(project, job_id)))
+        while tasks:
+            yield await tasks.popleft()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def fetch_project_statuses_async(
+    client: AsyncGitlab, names: Sequence[str], ref: Optional[str] = None,
+) -> AsyncGenerator[ProjectStatus, None]:
+    # like fetch_project_statuses(); the client limits the number of
+    # concurrent requests
+    for next_status in asyncio.as_completed([
+        fetch_project_status_async(client, name, ref) for name in names
+    ]):
+        yield await next_status
+
+
+async def fetch_indexed_trace_async(
+    client: AsyncGitlab, project: str, job_id: int,
+) -> Tuple[Any, IndexedTrace]:
+    job = await client.job(project, job_id)
+    trace = IndexedTrace()
+    async for chunk in stream_async(client, project, job_id):
+        trace.write(chunk)
+    trace.close()
+    return job, trace
+
+
+def describe_job(args: argparse.Namespace, job: Any) -> None:
+    if args.verbose:
+        info(f"Job created:    {job.created_at}")
+        info(f"Job started:    {job.started_at or 'not yet'}")
+        info(f"Job finished:   {job.finished_at or 'not yet'}")
+        info(f"Job duration:   {fmt_duration(job.duration)}")
+    if args.debug:
+        info(json.dumps(job.attributes, indent=2))
+    if args.format == 'ndjson':
+        write_event(sys.stdout.buffer, 'job', job=job.attributes)
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--profile", metavar="WHAT", nargs="?", const="cpu",
+        help=(
+            "profile gitlab-trace itself, for bug reports"
+            " (WHAT can be cpu, mem, or all; default: cpu)"
+        ),
+    )
+    parser.add_argument(
+        "--profile-output", metavar="FILENAME",
+        default="gitlab-trace-profile.txt",
+        help="where to save the profile (default: %(default)s)",
+    )
+
+
+def profile(
+    func: Callable[[], None], what: str = 'cpu',
+    filename: str = 'gitlab-trace-profile.txt',
+) -> None:
+    # starting Python and importing gitlab-trace happen before we get here
+    startup = time.process_time()
+    profiler = cProfile.Profile() if what in ('cpu', 'all') else None
+    if what in ('mem', 'all'):
+        tracemalloc.start()
+    try:
+        if profiler is not None:
+            profiler.runcall(func)
+        else:
+            func()
+    finally:
+        snapshot = None
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+        with open(filename, "w") as f:
+            f.write(f"gitlab-trace {__version__},"
+                    f" python-gitlab {gitlab.__version__},"
+                    f" Python {sys.version.split()[0]}\n")
+            f.write(f"Arguments: {' '.join(sys.argv[1:])}\n\n")
+            f.write(f"Startup: {startup * 1000:.0f} ms of CPU time"
+                    f" before profiling started\n\n")
+            if profiler is not None:
+                if snapshot is not None:
+                    f.write("NB: tracing memory allocations slows everything"
+                            " down; use --profile=cpu for accurate times\n\n")
+                stats = pstats.Stats(profiler, stream=f)
+                write_import_times(f, stats)
+                stats.sort_stats('cumulative').print_stats(PROFILE_TOP_N)
+            if snapshot is not None:
+                f.write(f"Peak memory usage: {fmt_size(peak)}\n")
+                f.write(f"Memory still in use at exit: {fmt_size(current)}\n")
+                f.write("Largest allocations still in use, by line:\n")
+                for entry in snapshot.statistics('lineno')[:PROFILE_TOP_N]:
+                    f.write(f"  {entry}\n")
+        info(f"Profile saved to {filename}")
+
+
+def write_import_times(f: IO[str], stats: 'pstats.Stats') -> None:
+    # like python -X importtime: the code of a module runs when it's
+    # imported, and its cumulative time includes the modules it imports
+    imports = sorted((
+        (cumulative, filename)
+        for (filename, line, name), (calls, primitive_calls, total,
+                                     cumulative, callers)
+        in stats.stats.items()  # type: ignore[attr-defined]
+        if name == '<module>'
+    ), reverse=True)
+    if not imports:
+        return
+    f.write("Modules imported while profiling, by cumulative time:\n")
+    for cumulative, filename in imports[:PROFILE_TOP_N]:
+        f.write(f"  {cumulative * 1000:8.1f} ms  {filename}\n")
+    f.write("\n")
+
+
+def add_daemon_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--daemon", action="store_true",
+        help=(
+            "keep running as a helper process that makes later gitlab-trace"
+            " commands start faster, by keeping GitLab connections open and"
+            " remembering projects and finished jobs"
+        ),
+    )
+    parser.add_argument(
+        "--socket", metavar="PATH",
+        help=(
+            "the Unix socket of the --daemon (default:"
+            " gitlab-trace-USER.sock in $XDG_RUNTIME_DIR or /tmp)"
+        ),
+    )
+    parser.add_argument(
+        "--no-daemon", action="store_true",
+        help="don't use the --daemon, even if it is running",
+    )
+
+
+def daemon_environ() -> Dict[str, str]:
+    return {
+        name: os.environ[name] for name in DAEMON_ENVIRON
+        if name in os.environ
+    }
+
+
+def user_name() -> str:
+    try:
+        return getpass.getuser()
+    except (KeyError, OSError):
+        # a uid without a passwd entry, e.g. in a container
+        return str(os.getuid())
+
+
+def daemon_socket_path() -> str:
+    directory = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(directory, f'gitlab-trace-{user_name()}.sock')
+
+
+class CachedManager:
+    """Remembers the objects returned by get() of a python-gitlab manager.
+
+    Only keeps the objects that pass the keep() test, i.e. the ones that
+    won't change any more, and never lazy ones (they have no attributes).
+    Everything else is passed to the manager.
+    """
+
+    def __init__(
+        self, manager: Any, keep: Callable[[Any], bool] = lambda obj: True,
+        prepare: Optional[Callable[[Any], None]] = None,
+    ) -> None:
+        self.manager = manager
+        self.keep = keep
+        self.prepare = prepare
+        self.objects: Dict[str, Any] = {}
+
+    def get(self, id: Union[int, str], **kwargs: Any) -> Any:
+        obj = self.objects.get(str(id))
+        if obj is None:
+            obj = self.manager.get(id, **kwargs)
+            if self.prepare is not None:
+                self.prepare(obj)
+            if self.keep(obj) and not kwargs.get('lazy'):
+                self.objects[str(id)] = obj
+        return obj
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.manager, name)
+
+
+def cache_finished_jobs(project: Project) -> None:
+    # NB: python-gitlab objects keep their managers in __dict__
+    project.__dict__['jobs'] = CachedManager(
+        project.jobs, keep=lambda job: bool(job.finished_at))
+
+
+class Daemon:
+    """The state gitlab-trace --daemon keeps between commands."""
+
+    def __init__(self) -> None:
+        self.gitlabs: Dict[Optional[str], gitlab.Gitlab] = {}
+        self.lock = threading.Lock()
+        self.environ = daemon_environ()
+
+    def gitlab(self, name: Optional[str]) -> gitlab.Gitlab:
+        with self.lock:
+            if name not in self.gitlabs:
+                gl = gitlab.Gitlab.from_config(name)
+                limiter = rate_limiter(name)
+                if limiter is not None:
+                    limiter.install(gl.session)
+                gl.projects = CachedManager(  # type: ignore[assignment]
+                    gl.projects, prepare=cache_finished_jobs)
+                self.gitlabs[name] = gl
+            return self.gitlabs[name]
+
+    def init_colorama(self, strip: Optional[bool] = None) -> None:
+        # colorama.init() would wrap sys.stdout for all the threads
+        for proxy in [sys.stdout, sys.stderr]:
+            assert isinstance(proxy, ThreadLocalStream)
+            proxy.local.stream = colorama.AnsiToWin32(
+                proxy.local.stream, strip=strip).stream
+
+
+class ThreadLocalStream:
+    """Stands in for sys.stdout/sys.stderr in the daemon.
+
+    Every thread serving a client sets its own stream, connected to that
+    client; the other threads keep using the original one.
+    """
+
+    def __init__(self, default: Any) -> None:
+        self.default = default
+        self.local = threading.local()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(getattr(self.local, 'stream', self.default), name)
+
+
+class FrameWriter(io.RawIOBase):
+    """Sends output to a daemon client, tagged with the stream it is for.
+
+    Every frame is a one-byte stream tag (b'1' for stdout, b'2' for
+    stderr, b'x' for the exit status, b'l' for "run it locally"), a
+    four-byte length, and the data.
+
+    Once the client hangs up, checking whether the stream is closed raises
+    BrokenPipeError, like a write would, so that a --follow of a job that
+    has nothing to write stops polling too.
+    """
+
+    def __init__(self, sock: socket.socket, tag: bytes, tty: bool) -> None:
+        super().__init__()
+        self.sock = sock
+        self.tag = tag
+        self.tty = tty
+        self.next_check = 0.0
+
+    @property
+    def closed(self) -> bool:
+        now = time.monotonic()
+        if now >= self.next_check and not super().closed:
+            # (not every time: BufferedWriter asks on every write)
+            self.next_check = now + CLIENT_CHECK_INTERVAL
+            try:
+                data = self.sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                data = None  # still connected, just not saying anything
+            if data == b'':
+                raise BrokenPipeError(errno.EPIPE, "the client went away")
+        return super().closed
+
+    def writable(self) -> bool:
+        return True
+
+    def isatty(self) -> bool:
+        # the client's stream, that is
+        return self.tty
+
+    def write(self, data: Any) -> int:
+        data = bytes(data)
+        self.sock.sendall(struct.pack('>cI', self.tag, len(data)) + data)
+        return len(data)
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    """Runs one gitlab-trace command for a client of the daemon."""
+
+    def __init__(self, *args: Any, daemon: Daemon, **kwargs: Any) -> None:
+        self.daemon = daemon
+        super().__init__(*args, **kwargs)
+
+    def handle(self) -> None:
+        line = self.rfile.readline()
+        if not line:
+            return  # someone checking whether the daemon is running
+        request = json.loads(line)
+        if request.get('environ') != self.daemon.environ:
+            # we'd use the wrong configuration, caches or proxies
+            FrameWriter(self.connection, b'l', False).write(b'')
+            return
+        streams = [
+            io.TextIOWrapper(
+                io.BufferedWriter(FrameWriter(self.connection, tag, tty)),
+                encoding='utf-8', errors='replace', line_buffering=tty)
+            for tag, tty in zip([b'1', b'2'], request['isatty'])
+        ]
+        for proxy, stream in zip([sys.stdout, sys.stderr], streams):
+            assert isinstance(proxy, ThreadLocalStream)
+            proxy.local.stream = stream
+        try:
+            status = run_command(request['argv'], self.daemon)
+            for stream in streams:
+                stream.flush()
+            FrameWriter(self.connection, b'x', False).write(b'%d' % status)
+        except OSError:
+            pass  # the client went away
+        finally:
+            for proxy in [sys.stdout, sys.stderr]:
+                assert isinstance(proxy, ThreadLocalStream)
+                del proxy.local.stream
+
+
+def run_command(argv: List[str], daemon: Daemon) -> int:
+    # like main(), but returns the exit status instead of exiting
+    try:
+        try:
+            _main(argv, daemon=daemon)
+        except requests.exceptions.RequestException as e:
+            sys.exit(str(e))
+        except BrokenPipeError:
+            sys.exit(0)
+        except Exception:
+            traceback.print_exc()
+            sys.exit(1)
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
+    return 0
+
+
+def serve(path: Optional[str] = None) -> None:
+    path = path or daemon_socket_path()
+    if os.path.exists(path):
+        with socket.socket(socket.AF_UNIX) as sock:
+            try:
+                sock.connect(path)
+            except OSError:
+                os.unlink(path)  # left over from a daemon that crashed
+            else:
+                fatal(f"gitlab-trace --daemon is already running on {path}")
+    # import them before there are threads: LazyLoader isn't thread-safe
+    # in older Pythons
+    for module in [asyncio, colorama, gitlab, requests, ssl, zipfile]:
+        vars(module)
+    daemon = Daemon()
+    sys.stdout = ThreadLocalStream(sys.stdout)
+    sys.stderr = ThreadLocalStream(sys.stderr)
+    umask = os.umask(0o077)  # only our own user may connect
+    try:
+        server = socketserver.ThreadingUnixStreamServer(
+            path, partial(DaemonHandler, daemon=daemon))
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+    info(f"gitlab-trace --daemon listening on {path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+def forward(path: Optional[str], argv: List[str]) -> bool:
+    """Run the command in the gitlab-trace --daemon listening on path.
+
+    Exits with the command's exit status.  Returns False if there's no
+    daemon there (or the command is better run here), and does nothing.
+    """
+    path = path or daemon_socket_path()
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        return False
+    args = make_parser().parse_args(argv)
+    if args.artifacts or args.extract or args.profile:
+        # the daemon would save files in its own working directory
+        return False
+    with socket.socket(socket.AF_UNIX) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            return False
+        # things that depend on our working directory need to happen here
+        # (and be reported once the daemon agrees to run the command)
+        options = []
+        notes = []
+        if not args.projects and not args.group:
+            project = determine_project()
+            if not project:
+                fatal("Could not determine GitLab project ID")
+            notes.append(f"GitLab project: {project}")
+            options.append(f"--project={project}")
+        if (not args.branch and not args.job and not several_projects(args)
+                and (not args.pipeline or args.pipeline < 0)):
+            args.branch = determine_branch()
+            notes.append(f"Current branch: {args.branch}")
+            options.append(f"--branch={args.branch}")
+        for option, filename in [("--output-dir", args.output_dir),
+                                 ("--stats-json", args.stats_json)]:
+            if filename:
+                options.append(f"{option}={os.path.abspath(filename)}")
+        # after a -- they'd be taken for positional arguments
+        end = argv.index('--') if '--' in argv else len(argv)
+        request = {
+            'argv': argv[:end] + options + argv[end:],
+            'isatty': [sys.stdout.isatty(), sys.stderr.isatty()],
+            'environ': daemon_environ(),
+        }
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        outputs = {b'1': sys.stdout.buffer, b'2': sys.stderr.buffer}
+        with sock.makefile('rb') as f:
+            while True:
+                header = f.read(5)
+                if len(header) < 5:
+                    fatal("Lost connection to gitlab-trace --daemon")
+                tag, size = struct.unpack('>cI', header)
+                data = f.read(size)
+                if tag == b'l':
+                    return False
+                for note in notes:
+                    info(note)
+                notes = []
+                if tag == b'x':
+                    sys.exit(int(data))
+                outputs[tag].write(data)
+                outputs[tag].flush()
+
+
+def main_here() -> None:
+    # (not in main(): looking at these except clauses imports requests and
+    # zipfile, which a client of the --daemon can do without)
+    try:
+        _main()
+    except requests.exceptions.RequestException as e:
+        sys.exit(str(e))
+    except zipfile.BadZipFile as e:
+        sys.exit(f"Bad artifacts archive: {e}")
+
+
+def main() -> None:
+    # --profile needs to be known before _main() parses the command line
+    parser = argparse.ArgumentParser(add_help=False)
+    add_profile_arguments(parser)
+    add_daemon_arguments(parser)
+    opts, _ = parser.parse_known_args()
+    try:
+        if opts.daemon:
+            serve(opts.socket)
+        elif opts.profile in PROFILE_MODES:
+            profile(main_here, opts.profile, opts.profile_output)
+        elif opts.no_daemon or not forward(opts.socket, sys.argv[1:]):
+            main_here()
     except (KeyboardInterrupt, BrokenPipeError):
         # suppress tracebacks from these
         sys.exit(0)
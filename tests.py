@@ -1,9 +1,31 @@
+import asyncio
+import datetime
+import errno
+import getpass
+import hashlib
+import http.server
+import io
+import json
+import os
+import re
+import socket
+import socketserver
+import ssl
+import struct
 import subprocess
 import sys
 import textwrap
+import threading
 import time
+import types
+import urllib.parse
+import zipfile
+from functools import partial
 
+import gitlab.exceptions
 import pytest
+import requests
+import requests.adapters
 import requests.exceptions
 
 import gitlab_trace as gt
@@ -18,32 +40,101 @@ def mock_gitlab(monkeypatch):
 def mock_time_sleep(monkeypatch):
     monkeypatch.setattr(time, 'sleep', lambda seconds: None)
 
+    async def sleep(seconds):
+        pass
+
+    monkeypatch.setattr(asyncio, 'sleep', sleep)
+
+
+@pytest.fixture(autouse=True)
+def no_daemon(monkeypatch, tmp_path):
+    # don't talk to a gitlab-trace --daemon that might be running
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path))
+
+
+@pytest.fixture(autouse=True)
+def gitlab_config(monkeypatch, tmp_path):
+    # don't use the rate limits of ~/.python-gitlab.cfg
+    path = tmp_path / 'python-gitlab.cfg'
+    monkeypatch.setenv('PYTHON_GITLAB_CFG', str(path))
+    return path
+
+
+@pytest.fixture(autouse=True)
+def artifacts_cache(monkeypatch, tmp_path):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    return tmp_path / 'cache' / 'gitlab-trace' / 'artifacts'
+
+
+def byte_range(data, range=None):
+    # (status, Content-Range, body) of a server that honors Range headers
+    if not range:
+        return 200, None, data
+    first, last = range[len('bytes='):].split('-')
+    start = int(first) if first else max(0, len(data) - int(last))
+    if start >= len(data):
+        return 416, f'bytes */{len(data)}', b''
+    return 206, f'bytes {start}-{len(data) - 1}/{len(data)}', data[start:]
+
 
 class FakeGitlabModule:
     __version__ = '0.42.frog-knows'
+    exceptions = gitlab.exceptions
 
     class Gitlab:
+        api_url = 'http://localhost/api/v4'
+        private_token = 'secret'
+        oauth_token = None
+        job_token = None
+        ssl_verify = True
+        timeout = None
+
         def __init__(self):
             self.projects = FakeGitlabModule.Projects()
+            self.groups = FakeGitlabModule.Groups()
+            self.session = requests.Session()
 
         @classmethod
         def from_config(cls, name=None):
             return cls()
 
     class Projects:
-        def get(self, project_id):
+        def get(self, project_id, lazy=False):
             if project_id == '404':
                 raise requests.exceptions.HTTPError
             return FakeGitlabModule.Project(project_id)
 
     class Project:
         def __init__(self, project_id):
+            self.id = int(project_id) if str(project_id).isdigit() else 1
             self.pipelines = FakeGitlabModule.ProjectPipelines()
             self.jobs = FakeGitlabModule.ProjectJobs()
             self.web_url = f'https://git.example.com/{project_id}'
+            self.default_branch = {
+                'owner/empty': None,
+                'owner/new': 'empty',
+            }.get(project_id, 'main')
+
+    class Groups:
+        def get(self, group_id, lazy=False):
+            return types.SimpleNamespace(
+                projects=FakeGitlabModule.GroupProjects(group_id))
+
+    class GroupProjects:
+        def __init__(self, group_id):
+            self.group_id = group_id
+
+        def list(self, iterator=False, per_page=None, include_subgroups=False,
+                 archived=None):
+            assert iterator
+            if self.group_id == 'forbidden':
+                raise gitlab.exceptions.GitlabListError('403 Forbidden')
+            for name in ['project', 'new', 'empty']:
+                yield types.SimpleNamespace(
+                    path_with_namespace=f'{self.group_id}/{name}')
 
     class ProjectPipelines:
-        def list(self, ref=None, iterator=False):
+        def list(self, ref=None, iterator=False, per_page=None):
             assert iterator
             if ref == 'empty':
                 return
@@ -53,20 +144,46 @@ class FakeGitlabModule:
                     FakeGitlabModule.ProjectPipeline(997),
                 ]
 
-        def get(self, pipeline_id):
+        def get(self, pipeline_id, lazy=False):
             return FakeGitlabModule.ProjectPipeline(pipeline_id)
 
     class ProjectPipeline:
         def __init__(self, id):
             self.id = str(id)
+            self.status = 'running' if self.id == '1009' else 'failed'
             self.jobs = FakeGitlabModule.PipelineJobs(self)
+            self.bridges = FakeGitlabModule.PipelineBridges(self)
             self.attributes = {"type": "pipeline", "json_attributes": "here"}
 
     class PipelineJobs:
         def __init__(self, project_pipeline):
             self._project_pipeline = project_pipeline
 
-        def list(self, all=False):
+        def list(self, all=False, scope=None, per_page=None):
+            return [
+                job for job in self._list()
+                if scope is None or job.status in scope
+            ]
+
+        def _list(self):
+            if self._project_pipeline.id == '2004':
+                # in a project we can't read
+                raise gitlab.exceptions.GitlabListError('403 Forbidden')
+            if self._project_pipeline.id == '2001':
+                return [
+                    FakeGitlabModule.ProjectJob(4001, 'deploy-app',
+                                                'running'),
+                    FakeGitlabModule.ProjectJob(4002, 'test', 'failed'),
+                ]
+            if self._project_pipeline.id == '2002':
+                return [
+                    FakeGitlabModule.ProjectJob(5001, 'docs', 'success'),
+                    FakeGitlabModule.ProjectJob(5002, 'linkcheck', 'failed'),
+                ]
+            if self._project_pipeline.id == '2003':
+                return [
+                    FakeGitlabModule.ProjectJob(4101, 'smoke', 'failed'),
+                ]
             if self._project_pipeline.id == '1009':
                 return [
                     FakeGitlabModule.ProjectJob(3301, 'build', 'success'),
@@ -81,12 +198,47 @@ class FakeGitlabModule:
                                                 has_artifacts=True),
                 ]
 
+    class PipelineBridges:
+        def __init__(self, project_pipeline):
+            self._project_pipeline = project_pipeline
+
+        def list(self, all=False, per_page=None):
+            Bridge = FakeGitlabModule.PipelineBridge
+            if self._project_pipeline.id == '1005':
+                return [
+                    Bridge(3205, 'deploy', 'running', 1, 2001),
+                    Bridge(3206, 'docs', 'success', 2, 2002),
+                    Bridge(3207, 'release', 'manual'),
+                ]
+            if self._project_pipeline.id == '2001':
+                return [Bridge(4003, 'nested', 'success', 1, 2003)]
+            return []
+
+    class PipelineBridge:
+        def __init__(self, id, name, status, project_id=None,
+                     pipeline_id=None):
+            self.id = id
+            self.name = name
+            self.status = status
+            self.downstream_pipeline = None
+            if pipeline_id is not None:
+                self.downstream_pipeline = {
+                    'id': pipeline_id, 'project_id': project_id,
+                    'status': status,
+                }
+            self.attributes = {"type": "bridge", "json_attributes": "here"}
+
     class ProjectJobs:
         def get(self, job_id):
             return FakeGitlabModule.ProjectJob(
-                job_id, 'build', 'success', has_artifacts=(job_id == '3202'))
+                job_id, 'build', 'success',
+                has_artifacts=(str(job_id) == '3202'))
 
     class ProjectJob:
+        default_trace = b'Hello, world!\n'
+        ranges = True  # False: the trace endpoint ignores Range headers
+        artifacts_data = b'PK\5\6' + bytes(18)  # an empty zip file
+
         def __init__(self, id, name, status, has_artifacts=False):
             self.id = id
             self.name = name
@@ -98,10 +250,10 @@ class FakeGitlabModule:
             if has_artifacts:
                 self.artifacts_file = {
                     'filename': 'artifacts.zip',
-                    'size': 0,
+                    'size': len(self.artifacts_data),
                 }
             self.attributes = {"type": "job", "json_attributes": "here"}
-            self._trace = b'Hello, world!\n'
+            self._trace = self.default_trace
             self._refresh = [
                 {},
                 {
@@ -112,15 +264,43 @@ class FakeGitlabModule:
             ]
 
         def artifacts(self, streamed=False, action=None):
-            pass
+            for i in range(0, len(self.artifacts_data), 100):
+                action(self.artifacts_data[i:i + 100])
 
         def refresh(self):
             if self._refresh:
                 self.__dict__.update(self._refresh.pop(0))
 
-        def trace(self):
+        def trace(self, streamed=False, iterator=False, chunk_size=1024):
+            if iterator:
+                return (self._trace[i:i + chunk_size]
+                        for i in range(0, len(self._trace), chunk_size))
             return self._trace
 
+        @property
+        def encoded_id(self):
+            return self.id
+
+        @property
+        def manager(self):
+            return types.SimpleNamespace(
+                path='/projects/1/jobs',
+                gitlab=types.SimpleNamespace(http_get=self._http_get))
+
+        def _http_get(self, path, raw=False, extra_headers=None):
+            assert path == f'/projects/1/jobs/{self.id}/trace'
+            range = (extra_headers or {}).get('Range') if self.ranges else None
+            status, content_range, body = byte_range(self._trace, range)
+            if status == 416:
+                raise gitlab.exceptions.GitlabHttpError(
+                    '416 Range Not Satisfiable', response_code=416)
+            response = requests.Response()
+            response.status_code = status
+            response._content = body
+            if content_range:
+                response.headers['Content-Range'] = content_range
+            return response
+
 
 def test_fatal():
     with pytest.raises(SystemExit):
@@ -174,6 +354,22 @@ def test_determine_branch(monkeypatch):
     assert gt.determine_branch() == 'fix-bugs'
 
 
+@pytest.mark.parametrize('spec, expected', [
+    ('42', [42]),
+    ('42,45', [42, 45]),
+    ('42-45', [42, 43, 44, 45]),
+    ('1, 42-43,7', [1, 42, 43, 7]),
+])
+def test_parse_job_ids(spec, expected):
+    assert gt.parse_job_ids(spec) == expected
+
+
+@pytest.mark.parametrize('spec', ['', 'foo', '45-42', '1-2-3'])
+def test_parse_job_ids_errors(spec):
+    with pytest.raises(ValueError):
+        gt.parse_job_ids(spec)
+
+
 @pytest.mark.parametrize('status, expected', [
     ('success', '\033[32msuccess\033[0m'),
     ('skipped', 'skipped'),
@@ -261,6 +457,535 @@ def test_follow_truncation_flushes(monkeypatch, capsys):
     """)
 
 
+def test_trace_cursor_tail(monkeypatch):
+    monkeypatch.setattr(gt, 'TAIL_CHUNK_SIZE', 4)
+    data = b'one\ntwo\nthree\nfour\n'
+    cursor = gt.TraceCursor(tail=2)
+    ranges, output = [], None
+    while output is None:
+        ranges.append(cursor.range())
+        output = cursor.update(*byte_range(data, ranges[-1]))
+    assert ranges == ['bytes=-4', 'bytes=-16']
+    assert output == b'three\nfour\n'
+    assert cursor.range() == 'bytes=18-'
+    assert cursor.update(*byte_range(data, cursor.range())) == b''
+    data += b'five\n'
+    assert cursor.update(*byte_range(data, cursor.range())) == b'five\n'
+
+
+def test_trace_cursor_tail_short_log():
+    data = b'one\ntwo\n'
+    cursor = gt.TraceCursor(tail=10)
+    assert cursor.update(*byte_range(data, cursor.range())) == data
+
+
+def test_trace_cursor_empty_log():
+    cursor = gt.TraceCursor(tail=10)
+    assert cursor.update(*byte_range(b'', cursor.range())) == b''
+    assert cursor.range() == 'bytes=0-'
+    assert cursor.update(*byte_range(b'', cursor.range())) == b''
+    assert cursor.update(*byte_range(b'hi\n', cursor.range())) == b'hi\n'
+
+
+@pytest.mark.parametrize('new_data', [b'Bye, world!\n', b'Bye\n'])
+def test_trace_cursor_truncated(capsys, new_data):
+    cursor = gt.TraceCursor()
+    assert cursor.update(*byte_range(b'Hello\n', cursor.range())) == (
+        b'Hello\n')
+    assert cursor.update(*byte_range(new_data, cursor.range())) is None
+    assert cursor.range() == 'bytes=0-'
+    assert cursor.update(*byte_range(new_data, cursor.range())) == new_data
+    assert capsys.readouterr().err == '\n----- trace was truncated -----\n'
+
+
+def test_trace_cursor_ranges_ignored():
+    cursor = gt.TraceCursor(tail=1)
+    assert cursor.update(206, 'bytes 0-5/6', b'Hello\n') == b'Hello\n'
+    # e.g. a redirect to a server that doesn't do ranges
+    assert cursor.update(200, None, b'Hello\nBye\n') == b'Bye\n'
+    assert cursor.range() is None
+    assert cursor.update(200, None, b'Hello\nBye\n') == b''
+
+
+def test_follow_tail_ranges_ignored(monkeypatch):
+    monkeypatch.setattr(FakeGitlabModule.ProjectJob, 'ranges', False)
+    job = FakeGitlabModule.ProjectJob(42, 'job', 'running')
+    job._trace = b'one\ntwo\n'
+    output = io.BytesIO()
+    gt.follow(job, buffer=output, tail=1)
+    assert output.getvalue() == b'two\nHello, world!\nBye!\n'
+
+
+def test_trace_range_error():
+    job = FakeGitlabModule.ProjectJob(42, 'job', 'running')
+
+    def http_get(path, raw=False, extra_headers=None):
+        raise gitlab.exceptions.GitlabHttpError('404 Not Found',
+                                                response_code=404)
+
+    job._http_get = http_get
+    with pytest.raises(gitlab.exceptions.GitlabHttpError):
+        gt.trace_range(job, 'bytes=0-')
+
+
+def grep(data, pattern, chunk_size=3, **kw):
+    buffer = io.BytesIO()
+    g = gt.Grep(buffer, re.compile(pattern), **kw)
+    for i in range(0, len(data), chunk_size):
+        g.write(data[i:i + chunk_size])
+    g.close()
+    return buffer.getvalue().decode()
+
+
+def test_grep():
+    assert grep(b'foo\nbar\nbaz\nqux', b'ba') == 'bar\nbaz\n'
+
+
+def test_grep_last_line_without_newline():
+    assert grep(b'foo\nbar\nbaz\nqux', b'q') == 'qux'
+
+
+def test_grep_long_chunks():
+    assert grep(b'foo\nbar\nbaz\nqux\n', b'ux', chunk_size=100) == 'qux\n'
+
+
+def test_grep_context():
+    data = b''.join(b'line %d\n' % n for n in range(1, 11))
+    assert grep(data, b'[37]$', before=1, after=1) == textwrap.dedent("""\
+        line 2
+        line 3
+        line 4
+        --
+        line 6
+        line 7
+        line 8
+    """)
+    assert grep(data, b'[34]$', before=2) == textwrap.dedent("""\
+        line 1
+        line 2
+        line 3
+        line 4
+    """)
+
+
+def test_grep_max_count():
+    data = b''.join(b'line %d\n' % n for n in range(1, 11))
+    assert grep(data, b'[2-9]$', max_count=2, after=1) == textwrap.dedent("""\
+        line 2
+        line 3
+        line 4
+    """)
+
+
+def test_tail_filter():
+    buffer = io.BytesIO()
+    f = gt.Tail(buffer, 2)
+    f.write(b'one\ntwo\nth')
+    f.write(b'ree\nfour')
+    assert buffer.getvalue() == b''
+    f.close()
+    assert buffer.getvalue() == b'three\nfour'
+
+
+SECTIONED_TRACE = (
+    b'\033[0KRunning with gitlab-runner 17.0.0\033[0;m\n'
+    b'section_start:1000:prepare_script\r\033[0K'
+    b'\033[0K\033[36;1mPreparing environment\033[0;m\n'
+    b'Running on runner-42...\n'
+    b'section_end:1003:prepare_script\r\033[0K\n'
+    b'section_start:1003:step_script[collapsed=true]\r\033[0K'
+    b'\033[0K\033[36;1mExecuting "step_script" stage\033[0;m\n'
+    b'$ make test\n'
+    b'section_start:1004:nested\r\033[0K\n'
+    b'\033[31mFAIL\033[0m\n'
+    b'section_end:1010:nested\r\033[0K\n'
+    b'section_end:1065:step_script\r\033[0K\n'
+    b'\033[31;1mERROR: Job failed: exit code 1\033[0;m\n'
+)
+
+
+def trace_filter(data, chunk_size=5, **kw):
+    buffer = io.BytesIO()
+    sections = []
+    f = gt.TraceFilter(
+        buffer, on_section_end=lambda *a: sections.append(a), **kw)
+    for i in range(0, len(data), chunk_size):
+        f.write(data[i:i + chunk_size])
+    f.close()
+    return buffer.getvalue().decode(), sections
+
+
+def test_trace_filter_passthrough():
+    output, sections = trace_filter(SECTIONED_TRACE)
+    assert output == SECTIONED_TRACE.decode()
+    assert sections == [
+        ('prepare_script', 3),
+        ('nested', 6),
+        ('step_script', 62),
+    ]
+
+
+def test_trace_filter_strip_ansi():
+    output, sections = trace_filter(SECTIONED_TRACE, strip_ansi=True)
+    assert output == textwrap.dedent("""\
+        Running with gitlab-runner 17.0.0
+        Preparing environment
+        Running on runner-42...
+        Executing "step_script" stage
+        $ make test
+        FAIL
+        ERROR: Job failed: exit code 1
+    """)
+
+
+def test_trace_filter_select_sections():
+    output, sections = trace_filter(
+        SECTIONED_TRACE, strip_ansi=True, sections=['step_script'])
+    assert output == textwrap.dedent("""\
+        Executing "step_script" stage
+        $ make test
+        FAIL
+    """)
+
+
+def test_trace_filter_collapse():
+    output, sections = trace_filter(
+        SECTIONED_TRACE, strip_ansi=True, collapse=True)
+    assert output == textwrap.dedent("""\
+        Running with gitlab-runner 17.0.0
+        Preparing environment
+        Executing "step_script" stage
+        ERROR: Job failed: exit code 1
+    """)
+
+
+def test_trace_filter_unbalanced_sections():
+    output, sections = trace_filter(
+        b'section_start:1:a\r\033[0K\n'
+        b'section_end:2:b\r\033[0K\n'
+        b'section_end:5:a\r\033[0K\n'
+    )
+    assert sections == [('a', 4)]
+
+
+def test_section_timings():
+    assert gt.section_timings(SECTIONED_TRACE) == [
+        ('prepare_script', 3),
+        ('nested', 6),
+        ('step_script', 62),
+    ]
+
+
+@pytest.mark.parametrize('url, expected', [
+    ('https://git.example.com/api/v4/projects/group%2Fproject',
+     'GET /api/v4/projects/:id'),
+    ('https://git.example.com/api/v4/projects/42/jobs/3202/trace?x=1',
+     'GET /api/v4/projects/:id/jobs/:id/trace'),
+])
+def test_api_endpoint(url, expected):
+    assert gt.api_endpoint('GET', url) == expected
+
+
+@pytest.mark.parametrize('p, expected', [
+    (0.5, 3),
+    (0.95, 5),
+    (1, 5),
+])
+def test_percentile(p, expected):
+    assert gt.percentile([5, 1, 4, 2, 3], p) == expected
+
+
+def make_response(url, status=200, elapsed=0.01, body=b''):
+    response = requests.Response()
+    response.request = requests.Request('GET', url).prepare()
+    response.status_code = status
+    response.elapsed = datetime.timedelta(seconds=elapsed)
+    response.raw = io.BytesIO(body)
+    response.raw.read()
+    return response
+
+
+def test_stats(capsys):
+    stats = gt.Stats()
+    session = requests.Session()
+    stats.install(session)
+    url = 'https://git.example.com/api/v4/projects/1/jobs/'
+    for response in [
+        make_response(url + '42', body=b'{}'),
+        make_response(url + '43', elapsed=0.1, body=b'{}'),
+        make_response(url + '44', status=404),
+        make_response(url + '42/trace', body=b'Hello, world!\n'),
+    ]:
+        for hook in session.hooks['response']:
+            hook(response)
+    stats.slept = 61
+    stats.report()
+    assert capsys.readouterr().err == textwrap.dedent("""\
+        API calls: 4, received 18 B, sent 0 B
+          GET /api/v4/projects/:id/jobs/:id: 3 (p50 10 ms, p95 100 ms; 200 x2, 404 x1; received 4 B)
+          GET /api/v4/projects/:id/jobs/:id/trace: 1 (p50 10 ms, p95 10 ms; 200 x1; received 14 B)
+        Waited for new data: 1m 1s
+    """)  # noqa: E501
+
+
+def test_rate_limiter(monkeypatch, tmp_path):
+    now = 100.0
+    monkeypatch.setattr(time, 'time', lambda: now)
+    limiter = gt.RateLimiter(str(tmp_path / 'bucket'), rate=2, burst=2)
+    assert [limiter.reserve() for n in range(4)] == [0, 0, 0.5, 1]
+    now = 101.5  # 3 more tokens, two of them already promised
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == 0.5
+    now = 50  # clocks can go backwards
+    assert limiter.reserve() == 1
+
+
+def test_rate_limiter_shared(monkeypatch, tmp_path):
+    monkeypatch.setattr(time, 'time', lambda: 100.0)
+    one = gt.RateLimiter(str(tmp_path / 'bucket'), rate=1, burst=1)
+    two = gt.RateLimiter(str(tmp_path / 'bucket'), rate=1, burst=1)
+    assert [one.reserve(), two.reserve(), one.reserve()] == [0, 1, 2]
+
+
+def test_rate_limiter_symlink(capsys, tmp_path):
+    (tmp_path / 'precious').write_bytes(b'precious')
+    (tmp_path / 'bucket').symlink_to(tmp_path / 'precious')
+    limiter = gt.RateLimiter(str(tmp_path / 'bucket'), rate=1, burst=1)
+    assert [limiter.reserve() for n in range(3)] == [0, 0, 0]
+    assert (tmp_path / 'precious').read_bytes() == b'precious'
+    assert capsys.readouterr().err.startswith(
+        f"Ignoring rate_limit: cannot open {tmp_path}/bucket: ")
+
+
+def test_rate_limiter_not_ours(monkeypatch, capsys, tmp_path):
+    # e.g. someone else created it in /tmp, full of negative tokens
+    (tmp_path / 'bucket').write_bytes(gt.RateLimiter.STATE.pack(-1e9, 0))
+    monkeypatch.setattr(os, 'getuid', lambda: os.stat(tmp_path).st_uid + 1)
+    limiter = gt.RateLimiter(str(tmp_path / 'bucket'), rate=1, burst=1)
+    assert [limiter.reserve() for n in range(3)] == [0, 0, 0]
+    assert capsys.readouterr().err == (
+        f"Ignoring rate_limit: {tmp_path}/bucket is not our own file\n")
+
+
+@pytest.mark.parametrize('rate, burst', [(0, 1), (1, 0.5)])
+def test_rate_limiter_bad_limits(rate, burst):
+    with pytest.raises(ValueError):
+        gt.RateLimiter('bucket', rate=rate, burst=burst)
+
+
+def test_rate_limiter_install(monkeypatch, tmp_path):
+    sleeps = []
+    monkeypatch.setattr(time, 'sleep', sleeps.append)
+
+    class Adapter(requests.adapters.BaseAdapter):
+        closed = False
+
+        def send(self, request, **kwargs):
+            return make_response(request.url, body=b'{}')
+
+        def close(self):
+            self.closed = True
+
+    session = requests.Session()
+    adapter = Adapter()
+    session.adapters.clear()
+    session.mount('https://', adapter)
+    limiter = gt.RateLimiter(str(tmp_path / 'bucket'), rate=1, burst=1)
+    limiter.install(session)
+    session.get('https://git.example.com/api/v4/projects/1')
+    session.get('https://git.example.com/api/v4/projects/1')
+    assert len(sleeps) == 2
+    assert sleeps[0] == 0
+    assert sleeps[1] > 0.9
+    session.close()
+    assert adapter.closed
+
+
+@pytest.mark.parametrize('config, gitlab_id, rate, burst', [
+    ('', None, None, None),
+    ('[global]\ndefault = main\n', None, None, None),
+    ('[main]\nrate_limit = 5\n', 'other', None, None),
+    ('[main]\nurl = https://a.example.com\n', 'main', None, None),
+    ('[main]\nrate_limit = 5\n', 'main', 5, 5),
+    ('[main]\nrate_limit = 0.5\n', 'main', 0.5, 1),
+    ('[main]\nrate_limit = 5\nrate_limit_burst = 20\n', 'main', 5, 20),
+    ('[global]\ndefault = main\nrate_limit = 2\nrate_limit_burst = 3\n'
+     '[main]\nurl = https://a.example.com\n', None, 2, 3),
+    ('[global]\nrate_limit = 2\n[main]\nrate_limit = 3\n', 'main', 3, 3),
+])
+def test_rate_limiter_config(tmp_path, gitlab_config, config, gitlab_id,
+                             rate, burst):
+    gitlab_config.write_text(config)
+    limiter = gt.rate_limiter(gitlab_id)
+    if rate is None:
+        assert limiter is None
+    else:
+        assert (limiter.rate, limiter.burst) == (rate, burst)
+
+
+def test_rate_limiter_config_per_server(tmp_path, gitlab_config):
+    gitlab_config.write_text(textwrap.dedent("""\
+        [global]
+        rate_limit = 5
+
+        [a]
+        url = https://a.example.com
+
+        [b]
+        url = https://b.example.com
+
+        [a-again]
+        url = https://a.example.com/
+    """))
+    user = getpass.getuser()
+    assert gt.rate_limiter('a').path == (
+        f'{tmp_path}/gitlab-trace-{user}-a.example.com.ratelimit')
+    assert gt.rate_limiter('b').path == (
+        f'{tmp_path}/gitlab-trace-{user}-b.example.com.ratelimit')
+    assert gt.rate_limiter('a-again').path == gt.rate_limiter('a').path
+
+
+@pytest.mark.parametrize('config, message', [
+    ('[main]\nrate_limit = lots\n',
+     "could not convert string to float: 'lots'"),
+    ('[main]\nrate_limit = -1\n',
+     "rate_limit must be positive and rate_limit_burst at least 1"),
+])
+def test_rate_limiter_bad_config(gitlab_config, config, message):
+    gitlab_config.write_text(config)
+    with pytest.raises(SystemExit) as e:
+        gt.rate_limiter('main')
+    assert str(e.value) == (
+        f"Bad rate limit in [main] of ~/.python-gitlab.cfg: {message}")
+
+
+def test_main_rate_limit(monkeypatch, capsys, tmp_path, gitlab_config):
+    gitlab_config.write_text('[global]\nrate_limit = 10\n[main]\n')
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '-p', 'owner/project', '-g', 'main', '--job=3202'])
+    gitlabs = []
+
+    def from_config(name=None):
+        gitlabs.append(FakeGitlabModule.Gitlab())
+        return gitlabs[-1]
+
+    monkeypatch.setattr(FakeGitlabModule.Gitlab, 'from_config', from_config)
+    with pytest.raises(SystemExit):
+        gt.main()
+    assert all(isinstance(adapter, gt.RateLimitedAdapter)
+               for adapter in gitlabs[0].session.adapters.values())
+
+
+def test_bytes_read():
+    assert gt.bytes_read(None) == 0
+
+
+def test_follow_grep_stops_early(capsys):
+    job = FakeGitlabModule.ProjectJob(42, 'job', 'running')
+    output = gt.Grep(sys.stdout.buffer, re.compile(b'world'), max_count=1)
+    gt.follow(job, buffer=output)
+    assert output.closed
+    assert job._refresh  # we didn't wait for the job to finish
+    assert capsys.readouterr().out == 'Hello, world!\n'
+
+
+class RecordingBuffer(io.BytesIO):
+    def __init__(self):
+        super().__init__()
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(bytes(data))
+        return super().write(data)
+
+
+def test_coalesce(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    buffer = RecordingBuffer()
+    output = gt.Coalesce(buffer, max_delay=5)
+    for data in [b'Hello', b', world!\nHow are', b' you?\n', b'Bye']:
+        now[0] += 1
+        output.write(data)
+        output.flush()
+    assert buffer.writes == []
+    # five seconds after the first byte
+    now[0] += 2
+    output.write(b'!\n')
+    output.flush()
+    assert buffer.writes == [b'Hello, world!\nHow are you?\nBye!\n']
+    output.write(b'Bye, then')
+    output.close()
+    assert output.closed
+    assert buffer.writes[-1] == b'Bye, then'
+
+
+def test_coalesce_backlog(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    buffer = RecordingBuffer()
+    output = gt.Coalesce(buffer, max_delay=5)
+    output.write(b'Hello, world!\n')
+    output.flush()
+    assert buffer.writes == [b'Hello, world!\n']
+    now[0] += 1
+    output.write(b'How are you?\n')
+    output.flush()
+    assert buffer.writes == [b'Hello, world!\n']
+    # nothing new, but it's been waiting long enough
+    now[0] += 5
+    output.flush()
+    assert buffer.writes == [b'Hello, world!\n', b'How are you?\n']
+
+
+def test_follow_coalesce_quiet_job(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(time, 'sleep',
+                        lambda seconds: now.__setitem__(0, now[0] + seconds))
+    job = FakeGitlabModule.ProjectJob(42, 'job', 'running')
+    job._refresh = [
+        {'_trace': b'Hello, world!\nBye?\n'},
+        {},
+        {},
+        {'finished_at': '2020-09-16T06:16:57.452Z'},
+    ]
+    buffer = RecordingBuffer()
+    gt.follow(job, buffer=gt.Coalesce(buffer, max_delay=2))
+    # the job went quiet after Bye?, which still got written out in time
+    assert buffer.writes == [b'Hello, world!\n', b'Bye?\n']
+
+
+def test_coalesce_max_size():
+    buffer = RecordingBuffer()
+    output = gt.Coalesce(buffer, max_delay=5, max_size=10)
+    output.write(b'Hello, world!\nHow are you?')
+    assert buffer.writes == [b'Hello, world!\n']
+
+
+def test_coalesce_interactive():
+    buffer = RecordingBuffer()
+    output = gt.Coalesce(buffer, max_delay=5, interactive=True)
+    output.write(b'Hello,')
+    output.flush()
+    output.write(b' world!\nBye')
+    output.flush()
+    output.close()
+    assert buffer.writes == [b'Hello,', b' world!\nBye']
+
+
+def test_prefix_shared_buffer():
+    buffer = gt.Coalesce(RecordingBuffer())
+    one = gt.Prefix(buffer, b'[one] ')
+    two = gt.Prefix(buffer, b'[two] ')
+    one.write(b'Hello')
+    two.write(b'Hi\nthere')
+    one.close()
+    two.close()
+    buffer.close()
+    assert buffer.buffer.getvalue() == b'[two] Hi\n[one] Hello\n[two] there\n'
+
+
 def test_main_help(monkeypatch):
     monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--help'])
     with pytest.raises(SystemExit):
@@ -269,7 +994,8 @@ def test_main_help(monkeypatch):
 
 def test_main_warn_extra_args(monkeypatch, capsys):
     monkeypatch.setattr(
-        sys, 'argv', ['gitlab-trace', '--running', '--job=123', '456']
+        sys, 'argv',
+        ['gitlab-trace', '--running', '--failed', '--job=123', '456']
     )
     monkeypatch.setattr(gt, 'determine_project', lambda: None)
     with pytest.raises(SystemExit):
@@ -279,6 +1005,10 @@ def test_main_warn_extra_args(monkeypatch, capsys):
         'Ignoring --running because --job=123 was specified'
         in stderr
     )
+    assert (
+        'Ignoring --failed because --job=123 was specified'
+        in stderr
+    )
     assert (
         'Ignoring pipeline (456) because --job=123 was specified'
         in stderr
@@ -403,8 +1133,6 @@ def test_main_no_running_job(monkeypatch, capsys):
     """)
     assert stdout == textwrap.dedent("""\
         Available jobs for pipeline #1005:
-           --job=3201 - success - build
-           --job=3202 - failed - test
     """)
 
 
@@ -555,14 +1283,85 @@ def test_main_running(monkeypatch, capsys):
     """)
     assert stdout == textwrap.dedent("""\
         Available jobs for pipeline #1009:
-           --job=3301 - success - build
+           --job=3304 - running - test
+        Hello, world!
+    """)
+
+
+def test_main_job_by_name_running(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '1009', 'build', '--running'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stderr == textwrap.dedent("""\
+        GitLab project: owner/project
+        Job ID: 3301
+    """)
+    assert stdout == 'Hello, world!\n'
+
+
+def test_main_failed(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '1009', '--failed'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stderr == textwrap.dedent("""\
+        GitLab project: owner/project
+        Automatically selected --job=3302 (test)
+    """)
+    assert stdout == textwrap.dedent("""\
+        Available jobs for pipeline #1009:
            --job=3302 - failed - test
            --job=3303 - failed - test
-           --job=3304 - running - test
         Hello, world!
     """)
 
 
+def test_main_no_failed_job(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '1009', '--failed', '--status=success'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    monkeypatch.setattr(
+        FakeGitlabModule.PipelineJobs, '_list', lambda self: [
+            FakeGitlabModule.ProjectJob(3301, 'build', 'success'),
+        ])
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stderr == textwrap.dedent("""\
+        GitLab project: owner/project
+        Ignoring --failed because no job has failed.
+    """)
+    assert stdout == textwrap.dedent("""\
+        Available jobs for pipeline #1009:
+           --job=3301 - success - build
+    """)
+
+
+def test_main_status(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '1009', '--status=success,running'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stdout == textwrap.dedent("""\
+        Available jobs for pipeline #1009:
+           --job=3301 - success - build
+           --job=3304 - running - test
+    """)
+
+
+def test_main_bad_status(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--status=broken'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    with pytest.raises(SystemExit, match='Unknown job status: broken'):
+        gt.main()
+
+
 def test_main_branch_ignored_because_job(monkeypatch, capsys):
     monkeypatch.setattr(sys, 'argv', [
         'gitlab-trace', '--job=3202', '--branch=foo'])
@@ -674,7 +1473,7 @@ def test_main_job_artefacts(monkeypatch, capsys, tmp_path):
     stdout, stderr = capsys.readouterr()
     assert stderr == textwrap.dedent("""\
         GitLab project: owner/project
-        Artifacts: artifacts.zip (0 B)
+        Artifacts: artifacts.zip (22 B)
     """)
     assert stdout == textwrap.dedent("""\
         Hello, world!
@@ -698,18 +1497,2404 @@ def test_main_job_artefacts_nope(monkeypatch, capsys, tmp_path):
     """)
 
 
-def raise_keyboard_interrupt(*args, **kw):
-    raise KeyboardInterrupt()
+class UnseekableBuffer(io.RawIOBase):
+    def __init__(self):
+        self.data = bytearray()
 
+    def writable(self):
+        return True
 
-def test_main_suppresses_keyboard_interrupt(monkeypatch, capsys):
-    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--job=3202'])
-    monkeypatch.setattr(gt, 'determine_project', raise_keyboard_interrupt)
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+
+def make_zip(files, stream=False, **kwargs):
+    # stream=True makes zipfile use data descriptors, like gitlab-runner
+    f = UnseekableBuffer() if stream else io.BytesIO()
+    with zipfile.ZipFile(f, 'w', **kwargs) as archive:
+        for name, data in files.items():
+            if stream:
+                with archive.open(name, 'w') as output:
+                    output.write(data)
+            else:
+                archive.writestr(name, data)
+    return bytes(f.data) if stream else f.getvalue()
+
+
+def extract(tmp_path, archive, chunk_size=7, **kwargs):
+    extractor = gt.ZipExtractor(str(tmp_path / 'out'), **kwargs)
+    for i in range(0, len(archive), chunk_size):
+        extractor.write(archive[i:i + chunk_size])
+    extractor.close()
+    return extractor
+
+
+def extracted_files(path):
+    return {
+        str(file.relative_to(path)): file.read_bytes()
+        for file in sorted(path.rglob('*')) if file.is_file()
+    }
+
+
+FILES = {
+    'hello.txt': b'Hello, world!\n' * 100,
+    'reports/junit.xml': b'<testsuites/>\n',
+    '../../escape.txt': b'nope\n',
+    '/abs.txt': b'nope\n',
+}
+EXTRACTED = {
+    'hello.txt': b'Hello, world!\n' * 100,
+    'reports/junit.xml': b'<testsuites/>\n',
+    'escape.txt': b'nope\n',
+    'abs.txt': b'nope\n',
+}
+
+
+@pytest.mark.parametrize('kwargs', [
+    dict(compression=zipfile.ZIP_DEFLATED),
+    dict(compression=zipfile.ZIP_STORED),
+    dict(compression=zipfile.ZIP_DEFLATED, stream=True),
+])
+def test_zip_extractor(tmp_path, kwargs):
+    extractor = extract(tmp_path, make_zip(FILES, **kwargs))
+    assert extractor.spool is None
+    assert extractor.extracted == 4
+    assert extracted_files(tmp_path / 'out') == EXTRACTED
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_zip_extractor_zip64(tmp_path, stream):
+    f = UnseekableBuffer() if stream else io.BytesIO()
+    with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as archive:
+        with archive.open('big.txt', 'w', force_zip64=True) as output:
+            output.write(b'not really\n')
+        with archive.open(zipfile.ZipInfo('empty/'), 'w'):
+            pass  # stored, with a data descriptor when streaming
+    archive = bytes(f.data) if stream else f.getvalue()
+    extractor = extract(tmp_path, archive)
+    assert extractor.spool is None
+    assert extracted_files(tmp_path / 'out') == {'big.txt': b'not really\n'}
+    assert (tmp_path / 'out' / 'empty').is_dir()
+
+
+def test_zip_extractor_patterns(tmp_path):
+    extractor = extract(tmp_path, make_zip(FILES, stream=True),
+                        patterns=['*.xml', 'hello*'])
+    assert extractor.extracted == 2
+    assert extracted_files(tmp_path / 'out') == {
+        'hello.txt': b'Hello, world!\n' * 100,
+        'reports/junit.xml': b'<testsuites/>\n',
+    }
+
+
+def test_zip_extractor_fallback(tmp_path):
+    # entries compressed with something other than deflate can't be
+    # extracted from the stream
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr('a.txt', b'a')
+        archive.writestr('b.txt', b'b', zipfile.ZIP_BZIP2)
+        archive.writestr('dir/', b'')
+        archive.writestr('c.txt', b'c')
+        archive.writestr('d.log', b'd')
+    extractor = extract(tmp_path, buffer.getvalue(),
+                        patterns=['*.txt', 'dir/'])
+    assert extractor.spool is not None
+    assert extractor.extracted == 3
+    assert extracted_files(tmp_path / 'out') == {
+        'a.txt': b'a', 'b.txt': b'b', 'c.txt': b'c'}
+    assert (tmp_path / 'out' / 'dir').is_dir()
+
+
+def test_zip_extractor_fallback_stored(tmp_path):
+    # stored entries with data descriptors: we can't tell where they end
+    archive = make_zip({'a.txt': b'a', 'b.txt': b'b'}, stream=True,
+                       compression=zipfile.ZIP_STORED)
+    extractor = extract(tmp_path, archive)
+    assert extractor.spool is not None
+    assert extracted_files(tmp_path / 'out') == {'a.txt': b'a', 'b.txt': b'b'}
+
+
+def test_zip_extractor_not_a_zip(tmp_path):
+    with pytest.raises(zipfile.BadZipFile):
+        extract(tmp_path, b'This is not a zip file, honest!')
+
+
+def test_zip_extractor_truncated(tmp_path):
+    archive = make_zip(FILES, compression=zipfile.ZIP_STORED)
+    with pytest.raises(zipfile.BadZipFile, match='Truncated zip archive'):
+        extract(tmp_path, archive[:100])
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_zip_extractor_bad_crc(tmp_path, stream):
+    if stream:
+        archive = make_zip({'a.txt': b'hello'}, stream=True,
+                           compression=zipfile.ZIP_DEFLATED)
+        i = archive.index(b'PK\7\x08') + 4  # the CRC in the data descriptor
+        archive = archive[:i] + b'\xff' + archive[i + 1:]
+    else:
+        archive = make_zip({'a.txt': b'hello'},
+                           compression=zipfile.ZIP_STORED)
+        archive = archive.replace(b'hello', b'jello')
+    with pytest.raises(zipfile.BadZipFile, match="Bad CRC-32 for file"):
+        extract(tmp_path, archive)
+
+
+def test_zip_extractor_bad_data(tmp_path):
+    archive = make_zip({'a.txt': b'hello' * 100},
+                       compression=zipfile.ZIP_DEFLATED)
+    header = 30 + len('a.txt')
+    archive = archive[:header] + b'\xff' * 10 + archive[header + 10:]
+    with pytest.raises(zipfile.BadZipFile, match="Bad data for file"):
+        extract(tmp_path, archive)
+
+
+def test_zip_extractor_bad_data_descriptor(tmp_path):
+    archive = make_zip({'a.txt': b'hello'}, stream=True,
+                       compression=zipfile.ZIP_DEFLATED)
+    i = archive.index(b'PK\7\x08')
+    archive = archive[:i + 8] + b'\xff' + archive[i + 9:]
+    with pytest.raises(zipfile.BadZipFile, match="Bad data descriptor"):
+        extract(tmp_path, archive)
+
+
+def test_main_extract(monkeypatch, capsys, tmp_path):
+    monkeypatch.setattr(FakeGitlabModule.ProjectJob, 'artifacts_data',
+                        make_zip(FILES, stream=True))
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '-p', 'owner/project', '--job=3202', '--tail=1',
+        f'--extract={tmp_path}/out', '--extract-only=*.txt'])
     with pytest.raises(SystemExit):
         gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stderr == textwrap.dedent(f"""\
+        Extracting artifacts.zip (1.9 KiB) into {tmp_path}/out
+        Extracted 3 files
+    """)
+    assert sorted(extracted_files(tmp_path / 'out')) == [
+        'abs.txt', 'escape.txt', 'hello.txt']
 
 
-def test_main_reports_network_issues_without_tracebacks(monkeypatch, capsys):
-    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--project=404'])
+def test_main_extract_and_save(monkeypatch, capsys, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    archive = make_zip(FILES)
+    monkeypatch.setattr(FakeGitlabModule.ProjectJob, 'artifacts_data',
+                        archive)
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '-p', 'owner/project', '--job=3202', '--tail=1',
+        '--extract=out', '-a'])
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stderr == textwrap.dedent("""\
+        Artifacts: artifacts.zip (1.8 KiB)
+        Extracting artifacts.zip (1.8 KiB) into out
+        Extracted 4 files
+    """)
+    assert (tmp_path / 'artifacts.zip').read_bytes() == archive
+    assert extracted_files(tmp_path / 'out') == EXTRACTED
+
+
+def test_main_extract_bad_zip(monkeypatch, capsys, tmp_path):
+    monkeypatch.setattr(FakeGitlabModule.ProjectJob, 'artifacts_data',
+                        b'<html>Sign in</html>')
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '-p', 'owner/project', '--job=3202',
+        f'--extract={tmp_path}'])
+    with pytest.raises(SystemExit,
+                       match='Bad artifacts archive: Truncated zip archive'):
+        gt.main()
+
+
+def test_main_extract_only_without_extract(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '-p', 'owner/project', '--job=3202',
+        '--extract-only=*.xml'])
+    with pytest.raises(SystemExit):
+        gt.main()
+    assert capsys.readouterr().err == (
+        "Ignoring --extract-only because --extract wasn't specified\n")
+
+
+def test_artifacts_cache(tmp_path):
+    cache = gt.ArtifactsCache(str(tmp_path), max_size=100)
+    server = 'https://git.example.com/api/v4'
+    assert cache.get(server, 1, 5) is None
+    with cache.add(server, 1) as download:
+        download.write(b'hel')
+        download.write(b'lo')
+    assert download.path == str(
+        tmp_path / 'blobs' / hashlib.sha256(b'hello').hexdigest())
+    assert cache.get(server, 1, 5) == download.path
+    assert cache.get(server, 1, 6) is None
+    assert cache.get('https://gitlab.example.com/api/v4', 1, 5) is None
+    assert (tmp_path / 'jobs' / 'git.example.com' / '1.json').exists()
+
+
+def test_artifacts_cache_same_artifacts(tmp_path):
+    cache = gt.ArtifactsCache(str(tmp_path), max_size=100)
+    for job_id in 1, 2:
+        with cache.add('http://localhost', job_id) as download:
+            download.write(b'hello')
+    assert cache.get('http://localhost', 1, 5) == download.path
+    assert cache.get('http://localhost', 2, 5) == download.path
+    assert os.listdir(tmp_path / 'blobs') == [os.path.basename(download.path)]
+    assert os.listdir(tmp_path / 'tmp') == []
+
+
+def test_artifacts_cache_failed_download(tmp_path):
+    cache = gt.ArtifactsCache(str(tmp_path), max_size=100)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        with cache.add('http://localhost', 1) as download:
+            download.write(b'hel')
+            raise requests.exceptions.ConnectionError()
+    assert download.path is None
+    assert os.listdir(tmp_path / 'tmp') == []
+    assert not (tmp_path / 'blobs').exists()
+
+
+def test_artifacts_cache_changed(tmp_path):
+    cache = gt.ArtifactsCache(str(tmp_path), max_size=100)
+    for job_id in 1, 2:
+        with cache.add('http://localhost', job_id) as download:
+            download.write(b'hello')
+    # someone changes it
+    path = download.path
+    os.chmod(path, 0o644)
+    with open(path, 'r+b') as f:
+        f.write(b'HELLO')
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+    assert cache.get('http://localhost', 1, 5) is None
+    assert cache.get('http://localhost', 2, 5) is None
+    with cache.add('http://localhost', 1) as download:
+        download.write(b'hello')
+    assert cache.get('http://localhost', 1, 5) == path
+    assert open(path, 'rb').read() == b'hello'
+
+
+@pytest.mark.parametrize('entry', [
+    '{"sha256": "../../etc/passwd"}',
+    '{"sha256": 42}',
+    '{}',
+    '[]',
+    'garbage',
+])
+def test_artifacts_cache_bad_entry(tmp_path, entry):
+    cache = gt.ArtifactsCache(str(tmp_path), max_size=100)
+    path = tmp_path / 'jobs' / 'localhost' / '1.json'
+    path.parent.mkdir(parents=True)
+    path.write_text(entry)
+    assert cache.get('http://localhost', 1, 5) is None
+
+
+def test_artifacts_cache_evict(tmp_path):
+    cache = gt.ArtifactsCache(str(tmp_path), max_size=10)
+    cache.evict()  # nothing to evict yet
+    for job_id, data in enumerate([b'1111', b'2222', b'3333'], 1):
+        with cache.add('http://localhost', job_id) as download:
+            download.write(data)
+        # last used job_id seconds after the epoch
+        os.utime(download.path,
+                 ns=(job_id * 10**9, os.stat(download.path).st_mtime_ns))
+    assert cache.get('http://localhost', 1, 4) is not None  # recently used
+    cache.evict()
+    assert cache.get('http://localhost', 1, 4) is not None
+    assert cache.get('http://localhost', 2, 4) is None
+    assert cache.get('http://localhost', 3, 4) is not None
+    cache.max_size = 0
+    cache.evict()
+    assert os.listdir(tmp_path / 'blobs') == []
+
+
+def test_copy_file_clone(monkeypatch, tmp_path):
+    clones = []
+    monkeypatch.setattr(gt.fcntl, 'ioctl', lambda *args: clones.append(args))
+    (tmp_path / 'a').write_bytes(b'hello')
+    gt.copy_file(str(tmp_path / 'a'), str(tmp_path / 'b'))
+    assert len(clones) == 1
+    assert not os.path.samefile(tmp_path / 'a', tmp_path / 'b')
+
+
+def test_copy_file_copy(monkeypatch, tmp_path):
+    def ioctl(*args):
+        raise OSError(errno.EOPNOTSUPP, 'Operation not supported')
+
+    monkeypatch.setattr(gt.fcntl, 'ioctl', ioctl)
+    (tmp_path / 'a').write_bytes(b'hello')
+    (tmp_path / 'a').chmod(0o444)
+    gt.copy_file(str(tmp_path / 'a'), str(tmp_path / 'b'))
+    assert not os.path.samefile(tmp_path / 'a', tmp_path / 'b')
+    assert (tmp_path / 'b').read_bytes() == b'hello'
+    assert (tmp_path / 'b').stat().st_mode & 0o200
+
+
+def test_main_artifacts_cached(monkeypatch, capsys, tmp_path,
+                               artifacts_cache):
+    archive = make_zip(FILES)
+    monkeypatch.setattr(FakeGitlabModule.ProjectJob, 'artifacts_data',
+                        archive)
+    argv = ['gitlab-trace', '-p', 'owner/project', '--job=3202', '--tail=1',
+            '-a', '--extract=out']
+    for where in 'first', 'second':
+        (tmp_path / where).mkdir()
+        monkeypatch.chdir(tmp_path / where)
+        monkeypatch.setattr(sys, 'argv', argv)
+        with pytest.raises(SystemExit):
+            gt.main()
+        # the second time around the artifacts come from the cache
+        monkeypatch.setattr(FakeGitlabModule.ProjectJob, 'artifacts', None)
+    stdout, stderr = capsys.readouterr()
+    assert stderr == textwrap.dedent("""\
+        Artifacts: artifacts.zip (1.8 KiB)
+        Extracting artifacts.zip (1.8 KiB) into out
+        Extracted 4 files
+        Artifacts: artifacts.zip (1.8 KiB, cached)
+        Extracting artifacts.zip (1.8 KiB, cached) into out
+        Extracted 4 files
+    """)
+    [blob] = os.listdir(artifacts_cache / 'blobs')
+    for where in 'first', 'second':
+        path = tmp_path / where / 'artifacts.zip'
+        assert path.read_bytes() == archive
+        # a file of the user's own, not a link to the cache
+        assert path.stat().st_mode & 0o200
+        assert not os.path.samefile(path, artifacts_cache / 'blobs' / blob)
+        assert extracted_files(tmp_path / where / 'out') == EXTRACTED
+
+
+def test_main_artifacts_no_cache(monkeypatch, capsys, tmp_path,
+                                 artifacts_cache):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '-p', 'owner/project', '--job=3202', '--tail=1',
+        '-a', '--cache-size=0'])
+    with pytest.raises(SystemExit):
+        gt.main()
+    assert (tmp_path / 'artifacts.zip').read_bytes() == b'PK\5\6' + bytes(18)
+    assert not artifacts_cache.exists()
+
+
+def test_main_artifacts_too_big_for_cache(monkeypatch, capsys, tmp_path,
+                                          artifacts_cache):
+    monkeypatch.setattr(FakeGitlabModule.ProjectJob, 'artifacts_data',
+                        bytes(1024**2 + 1))
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '-p', 'owner/project', '--job=3202', '--tail=1',
+        '-a', '--cache-size=1'])
+    with pytest.raises(SystemExit):
+        gt.main()
+    assert (tmp_path / 'artifacts.zip').stat().st_size == 1024**2 + 1
+    assert not artifacts_cache.exists()
+
+
+def test_main_artifacts_already_exist(monkeypatch, capsys, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'artifacts.zip').write_bytes(b'precious')
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '-p', 'owner/project', '--job=3202', '--tail=1',
+        '-a'])
+    with pytest.raises(SystemExit, match='artifacts.zip already exists'):
+        gt.main()
+    assert (tmp_path / 'artifacts.zip').read_bytes() == b'precious'
+
+
+def test_main_recursive(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '-p', 'owner/project', '--recursive'])
+    monkeypatch.setattr(gt, 'determine_branch', lambda: 'main')
     with pytest.raises(SystemExit):
         gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stdout == textwrap.dedent("""\
+        Available jobs for pipeline #1005:
+           --job=3201 - success - build
+           --job=3202 - failed - test
+           deploy - running - pipeline #2001
+              --job=4001 - running - deploy-app
+              --job=4002 - failed - test
+              nested - success - pipeline #2003
+                 --job=4101 - failed - smoke
+           docs - success - pipeline #2002
+              --job=5001 --project=2 - success - docs
+              --job=5002 --project=2 - failed - linkcheck
+           release - manual - not triggered
+    """)
+
+
+def secret_downstream_pipeline(monkeypatch):
+    # a bridge to a pipeline of a project we can't read
+    list_bridges = FakeGitlabModule.PipelineBridges.list
+
+    def list(self, all=False, per_page=None):
+        bridges = list_bridges(self, all=all, per_page=per_page)
+        if self._project_pipeline.id == '1005':
+            bridges.append(FakeGitlabModule.PipelineBridge(
+                3208, 'secret', 'success', 3, 2004))
+        return bridges
+
+    monkeypatch.setattr(FakeGitlabModule.PipelineBridges, 'list', list)
+
+
+def test_main_recursive_not_accessible(monkeypatch, capsys):
+    secret_downstream_pipeline(monkeypatch)
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '-p', 'owner/project', '--recursive', '1005',
+        '--status=failed'])
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stdout.endswith(
+        '   release - manual - not triggered\n'
+        '   secret - success - pipeline #2004 (not accessible)\n')
+
+
+def test_main_recursive_root_not_accessible(monkeypatch):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '-p', 'owner/project', '--recursive', '2004'])
+    with pytest.raises(gitlab.exceptions.GitlabListError):
+        gt.main()
+
+
+def test_main_recursive_running(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '-p', 'owner/project', '-r', '--running', '1005'])
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stdout == textwrap.dedent("""\
+        Available jobs for pipeline #1005:
+           deploy - running - pipeline #2001
+              --job=4001 - running - deploy-app
+              nested - success - pipeline #2003
+           docs - success - pipeline #2002
+           release - manual - not triggered
+        Hello, world!
+    """)
+    assert stderr == textwrap.dedent("""\
+        Automatically selected --job=4001 (deploy-app)
+    """)
+
+
+def test_main_recursive_job_name(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '-p', 'owner/project', '-r', '1005', 'test',
+        '--print-url'])
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stderr == textwrap.dedent("""\
+        Found 2 matching jobs: 3202,4002
+    """)
+    assert stdout == textwrap.dedent("""\
+        https://git.example.com/owner/project/-/jobs/3202
+        https://git.example.com/owner/project/-/jobs/4002
+    """)
+
+
+def test_main_recursive_other_project(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '-p', 'owner/project', '-r', '1005', 'linkcheck',
+        '--print-url'])
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stderr == textwrap.dedent("""\
+        Job ID: 5002
+        GitLab project: 2
+    """)
+    assert stdout == textwrap.dedent("""\
+        https://git.example.com/2/-/jobs/5002
+    """)
+
+
+def test_main_recursive_several_projects(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '-p', 'owner/project', '-r', '1005', '*',
+        '--print-url'])
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stderr == textwrap.dedent("""\
+        Found 7 matching jobs: 3201,3202,4001,4002,4101,5001,5002
+        Ignoring jobs of other projects: 5001, 5002
+    """)
+    assert stdout == textwrap.dedent("""\
+        https://git.example.com/owner/project/-/jobs/3201
+        https://git.example.com/owner/project/-/jobs/3202
+        https://git.example.com/owner/project/-/jobs/4001
+        https://git.example.com/owner/project/-/jobs/4002
+        https://git.example.com/owner/project/-/jobs/4101
+    """)
+
+
+def test_main_recursive_with_job(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '-p', 'owner/project', '-r', '--job=3202',
+        '--print-url'])
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stderr == textwrap.dedent("""\
+        Ignoring --recursive because --job=3202 was specified
+    """)
+
+
+def test_main_invalid_job_list(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--job=3202-'])
+    with pytest.raises(SystemExit, match='Invalid job ID list: 3202-'):
+        gt.main()
+
+
+def test_main_job_list(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '--job=3201,3202', '-f', '-a'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stderr == textwrap.dedent("""\
+        GitLab project: owner/project
+        Ignoring --follow because several jobs were selected.
+        Ignoring --artifacts because several jobs were selected.
+    """)
+    assert stdout == textwrap.dedent("""\
+        ==> job 3201 (build) <==
+        Hello, world!
+        ==> job 3202 (build) <==
+        Hello, world!
+    """)
+
+
+def test_main_job_list_print_url(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '--job=3201-3202', '--print-url'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stdout == textwrap.dedent("""\
+        https://git.example.com/owner/project/-/jobs/3201
+        https://git.example.com/owner/project/-/jobs/3202
+    """)
+
+
+def test_fetch_traces_runs_few_ahead():
+    fetched = []
+
+    def get(job_id):
+        fetched.append(job_id)
+        return FakeGitlabModule.ProjectJob(job_id, 'build', 'success')
+
+    project = types.SimpleNamespace(jobs=types.SimpleNamespace(get=get))
+    traces = gt.fetch_traces(project, [1, 2, 3, 4, 5], workers=2)
+    job, trace = next(traces)
+    assert job.id == 1
+    assert set(fetched) <= {1, 2}
+    assert [job.id for job, trace in traces] == [2, 3, 4, 5]
+
+
+def test_main_job_list_output_dir(monkeypatch, capsys, tmp_path):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '--job=3201,3202', f'--output-dir={tmp_path}'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stderr == textwrap.dedent(f"""\
+        GitLab project: owner/project
+        Job 3201 (build): {tmp_path}/3201.log
+        Job 3202 (build): {tmp_path}/3202.log
+    """)
+    assert stdout == ''
+    assert (tmp_path / '3201.log').read_bytes() == b'Hello, world!\n'
+
+
+def test_main_job_by_name_pattern(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '1009', '*'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stderr == textwrap.dedent("""\
+        GitLab project: owner/project
+        Found 2 matching jobs: 3301,3304
+    """)
+    assert stdout == textwrap.dedent("""\
+        ==> job 3301 (build) <==
+        Hello, world!
+        ==> job 3304 (build) <==
+        Hello, world!
+    """)
+
+
+def test_main_job_by_name_matrix(monkeypatch, capsys):
+    # parallel:matrix job names look like patterns, but aren't
+    monkeypatch.setattr(
+        FakeGitlabModule.PipelineJobs, '_list', lambda self: [
+            FakeGitlabModule.ProjectJob(3201, 'test: [3.10]', 'success'),
+            FakeGitlabModule.ProjectJob(3202, 'test: [3.11]', 'failed'),
+        ])
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '1005', 'test: [3.10]'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stderr == textwrap.dedent("""\
+        GitLab project: owner/project
+        Job ID: 3201
+    """)
+
+
+def test_main_grep(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '--job=3202', '--grep=wor', '-C', '1'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stdout == 'Hello, world!\n'
+
+
+def test_main_grep_max_count(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '--job=3202', '--grep=o', '-m1'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    monkeypatch.setattr(gt, 'CHUNK_SIZE', 1)
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stdout == 'Hello, world!\n'
+
+
+def test_main_grep_no_match(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '--job=3202', '--grep=^world', '--tail'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stdout == ''
+
+
+def test_main_grep_follow(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '--job=3202', '--grep=Bye', '--follow'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stdout == 'Bye!\n'
+
+
+def test_main_grep_batch(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '--job=3201,3202', '--grep=Bye'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stdout == textwrap.dedent("""\
+        ==> job 3201 (build) <==
+        ==> job 3202 (build) <==
+    """)
+
+
+def test_main_grep_bad_pattern(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--grep=(oops'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    with pytest.raises(SystemExit, match='Invalid --grep pattern: '):
+        gt.main()
+
+
+@pytest.mark.parametrize('option', ['-A', '-B', '-C'])
+def test_main_grep_negative_context(monkeypatch, option):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '--grep=o', option, '-1'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    with pytest.raises(SystemExit, match=f"{option} can't be negative: -1"):
+        gt.main()
+
+
+def test_main_section(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '--job=3202', '--section=nested'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    monkeypatch.setattr(FakeGitlabModule.ProjectJob, 'default_trace',
+                        SECTIONED_TRACE)
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stdout == 'FAIL\n'
+    assert stderr == textwrap.dedent("""\
+        GitLab project: owner/project
+        Section nested took 6s
+    """)
+
+
+def test_main_color_always(monkeypatch, capsysbinary):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '--job=3202', '--color=always'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    monkeypatch.setattr(FakeGitlabModule.ProjectJob, 'default_trace',
+                        SECTIONED_TRACE)
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsysbinary.readouterr()
+    assert stdout == SECTIONED_TRACE
+
+
+def test_main_color_never(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '--job=3202', '--color=never', '--tail=1'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    monkeypatch.setattr(FakeGitlabModule.ProjectJob, 'default_trace',
+                        SECTIONED_TRACE)
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stdout == 'ERROR: Job failed: exit code 1\n'
+
+
+def test_main_tail_counts_shown_lines(monkeypatch, capsys):
+    # the log ends with lines that have nothing but section markers
+    trace = SECTIONED_TRACE[:SECTIONED_TRACE.index(b'\033[31;1mERROR')]
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '--job=3202', '--color=never', '--tail=2'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    monkeypatch.setattr(FakeGitlabModule.ProjectJob, 'default_trace', trace)
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stdout == '$ make test\nFAIL\n'
+
+
+def test_main_timings(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--job=3202',
+                                      '--timings'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    monkeypatch.setattr(FakeGitlabModule.ProjectJob, 'default_trace',
+                        SECTIONED_TRACE)
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stdout == (
+        "     1m 2s  step_script (--job=3202 - build)\n"
+        "        6s  nested (--job=3202 - build)\n"
+        "        3s  prepare_script (--job=3202 - build)\n"
+    )
+
+
+def test_main_timings_pipeline_json(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '1005',
+                                      '--timings=json', '--status=failed'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    monkeypatch.setattr(FakeGitlabModule.ProjectJob, 'default_trace',
+                        b'section_start:1:a\r\033[0K\n'
+                        b'section_end:5:a\r\033[0K\n')
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stdout == textwrap.dedent("""\
+        [
+          {
+            "job_id": 3202,
+            "job_name": "build",
+            "section": "a",
+            "duration": 4
+          }
+        ]
+    """)
+
+
+def test_main_history(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--history=5'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    monkeypatch.setattr(gt, 'determine_branch', lambda: 'main')
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stderr == textwrap.dedent("""\
+        GitLab project: owner/project
+        Current branch: main
+    """)
+    assert stdout == textwrap.dedent("""\
+               #1005        #997         failed
+        build  success 42s  success 42s  0/2
+        test   failed 42s   failed 42s   2/2
+    """)
+
+
+def test_main_history_status(monkeypatch, capsys):
+    list_jobs = FakeGitlabModule.PipelineJobs._list
+
+    def _list(self):
+        jobs = list_jobs(self)
+        if self._project_pipeline.id == '997':
+            jobs[1].status = 'success'
+        return jobs
+
+    monkeypatch.setattr(FakeGitlabModule.PipelineJobs, '_list', _list)
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--history=5',
+                                      '--status=failed', '-b', 'main'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    with pytest.raises(SystemExit):
+        gt.main()
+    # the passing runs count too
+    assert capsys.readouterr().out == textwrap.dedent("""\
+              #1005       #997         failed
+        test  failed 42s  success 42s  1/2
+    """)
+
+
+def test_print_history(capsys):
+    job = FakeGitlabModule.ProjectJob
+    running = job(3303, 'test', 'running')
+    running.duration = None
+    gt.print_history([
+        (FakeGitlabModule.ProjectPipeline(1009), [
+            job(3301, 'build', 'failed'),
+            job(3302, 'build', 'success'),
+            running,
+        ]),
+        (FakeGitlabModule.ProjectPipeline(1008), [
+            job(3201, 'build', 'canceled'),
+        ]),
+    ])
+    stdout = re.sub(r'\033\[\d*m', '', capsys.readouterr().out)
+    assert stdout == textwrap.dedent("""\
+               #1009        #1008         failed
+        build  success 42s  canceled 42s  0/2
+        test   running      -             0/1
+    """)
+
+
+@pytest.mark.parametrize('n', ['0', '-2'])
+def test_main_history_not_positive(monkeypatch, n):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', f'--history={n}'])
+    with pytest.raises(SystemExit, match=f'--history must be at least 1: {n}'):
+        gt.main()
+
+
+def test_main_history_no_pipelines(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--history=5',
+                                      '-b', 'empty'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    with pytest.raises(SystemExit,
+                       match="Project owner/project doesn't have any pipelines"
+                             " for branch empty"):
+        gt.main()
+
+
+@pytest.mark.parametrize('arg, expected', [
+    ('--job=3202', 'Ignoring --history because --job=3202 was specified'),
+    ('1005', 'Ignoring --history because pipeline (1005) was specified'),
+])
+def test_main_history_ignored(monkeypatch, capsys, arg, expected):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--history=5', arg])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    with pytest.raises(SystemExit):
+        gt.main()
+    assert expected in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('line, expected', [
+    (b'Hello, world!\n', b'Hello, world!'),
+    (b'\033[32;1mJob succeeded\033[0;m\n', b'Job succeeded'),
+    (b'section_end:1010:nested\r\033[0K\n', b''),
+    (b'Started at 2024-01-02T03:04:05.678Z\n', b'Started at #'),
+    (b'[12:34:56] Ran 42 tests in 1.5s\n', b'[#] Ran 42 tests in #'),
+    (b'Took 3 minutes, 250 ms\n', b'Took #, #'),
+])
+def test_normalize(line, expected):
+    assert gt.normalize(line) == expected
+
+
+def indexed_trace(data):
+    trace = gt.IndexedTrace()
+    trace.write(data)
+    trace.close()
+    return trace
+
+
+def test_indexed_trace():
+    trace = indexed_trace(b'a\rb\nc\n\nd')
+    assert trace.lines(0, 4) == [b'a\rb\n', b'c\n', b'\n', b'd']
+    assert trace.lines(1, 3) == [b'c\n', b'\n']
+    assert len(trace.hashes) == 4
+
+
+def test_print_diff(capsysbinary):
+    job = FakeGitlabModule.ProjectJob
+    a = ''.join(f'line {n}\n' for n in range(1, 21))
+    b = a.replace('line 2\n', 'line two\n').replace('line 15\n', '')
+    output = gt.TraceFilter(sys.stdout.buffer, strip_ansi=True)
+    gt.print_diff((job(3201, 'test', 'failed'), indexed_trace(a.encode())),
+                  (job(3202, 'test', 'success'), indexed_trace(b.encode())),
+                  output, context=1)
+    assert output.closed
+    stdout, stderr = capsysbinary.readouterr()
+    assert stdout.decode() == textwrap.dedent("""\
+        --- job 3201 (test)
+        +++ job 3202 (test)
+        @@ -1,3 +1,3 @@
+         line 1
+        -line 2
+        +line two
+         line 3
+        @@ -14,3 +14,2 @@
+         line 14
+        -line 15
+         line 16
+    """)
+
+
+def test_print_diff_same(capsysbinary):
+    job = FakeGitlabModule.ProjectJob
+    gt.print_diff((job(3201, 'test', 'failed'),
+                   indexed_trace(b'Took 5s\nat 10:20:30\n')),
+                  (job(3202, 'test', 'success'),
+                   indexed_trace(b'Took 7s\nat 10:21:02\n')),
+                  sys.stdout.buffer)
+    stdout, stderr = capsysbinary.readouterr()
+    assert stdout == b''
+    assert stderr == (b'Jobs 3201 and 3202 have the same trace'
+                      b' (ignoring timestamps and durations)\n')
+
+
+def diff_traces(monkeypatch):
+    traces = {
+        '3201': b'Running tests\nTook 5s\nOK\n',
+        '3202': b'Running tests\nTook 7s\nFAIL\n',
+    }
+    get = FakeGitlabModule.ProjectJobs.get
+
+    def get_job(self, job_id):
+        job = get(self, job_id)
+        job._trace = traces[str(job_id)]
+        return job
+
+    monkeypatch.setattr(FakeGitlabModule.ProjectJobs, 'get', get_job)
+
+
+def test_main_diff(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--diff', '3201', '3202',
+                                      '-C', '0'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    diff_traces(monkeypatch)
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stdout == textwrap.dedent("""\
+        --- job 3201 (build)
+        +++ job 3202 (build)
+        @@ -3,1 +3,1 @@
+        -OK
+        +FAIL
+    """)
+
+
+@pytest.mark.parametrize('arg, expected', [
+    ('--job=3202', 'Ignoring --job=3202 because --diff was specified'),
+    ('1005', 'Ignoring pipeline (1005) because --diff was specified'),
+    ('--history=5', 'Ignoring --history because --diff was specified'),
+])
+def test_main_diff_ignores(monkeypatch, capsys, arg, expected):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--diff', '3201', '3201',
+                                      arg])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stdout == ''
+    assert expected in stderr
+    assert 'Jobs 3201 and 3201 have the same trace' in stderr
+
+
+def test_main_group(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--group=owner',
+                                      '-p', '404', '-p', 'owner/new'])
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stderr == ''
+    assert sorted(stdout.splitlines()) == [
+        '404            error: HTTPError',
+        'owner/empty    -         no pipelines for None',
+        'owner/new      -         no pipelines for empty',
+        'owner/project  failed    #1005 (main)  failed: test',
+    ]
+
+
+def test_main_several_projects(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '-p', 'owner/a',
+                                      '-p', 'owner/new', '--failed'])
+    with pytest.raises(SystemExit):
+        gt.main()
+    assert capsys.readouterr().out == (
+        'owner/a    failed    #1005 (main)  failed: test\n'
+    )
+
+
+def test_main_group_not_found(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--group=forbidden'])
+    with pytest.raises(gitlab.exceptions.GitlabListError):
+        gt.main()
+
+
+def test_main_group_with_job(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--group=owner',
+                                      '--job=3202'])
+    with pytest.raises(SystemExit,
+                       match="--group and several --project options can't"):
+        gt.main()
+
+
+def test_print_project_status(capsys):
+    job = FakeGitlabModule.ProjectJob
+    status = gt.ProjectStatus(
+        'owner/project', 'main', FakeGitlabModule.ProjectPipeline(1009), [
+            job(3301, 'build', 'success'),
+            job(3302, 'lint', 'failed'),
+            job(3303, 'test', 'failed'),
+            job(3304, 'test', 'running'),
+            job(3305, 'docs', 'failed'),
+            job(3306, 'deploy', 'pending'),
+        ])
+    gt.print_project_status(status, width=15)
+    gt.print_project_status(status, width=15, scope=['failed'])
+    stdout = re.sub(r'\033\[\d*m', '', capsys.readouterr().out)
+    assert stdout == (
+        'owner/project    running   #1009 (main)  failed: lint, docs'
+        '  running: test  pending: deploy\n'
+    )
+
+
+def test_trace_events():
+    buffer = RecordingBuffer()
+    output = gt.TraceEvents(buffer, 3202, max_size=8)
+    data = 'Hello, \N{EARTH GLOBE EUROPE-AFRICA}\n'.encode()
+    output.write(data[:9])
+    output.write(data[9:])
+    output.flush()
+    output.flush()
+    output.write(b'\xe2')
+    output.close()
+    assert output.closed
+    assert [json.loads(line) for line in b''.join(buffer.writes).splitlines()
+            ] == [
+        {'event': 'trace', 'job': 3202, 'data': 'Hello, '},
+        {'event': 'trace', 'job': 3202,
+         'data': '\N{EARTH GLOBE EUROPE-AFRICA}\n'},
+        {'event': 'trace', 'job': 3202, 'data': '\N{REPLACEMENT CHARACTER}'},
+    ]
+
+
+def events(stdout):
+    return [json.loads(line) for line in stdout.splitlines()]
+
+
+JOB = {'type': 'job', 'json_attributes': 'here'}
+PIPELINE = {'type': 'pipeline', 'json_attributes': 'here'}
+
+
+def test_main_ndjson_list_jobs(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--format=ndjson',
+                                      '-p', 'owner/project', '-b', 'main'])
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert events(stdout) == [
+        {'event': 'pipeline', 'pipeline': PIPELINE},
+        {'event': 'job', 'job': JOB},
+        {'event': 'job', 'job': JOB},
+    ]
+
+
+def test_main_ndjson_failed(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--format=ndjson',
+                                      '-p', 'owner/project', '-b', 'main',
+                                      '--failed', '--grep=world'])
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert events(stdout) == [
+        {'event': 'pipeline', 'pipeline': PIPELINE},
+        {'event': 'job', 'job': JOB},
+        {'event': 'job', 'job': JOB},
+        {'event': 'trace', 'job': 3202, 'data': 'Hello, world!\n'},
+        {'event': 'trace_end', 'job': 3202, 'status': 'success'},
+    ]
+
+
+@pytest.mark.parametrize('args', [[], ['--tail=1']])
+def test_main_ndjson_follow(monkeypatch, capsys, args):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--format=ndjson',
+                                      '-p', 'owner/project', '--job=3202',
+                                      '--follow', *args])
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert events(stdout) == [
+        {'event': 'job', 'job': JOB},
+        {'event': 'trace', 'job': 3202, 'data': 'Hello, world!\n'},
+        {'event': 'trace', 'job': 3202, 'data': 'Bye!\n'},
+        {'event': 'trace_end', 'job': 3202, 'status': 'success'},
+    ]
+
+
+def test_main_ndjson_tail(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--format=ndjson',
+                                      '-p', 'owner/project', '--job=3202',
+                                      '--tail=1'])
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert events(stdout) == [
+        {'event': 'job', 'job': JOB},
+        {'event': 'trace', 'job': 3202, 'data': 'Hello, world!\n'},
+        {'event': 'trace_end', 'job': 3202, 'status': 'success'},
+    ]
+
+
+def test_main_ndjson_several_jobs(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--format=ndjson',
+                                      '-p', 'owner/project',
+                                      '--job=3201,3202'])
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert events(stdout) == [
+        {'event': 'job', 'job': JOB},
+        {'event': 'trace', 'job': 3201, 'data': 'Hello, world!\n'},
+        {'event': 'trace_end', 'job': 3201, 'status': 'success'},
+        {'event': 'job', 'job': JOB},
+        {'event': 'trace', 'job': 3202, 'data': 'Hello, world!\n'},
+        {'event': 'trace_end', 'job': 3202, 'status': 'success'},
+    ]
+
+
+def test_main_ndjson_group(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--format=ndjson',
+                                      '--group=owner', '-p', '404',
+                                      '--failed'])
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert sorted(events(stdout), key=lambda e: e['project']) == [
+        {'event': 'project', 'project': '404', 'ref': None,
+         'pipeline': None, 'jobs': [], 'error': 'HTTPError'},
+        {'event': 'project', 'project': 'owner/project', 'ref': 'main',
+         'pipeline': PIPELINE, 'jobs': [JOB, JOB], 'error': None},
+    ]
+
+
+@pytest.mark.parametrize('option, args', [
+    ('--print-url', ['--print-url']),
+    ('--timings', ['--timings']),
+    ('--history', ['--history=5']),
+    ('--diff', ['--diff', '3201', '3202']),
+])
+def test_main_ndjson_incompatible(monkeypatch, capsys, option, args):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--format=ndjson',
+                                      '-p', 'owner/project', *args])
+    with pytest.raises(SystemExit,
+                       match=f"--format=ndjson can't be combined with"
+                             f" {option}"):
+        gt.main()
+
+
+def test_main_stats(monkeypatch, capsys, tmp_path):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '--job=3202', '-f', '--stats',
+        f'--stats-json={tmp_path}/stats.json'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stderr == textwrap.dedent("""\
+        GitLab project: owner/project
+        API calls: 0, received 0 B, sent 0 B
+        Waited for new data: 2s
+    """)
+    with open(tmp_path / 'stats.json') as f:
+        assert json.load(f) == {
+            'requests': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+            'sleep': 2.0,
+            'endpoints': {},
+        }
+
+
+@pytest.mark.parametrize('what, expected, unexpected', [
+    ('', 'Ordered by: cumulative time', 'Peak memory usage: '),
+    ('=cpu', 'Ordered by: cumulative time', 'Peak memory usage: '),
+    ('=mem', 'Peak memory usage: ', 'Ordered by: cumulative time'),
+    ('=all', 'use --profile=cpu for accurate times', None),
+])
+def test_main_profile(monkeypatch, capsys, tmp_path, what, expected,
+                      unexpected):
+    filename = tmp_path / 'profile.txt'
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '--job=3202', f'--profile{what}',
+        f'--profile-output={filename}'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stderr == textwrap.dedent(f"""\
+        GitLab project: owner/project
+        Profile saved to {filename}
+    """)
+    report = filename.read_text()
+    assert 'ms of CPU time before profiling started' in report
+    assert expected in report
+    if unexpected:
+        assert unexpected not in report
+
+
+def test_profile_imports(monkeypatch, capsys, tmp_path):
+    (tmp_path / 'gt_profile_test_module.py').write_text('x = 42\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.delitem(sys.modules, 'gt_profile_test_module', raising=False)
+    filename = tmp_path / 'profile.txt'
+    gt.profile(lambda: __import__('gt_profile_test_module'),
+               filename=str(filename))
+    report = filename.read_text()
+    assert 'Modules imported while profiling, by cumulative time:' in report
+    assert str(tmp_path / 'gt_profile_test_module.py') in report
+
+
+def test_main_profile_bad_mode(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--profile', '1234'])
+    with pytest.raises(SystemExit, match='Unknown --profile mode: 1234'):
+        gt.main()
+
+
+def raise_keyboard_interrupt(*args, **kw):
+    raise KeyboardInterrupt()
+
+
+def test_main_suppresses_keyboard_interrupt(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--job=3202'])
+    monkeypatch.setattr(gt, 'determine_project', raise_keyboard_interrupt)
+    with pytest.raises(SystemExit):
+        gt.main()
+
+
+def test_main_reports_network_issues_without_tracebacks(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--project=404'])
+    with pytest.raises(SystemExit):
+        gt.main()
+
+
+class FakeGitlabServer(http.server.ThreadingHTTPServer):
+    """Serves the data of FakeGitlabModule over HTTP, for AsyncGitlab."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeGitlabHandler)
+        self.api_url = f'http://127.0.0.1:{self.server_port}/api/v4'
+        self.jobs = {}
+        self.seen = set()
+        self.requests = []
+
+    def handle_error(self, request, client_address):
+        # AsyncGitlab closes connections it won't read to the end, and
+        # the traceback would end up in the output of a later test
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeGitlabHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body=b'', headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        if not any(name.lower() == 'connection' for name, value in headers):
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data, headers=()):
+        self.send(200, json.dumps(data).encode(), headers)
+
+    def send_chunked(self, data, chunk_size=5):
+        self.send_response(200)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i in range(0, len(data), chunk_size):
+            chunk = data[i:i + chunk_size]
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        self.wfile.write(b'0\r\nX-Trailer: yes\r\n\r\n')
+
+    def get_job(self, job_id, refresh=False):
+        jobs = self.server.jobs
+        if job_id not in jobs:
+            jobs[job_id] = FakeGitlabModule.ProjectJobs().get(job_id)
+        elif refresh:
+            jobs[job_id].refresh()
+        return jobs[job_id]
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        path = url.path.removeprefix('/api/v4/')
+        if path == 'loop':
+            self.send(302, headers=[('Location', '/api/v4/loop')])
+        elif path == 'teapot':
+            self.send(418)
+        elif path == 'short':
+            self.send_response(200)
+            self.send_header('Content-Length', '10')
+            self.end_headers()
+            self.wfile.write(b'{}\n')
+            self.close_connection = True
+        elif path == 'hangup':
+            self.close_connection = True
+        elif path.startswith('stall'):
+            # stop responding (until the client hangs up) after the status
+            # line, the headers or some of the body
+            if path != 'stall':
+                self.send_response_only(200)
+            if path == 'stall-body':
+                self.send_header('Content-Length', '10')
+                self.end_headers()
+                self.wfile.write(b'{}\n')
+            self.flush_headers()
+            self.rfile.read(1)
+            self.close_connection = True
+        elif path == 'reset':
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                       struct.pack('ii', 1, 0))
+            self.connection.close()
+            self.close_connection = True
+        elif path == 'bye':
+            self.send_json({})
+            self.close_connection = True
+        elif path == '/download/artifacts.zip':
+            self.send(200, FakeGitlabModule.ProjectJob.artifacts_data,
+                      headers=[('Connection', 'close')])
+            self.close_connection = True
+        elif m := re.fullmatch(r'projects/([^/]+)', path):
+            if m.group(1) == '404':
+                self.send(404)
+            else:
+                project = FakeGitlabModule.Project(
+                    urllib.parse.unquote(m.group(1)))
+                self.send_json({'id': project.id, 'web_url': project.web_url,
+                                'default_branch': project.default_branch})
+        elif m := re.fullmatch(r'groups/([^/]+)/projects', path):
+            group = FakeGitlabModule.GroupProjects(
+                urllib.parse.unquote(m.group(1)))
+            self.send_json([
+                {'path_with_namespace': project.path_with_namespace}
+                for project in group.list(iterator=True)
+            ])
+        elif re.fullmatch(r'projects/[^/]+/pipelines', path):
+            pipelines = [] if query['ref'] == ['empty'] else [1005, 997]
+            page = int(query['page'][0])
+            headers = []
+            if page < len(pipelines):
+                headers.append(('X-Next-Page', str(page + 1)))
+            self.send_json([
+                {'id': id, 'status': 'failed'}
+                for id in pipelines[page - 1:page]
+            ], headers)
+        elif m := re.fullmatch(r'projects/[^/]+/pipelines/(\d+)', path):
+            pipeline = FakeGitlabModule.ProjectPipeline(m.group(1))
+            self.send_json(dict(pipeline.attributes, id=int(pipeline.id)))
+        elif m := re.fullmatch(r'projects/[^/]+/pipelines/(\d+)/jobs', path):
+            pipeline = FakeGitlabModule.ProjectPipeline(m.group(1))
+            try:
+                jobs = pipeline.jobs.list(scope=query.get('scope[]'))
+            except gitlab.exceptions.GitlabListError:
+                self.send(403)
+                return
+            self.send_json([
+                {'id': job.id, 'name': job.name, 'status': job.status,
+                 'duration': job.duration}
+                for job in jobs
+            ])
+        elif m := re.fullmatch(r'projects/[^/]+/pipelines/(\d+)/bridges',
+                               path):
+            pipeline = FakeGitlabModule.ProjectPipeline(m.group(1))
+            self.send_json([
+                {k: v for k, v in vars(bridge).items() if k != 'attributes'}
+                for bridge in pipeline.bridges.list(all=True)
+            ])
+        elif m := re.fullmatch(r'projects/[^/]+/jobs/(\d+)', path):
+            # every time we're asked again, the job makes some progress
+            job_id = m.group(1)
+            job = self.get_job(job_id, refresh=job_id in self.server.seen)
+            self.server.seen.add(job_id)
+            self.send_json(dict(
+                {k: v for k, v in vars(job).items() if k[0] != '_'},
+                id=int(job.id)))
+        elif m := re.fullmatch(r'projects/[^/]+/jobs/(\d+)/trace', path):
+            job = self.get_job(m.group(1))
+            range = self.headers['Range'] if job.ranges else None
+            status, content_range, body = byte_range(job._trace, range)
+            if status == 200:
+                self.send_chunked(body)
+            else:
+                self.send(status, body, [('Content-Range', content_range)])
+        elif re.fullmatch(r'projects/[^/]+/jobs/(\d+)/artifacts', path):
+            self.send(302, headers=[
+                ('Location', '/download/artifacts.zip'),
+                ('Content-Length', '0'),
+            ])
+        else:
+            self.send(404)
+
+
+@pytest.fixture
+def fake_server(monkeypatch):
+    server = FakeGitlabServer()
+    thread = threading.Thread(target=server.serve_forever,
+                              kwargs={'poll_interval': 0.01})
+    thread.start()
+    monkeypatch.setattr(FakeGitlabModule.Gitlab, 'api_url', server.api_url)
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def run_async_client(server, coro_fn, **kwargs):
+    async def run():
+        client = gt.AsyncGitlab(server.api_url, {'PRIVATE-TOKEN': 'secret'},
+                                **kwargs)
+        try:
+            return await coro_fn(client)
+        finally:
+            client.close()
+    return asyncio.run(run())
+
+
+def test_async_gitlab_from_gitlab():
+    gl = types.SimpleNamespace(
+        api_url='https://git.example.com/api/v4', private_token=None,
+        oauth_token=None, job_token=None, ssl_verify=False, timeout=5,
+        session=requests.Session())
+    client = gt.AsyncGitlab.from_gitlab(gl)
+    assert client.timeout == 5
+    assert client.api_url == 'https://git.example.com/api/v4/'
+    assert client.ssl_verify is False
+    assert 'PRIVATE-TOKEN' not in client.headers
+    gl.job_token = 'job'
+    assert gt.AsyncGitlab.from_gitlab(gl).headers['JOB-TOKEN'] == 'job'
+    gl.oauth_token = 'oauth'
+    assert (gt.AsyncGitlab.from_gitlab(gl).headers['Authorization']
+            == 'Bearer oauth')
+    gl.private_token = 'secret'
+    assert gt.AsyncGitlab.from_gitlab(gl).headers['PRIVATE-TOKEN'] == 'secret'
+
+
+def test_async_gitlab_list(fake_server):
+    pipelines = run_async_client(
+        fake_server, lambda client: client.pipelines('owner/project',
+                                                     ref='main', limit=5))
+    assert [p.id for p in pipelines] == [1005, 997]
+    # all of that over a single keep-alive connection
+    assert len(fake_server.requests) == 2
+    assert fake_server.requests[0][0] == (
+        '/api/v4/projects/owner%2Fproject/pipelines'
+        '?ref=main&per_page=5&page=1')
+
+
+def test_async_gitlab_stats(fake_server):
+    stats = gt.Stats()
+    run_async_client(
+        fake_server, lambda client: client.job_with_trace('1', 3202),
+        stats=stats)
+    summary = stats.summary()
+    assert summary['requests'] == 2
+    assert summary['bytes_in'] > len(b'Hello, world!\n')
+    assert sorted(summary['endpoints']) == [
+        'GET /api/v4/projects/:id/jobs/:id',
+        'GET /api/v4/projects/:id/jobs/:id/trace',
+    ]
+
+
+def test_async_gitlab_rate_limiter(fake_server, tmp_path):
+    limiter = gt.RateLimiter(str(tmp_path / 'bucket'), rate=1, burst=1)
+    run_async_client(
+        fake_server, lambda client: client.job_with_trace('1', 3202),
+        rate_limiter=limiter)
+    # two API calls: one token was available, the other is promised
+    assert limiter.reserve() == pytest.approx(2, abs=0.1)
+
+
+def test_async_gitlab_redirect_drops_token(fake_server):
+    async def download(client):
+        async with client.stream('1', 3202, 'artifacts') as response:
+            return await response.read()
+    assert run_async_client(fake_server, download) == b'PK\5\6' + bytes(18)
+    (redirect, headers1), (download, headers2) = fake_server.requests
+    assert headers1['PRIVATE-TOKEN'] == 'secret'
+    assert 'PRIVATE-TOKEN' not in headers2
+
+
+def test_async_gitlab_reconnects(fake_server):
+    async def fetch(client):
+        await client.get_json('bye')
+        # the idle connection we kept was closed by the server
+        return await client.get_json('bye')
+    assert run_async_client(fake_server, fetch) == {}
+
+
+@pytest.mark.parametrize('path, exception, message', [
+    ('teapot', requests.exceptions.HTTPError, "418 I'm a Teapot"),
+    ('loop', requests.exceptions.TooManyRedirects, 'Exceeded 5 redirects'),
+    ('short', requests.exceptions.ChunkedEncodingError, 'closed early'),
+    ('hangup', requests.exceptions.ConnectionError, 'Connection closed'),
+    ('reset', requests.exceptions.ConnectionError, 'Connection closed'),
+])
+def test_async_gitlab_errors(fake_server, path, exception, message):
+    with pytest.raises(exception, match=message):
+        run_async_client(fake_server, lambda client: client.get_json(path))
+
+
+@pytest.mark.parametrize('path', ['stall', 'stall-headers', 'stall-body'])
+def test_async_gitlab_read_timeout(fake_server, path):
+    with pytest.raises(requests.exceptions.ReadTimeout,
+                       match=f'Read timed out after 0.1 s: .*/{path}'):
+        run_async_client(fake_server, lambda client: client.get_json(path),
+                         timeout=0.1)
+
+
+def test_async_gitlab_connect_timeout(fake_server, monkeypatch):
+    async def open_connection(host, port, ssl=None):
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(asyncio, 'open_connection', open_connection)
+    with pytest.raises(requests.exceptions.ConnectTimeout,
+                       match='Connection to 127.0.0.1:.* timed out'):
+        run_async_client(fake_server, lambda client: client.get_json('bye'),
+                         timeout=0.1)
+
+
+@pytest.mark.parametrize('ssl_verify', [True, False, '/nonexistent/ca.pem'])
+def test_async_gitlab_connect_errors(fake_server, ssl_verify):
+    # our fake server doesn't speak TLS
+    with pytest.raises(requests.exceptions.ConnectionError,
+                       match='Cannot connect to 127.0.0.1'):
+        run_async_client(
+            fake_server,
+            lambda client: client.connect('https', '127.0.0.1',
+                                          fake_server.server_port),
+            ssl_verify=ssl_verify)
+
+
+def test_async_gitlab_ca_bundle(monkeypatch):
+    monkeypatch.setenv('REQUESTS_CA_BUNDLE', '/etc/our-ca.pem')
+    client = gt.AsyncGitlab.from_gitlab(FakeGitlabModule.Gitlab())
+    assert client.ssl_verify == '/etc/our-ca.pem'
+    monkeypatch.setattr(FakeGitlabModule.Gitlab, 'ssl_verify', False)
+    client = gt.AsyncGitlab.from_gitlab(FakeGitlabModule.Gitlab())
+    assert client.ssl_verify is False
+
+
+def test_ssl_context(tmp_path):
+    # certifi's CA certificates, like requests
+    context = gt.ssl_context(True)
+    assert context.verify_mode == ssl.CERT_REQUIRED
+    assert context.cert_store_stats()['x509_ca'] > 0
+    context = gt.ssl_context(str(tmp_path))
+    assert context.verify_mode == ssl.CERT_REQUIRED
+    assert context.cert_store_stats()['x509_ca'] == 0
+    context = gt.ssl_context(False)
+    assert context.verify_mode == ssl.CERT_NONE
+    assert not context.check_hostname
+
+
+def test_prefix(capsysbinary):
+    output = gt.Prefix(sys.stdout.buffer, b'[job] ')
+    output.write(b'Hello,\nworld!')
+    output.close()
+    assert capsysbinary.readouterr().out == b'[job] Hello,\n[job] world!\n'
+
+
+def test_fetch_traces_async_runs_few_ahead():
+    fetched = []
+
+    async def job_with_trace(project, job_id):
+        fetched.append(job_id)
+        return types.SimpleNamespace(id=job_id), b''
+
+    async def fetch():
+        client = types.SimpleNamespace(job_with_trace=job_with_trace)
+        traces = gt.fetch_traces_async(client, 'p', [1, 2, 3, 4], workers=2)
+        job, trace = await traces.__anext__()
+        assert job.id == 1
+        assert set(fetched) <= {1, 2}
+        await traces.aclose()
+
+    asyncio.run(fetch())
+    assert set(fetched) <= {1, 2}
+
+
+def test_follow_async_truncation(capsys):
+    traces = [b'Hello, world!\n', b'world!\nBye!\n']
+
+    async def trace_range(project, job_id, range):
+        # a server that ignores the Range header
+        return 200, None, traces.pop(0)
+
+    async def job(project, job_id):
+        return types.SimpleNamespace(id=job_id, finished_at='now')
+
+    client = types.SimpleNamespace(trace_range=trace_range, job=job)
+    stats = gt.Stats()
+    asyncio.run(gt.follow_async(
+        client, 'owner/project', types.SimpleNamespace(id=1, finished_at=None),
+        sys.stdout.buffer, stats=stats))
+    stdout, stderr = capsys.readouterr()
+    assert stdout == 'Hello, world!\nworld!\nBye!\n'
+    assert stderr == '\n----- trace was truncated -----\n'
+    assert stats.slept == 1
+
+
+def main_async(monkeypatch, capsys, *args):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '--async', '--project=owner/project', *args])
+    monkeypatch.setattr(gt, 'determine_branch', lambda: 'main')
+    try:
+        gt.main()
+    except SystemExit as e:
+        assert e.code in (0, None), e.code
+    return capsys.readouterr()
+
+
+def test_main_async_list_jobs(monkeypatch, capsys, fake_server):
+    stdout, stderr = main_async(monkeypatch, capsys, '-2', '--debug')
+    assert stderr == textwrap.dedent("""\
+        Current branch: main
+        https://git.example.com/owner/project/pipelines/997
+        {
+          "type": "pipeline",
+          "json_attributes": "here",
+          "id": 997
+        }
+    """)
+    assert stdout == textwrap.dedent("""\
+        Available jobs for pipeline #997:
+           --job=3201 - success - build
+           --job=3202 - failed - test
+    """)
+
+
+def test_main_async_no_pipelines(monkeypatch, capsys, fake_server):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '--async', '-p', 'owner/project', '-b', 'empty'])
+    with pytest.raises(SystemExit,
+                       match="Project owner/project doesn't have any pipelines"
+                             " for branch empty"):
+        gt.main()
+
+
+def test_main_async_not_enough_pipelines(monkeypatch, capsys, fake_server):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '--async', '-p', 'owner/project', '-b', 'main', '-5'])
+    with pytest.raises(SystemExit,
+                       match="Project owner/project has only 2 pipelines"
+                             " for branch main"):
+        gt.main()
+
+
+def test_main_async_running(monkeypatch, capsys, fake_server):
+    stdout, stderr = main_async(monkeypatch, capsys, '1009', '--running',
+                                '-b', 'main')
+    assert stderr == textwrap.dedent("""\
+        Ignoring --branch=main because pipeline (1009) was specified
+        Automatically selected --job=3304 (test)
+    """)
+    assert stdout == textwrap.dedent("""\
+        Available jobs for pipeline #1009:
+           --job=3304 - running - test
+        Hello, world!
+    """)
+
+
+def test_main_async_unfiltered(monkeypatch, capsys, fake_server):
+    stdout, stderr = main_async(monkeypatch, capsys, '--job=3202',
+                                '--color=always')
+    assert stdout == 'Hello, world!\n'
+
+
+def test_main_async_history(monkeypatch, capsys, fake_server):
+    stdout, stderr = main_async(monkeypatch, capsys, '--history=5')
+    assert stderr == 'Current branch: main\n'
+    assert stdout == textwrap.dedent("""\
+               #1005        #997         failed
+        build  success 42s  success 42s  0/2
+        test   failed 42s   failed 42s   2/2
+    """)
+
+
+def test_main_async_history_status(monkeypatch, capsys, fake_server):
+    stdout, stderr = main_async(monkeypatch, capsys, '--history=5',
+                                '--status=success')
+    assert stdout == textwrap.dedent("""\
+               #1005        #997         failed
+        build  success 42s  success 42s  0/2
+    """)
+    # whole job lists, or we'd never see any other status
+    assert not any('scope' in path for path, headers in fake_server.requests)
+
+
+def test_main_async_diff(monkeypatch, capsys, fake_server):
+    diff_traces(monkeypatch)
+    stdout, stderr = main_async(monkeypatch, capsys, '--diff', '3201', '3202')
+    assert stdout == textwrap.dedent("""\
+        --- job 3201 (build)
+        +++ job 3202 (build)
+        @@ -1,3 +1,3 @@
+         Running tests
+         Took 5s
+        -OK
+        +FAIL
+    """)
+
+
+def test_main_async_group(monkeypatch, capsys, fake_server):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--async',
+                                      '--group=owner', '-p', '404'])
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stderr == ''
+    stdout = stdout.replace(fake_server.api_url, 'API_URL')
+    assert sorted(stdout.splitlines()) == [
+        '404            error: 404 Not Found for url: API_URL/projects/404',
+        'owner/empty    -         no pipelines for None',
+        'owner/new      -         no pipelines for empty',
+        'owner/project  failed    #1005 (main)  failed: test',
+    ]
+
+
+def test_main_async_ndjson(monkeypatch, capsys, fake_server):
+    stdout, stderr = main_async(monkeypatch, capsys, '--format=ndjson',
+                                '--job=3202')
+    assert events(stdout)[0]['event'] == 'job'
+    assert events(stdout)[1:] == [
+        {'event': 'trace', 'job': 3202, 'data': 'Hello, world!\n'},
+        {'event': 'trace_end', 'job': 3202, 'status': 'success'},
+    ]
+
+
+def test_main_async_ndjson_tail(monkeypatch, capsys, fake_server):
+    stdout, stderr = main_async(monkeypatch, capsys, '--format=ndjson',
+                                '--job=3202', '--tail=1')
+    assert events(stdout)[1:] == [
+        {'event': 'trace', 'job': 3202, 'data': 'Hello, world!\n'},
+        {'event': 'trace_end', 'job': 3202, 'status': 'success'},
+    ]
+
+
+def test_main_async_ndjson_several(monkeypatch, capsys, fake_server):
+    stdout, stderr = main_async(monkeypatch, capsys, '--format=ndjson',
+                                '--job=3201,3202')
+    assert [(e['event'], e.get('job')) for e in events(stdout)
+            if e['event'] != 'job'] == [
+        ('trace', 3201), ('trace_end', 3201),
+        ('trace', 3202), ('trace_end', 3202),
+    ]
+
+
+def test_main_async_ndjson_follow(monkeypatch, capsys, fake_server):
+    stdout, stderr = main_async(monkeypatch, capsys, '--format=ndjson',
+                                '--job=3201,3202', '-f')
+    trace_events = [e for e in events(stdout) if e['event'] != 'job']
+    assert sorted(trace_events, key=lambda e: e['job']) == [
+        {'event': 'trace', 'job': 3201, 'data': 'Hello, world!\n'},
+        {'event': 'trace', 'job': 3201, 'data': 'Bye!\n'},
+        {'event': 'trace_end', 'job': 3201, 'status': 'success'},
+        {'event': 'trace', 'job': 3202, 'data': 'Hello, world!\n'},
+        {'event': 'trace', 'job': 3202, 'data': 'Bye!\n'},
+        {'event': 'trace_end', 'job': 3202, 'status': 'success'},
+    ]
+
+
+def test_main_async_ndjson_group(monkeypatch, capsys, fake_server):
+    stdout, stderr = main_async(monkeypatch, capsys, '--format=ndjson',
+                                '--group=owner')
+    assert sorted(e['project'] for e in events(stdout)) == [
+        'owner/empty', 'owner/new', 'owner/project',
+    ]
+
+
+def test_main_async_history_no_pipelines(monkeypatch, capsys, fake_server):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '--async', '-p', 'owner/project', '-b', 'empty',
+        '--history=5'])
+    with pytest.raises(SystemExit,
+                       match="Project owner/project doesn't have any pipelines"
+                             " for branch empty"):
+        gt.main()
+
+
+def test_main_async_print_url(monkeypatch, capsys, fake_server):
+    stdout, stderr = main_async(monkeypatch, capsys, '--job=3202',
+                                '--print-url', '-b', 'main')
+    assert stderr == textwrap.dedent("""\
+        Ignoring --branch=main because --job=3202 was specified
+    """)
+    assert stdout == textwrap.dedent("""\
+        https://git.example.com/owner/project/-/jobs/3202
+    """)
+
+
+def test_main_async_job_list_print_url(monkeypatch, capsys, fake_server):
+    stdout, stderr = main_async(monkeypatch, capsys, '1009', 'test',
+                                '--print-url')
+    assert stderr == textwrap.dedent("""\
+        Found multiple jobs: 3302 3303 3304
+        Selecting the last one: 3304
+    """)
+    assert stdout == textwrap.dedent("""\
+        https://git.example.com/owner/project/-/jobs/3304
+    """)
+    stdout, stderr = main_async(monkeypatch, capsys, '--job=3201,3202',
+                                '--print-url')
+    assert stdout == textwrap.dedent("""\
+        https://git.example.com/owner/project/-/jobs/3201
+        https://git.example.com/owner/project/-/jobs/3202
+    """)
+
+
+def test_main_async_job_list(monkeypatch, capsys, fake_server):
+    stdout, stderr = main_async(monkeypatch, capsys, '1009', '*', '-a')
+    assert stderr == textwrap.dedent("""\
+        Found 2 matching jobs: 3301,3304
+        Ignoring --artifacts because several jobs were selected.
+    """)
+    assert stdout == textwrap.dedent("""\
+        ==> job 3301 (build) <==
+        Hello, world!
+        ==> job 3304 (build) <==
+        Hello, world!
+    """)
+
+
+def test_main_async_timings(monkeypatch, capsys, fake_server):
+    monkeypatch.setattr(FakeGitlabModule.ProjectJob, 'default_trace',
+                        SECTIONED_TRACE)
+    stdout, stderr = main_async(monkeypatch, capsys, '--job=3202',
+                                '--timings')
+    assert stdout == (
+        "     1m 2s  step_script (--job=3202 - build)\n"
+        "        6s  nested (--job=3202 - build)\n"
+        "        3s  prepare_script (--job=3202 - build)\n"
+    )
+
+
+def test_main_async_follow(monkeypatch, capsys, fake_server, tmp_path):
+    stdout, stderr = main_async(monkeypatch, capsys, '--job=3202', '-f',
+                                f'--stats-json={tmp_path}/stats.json')
+    assert stderr == ''
+    assert stdout == textwrap.dedent("""\
+        Hello, world!
+        Bye!
+    """)
+    with open(tmp_path / 'stats.json') as f:
+        stats = json.load(f)
+    assert stats['requests'] == 7
+    assert stats['sleep'] == 2.0
+
+
+def test_main_async_parallel(monkeypatch, capsys, fake_server):
+    from_gitlab = gt.AsyncGitlab.from_gitlab
+    options = []
+
+    def spy(gl, **kwargs):
+        options.append(kwargs)
+        return from_gitlab(gl, **kwargs)
+
+    monkeypatch.setattr(gt.AsyncGitlab, 'from_gitlab', spy)
+    stdout, stderr = main_async(monkeypatch, capsys, '--job=3201,3202',
+                                '--parallel=2')
+    assert options[0]['max_connections'] == 2
+
+
+def test_main_parallel_zero(monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--parallel=0'])
+    with pytest.raises(SystemExit, match='--parallel must be at least 1: 0'):
+        gt.main()
+
+
+def test_main_async_proxy(monkeypatch, capsys, fake_server):
+    monkeypatch.setenv('http_proxy', 'http://proxy.example.com:3128')
+    monkeypatch.delenv('no_proxy', raising=False)
+    monkeypatch.delenv('NO_PROXY', raising=False)
+    stdout, stderr = main_async(monkeypatch, capsys, '--job=3202')
+    assert stderr == textwrap.dedent("""\
+        Ignoring --async because an HTTP proxy is configured
+    """)
+    assert stdout == 'Hello, world!\n'
+    assert fake_server.requests == []
+
+
+@pytest.mark.parametrize('trace, expected', [
+    (b'', 'Bye!\n'),
+    (b'one\ntwo\n', 'two\nBye!\n'),
+])
+def test_main_async_follow_tail(monkeypatch, capsys, fake_server, trace,
+                                expected):
+    monkeypatch.setattr(FakeGitlabModule.ProjectJob, 'default_trace', trace)
+    stdout, stderr = main_async(monkeypatch, capsys, '--job=3202', '-f',
+                                '--tail=1')
+    assert stderr == ''
+    assert stdout == expected
+    ranges = [
+        headers.get('Range') for path, headers in fake_server.requests
+        if path.endswith('/trace')
+    ]
+    # the initial tail, then two polls
+    poll = f'bytes={max(0, len(trace) - 1)}-'
+    assert ranges == ['bytes=-16384', poll, poll]
+
+
+def test_main_async_follow_several(monkeypatch, capsys, fake_server):
+    stdout, stderr = main_async(monkeypatch, capsys, '--job=3201,3202', '-f',
+                                '--grep=.', '-a')
+    assert stderr == textwrap.dedent("""\
+        Ignoring --artifacts because several jobs were selected.
+    """)
+    assert sorted(stdout.splitlines()) == [
+        '[build] Bye!',
+        '[build] Bye!',
+        '[build] Hello, world!',
+        '[build] Hello, world!',
+    ]
+
+
+def test_main_async_grep(monkeypatch, capsys, fake_server):
+    monkeypatch.setattr(FakeGitlabModule.ProjectJob, 'default_trace',
+                        b'one\ntwo\nthree\n' * 10)
+    stdout, stderr = main_async(monkeypatch, capsys, '--job=3202',
+                                '--grep=t', '-m', '2')
+    assert stdout == textwrap.dedent("""\
+        two
+        three
+    """)
+
+
+def test_main_async_artifacts(monkeypatch, capsys, fake_server, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    stdout, stderr = main_async(monkeypatch, capsys, '--job=3202', '-a',
+                                '--tail=1')
+    assert stderr == textwrap.dedent("""\
+        Artifacts: artifacts.zip (22 B)
+    """)
+    assert stdout == textwrap.dedent("""\
+        Hello, world!
+    """)
+    assert (tmp_path / 'artifacts.zip').read_bytes() == b'PK\5\6' + bytes(18)
+
+
+def test_main_async_artifacts_cached(monkeypatch, capsys, fake_server,
+                                     tmp_path):
+    for where in 'first', 'second':
+        (tmp_path / where).mkdir()
+        monkeypatch.chdir(tmp_path / where)
+        stdout, stderr = main_async(monkeypatch, capsys, '--job=3202', '-a',
+                                    '--tail=1')
+    assert stderr == textwrap.dedent("""\
+        Artifacts: artifacts.zip (22 B, cached)
+    """)
+    assert (tmp_path / 'second' / 'artifacts.zip').read_bytes() == (
+        b'PK\5\6' + bytes(18))
+    assert [path for path, headers in fake_server.requests].count(
+        '/download/artifacts.zip') == 1
+
+
+def test_main_async_extract(monkeypatch, capsys, fake_server, tmp_path):
+    monkeypatch.setattr(FakeGitlabModule.ProjectJob, 'artifacts_data',
+                        make_zip(FILES, stream=True))
+    stdout, stderr = main_async(monkeypatch, capsys, '--job=3202',
+                                f'--extract={tmp_path}/out', '--tail=1')
+    assert stderr == textwrap.dedent(f"""\
+        Extracting artifacts.zip (1.9 KiB) into {tmp_path}/out
+        Extracted 4 files
+    """)
+    assert extracted_files(tmp_path / 'out') == EXTRACTED
+    # --extract alone doesn't keep the archive
+    assert not (tmp_path / 'cache').exists()
+
+
+def test_main_async_extract_several(monkeypatch, capsys, fake_server,
+                                    tmp_path):
+    stdout, stderr = main_async(monkeypatch, capsys, '--job=3201,3202',
+                                f'--extract={tmp_path}')
+    assert stderr == (
+        'Ignoring --extract because several jobs were selected.\n')
+
+
+def test_main_async_recursive(monkeypatch, capsys, fake_server):
+    stdout, stderr = main_async(monkeypatch, capsys, '-r', '--failed',
+                                '1005')
+    assert stdout == textwrap.dedent("""\
+        Available jobs for pipeline #1005:
+           --job=3202 - failed - test
+           deploy - running - pipeline #2001
+              --job=4002 - failed - test
+              nested - success - pipeline #2003
+                 --job=4101 - failed - smoke
+           docs - success - pipeline #2002
+              --job=5002 --project=2 - failed - linkcheck
+           release - manual - not triggered
+        Hello, world!
+    """)
+
+
+def test_main_async_recursive_not_accessible(monkeypatch, capsys,
+                                             fake_server):
+    secret_downstream_pipeline(monkeypatch)
+    stdout, stderr = main_async(monkeypatch, capsys, '-r', '1005')
+    assert stdout.endswith(
+        '   release - manual - not triggered\n'
+        '   secret - success - pipeline #2004 (not accessible)\n')
+
+
+def test_main_async_recursive_root_not_accessible(monkeypatch, capsys,
+                                                  fake_server):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '--async', '--project=owner/project', '-r', '2004'])
+    with pytest.raises(SystemExit, match='403 Forbidden'):
+        gt.main()
+
+
+def test_main_async_recursive_other_project(monkeypatch, capsys,
+                                            fake_server):
+    stdout, stderr = main_async(monkeypatch, capsys, '-r', '1005', 'docs',
+                                '--print-url')
+    assert stderr == textwrap.dedent("""\
+        Job ID: 5001
+        GitLab project: 2
+    """)
+    assert stdout == textwrap.dedent("""\
+        https://git.example.com/2/-/jobs/5001
+    """)
+
+
+def test_main_async_no_artifacts(monkeypatch, capsys, fake_server):
+    monkeypatch.setattr(sys, 'argv', [
+        'gitlab-trace', '--async', '-p', 'owner/project', '--job=3201', '-a'])
+    with pytest.raises(SystemExit):
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    assert stderr == 'Job has no artifacts.\n'
+
+
+def test_cached_manager():
+    projects = gt.CachedManager(FakeGitlabModule.Projects(),
+                                prepare=gt.cache_finished_jobs)
+    project = projects.get('owner/project')
+    assert projects.get('owner/project') is project
+    job = project.jobs.get('3202')
+    assert project.jobs.get('3202') is not job
+    job.finished_at = '2020-09-16T06:16:57.452Z'
+    project.jobs.manager.get = lambda job_id: job
+    assert project.jobs.get(3202) is job
+    assert project.jobs.objects == {'3202': job}
+
+
+def test_cached_manager_lazy():
+    projects = gt.CachedManager(FakeGitlabModule.Projects())
+    lazy = projects.get(42, lazy=True)
+    assert projects.get('42') is not lazy
+    assert projects.get('42') is projects.get(42, lazy=True)
+
+
+def test_daemon_gitlab():
+    daemon = gt.Daemon()
+    gl = daemon.gitlab(None)
+    assert daemon.gitlab(None) is gl
+    assert daemon.gitlab('other') is not gl
+    assert isinstance(gl.projects, gt.CachedManager)
+    assert gt.CachedManager(types.SimpleNamespace(path='/p')).path == '/p'
+
+
+def test_daemon_gitlab_rate_limit(gitlab_config):
+    gitlab_config.write_text('[main]\nrate_limit = 5\n')
+    daemon = gt.Daemon()
+    assert isinstance(daemon.gitlab('main').session.adapters['https://'],
+                      gt.RateLimitedAdapter)
+    assert isinstance(daemon.gitlab(None).session.adapters['https://'],
+                      requests.adapters.HTTPAdapter)
+
+
+@pytest.mark.parametrize('exception', [None, BrokenPipeError])
+def test_run_command_exit_status(monkeypatch, exception):
+    def main(*args, **kwargs):
+        if exception is not None:
+            raise exception()
+    monkeypatch.setattr(gt, '_main', main)
+    assert gt.run_command([], gt.Daemon()) == 0
+
+
+def test_daemon_client_went_away(monkeypatch):
+    monkeypatch.setattr(sys, 'stdout', gt.ThreadLocalStream(sys.stdout))
+    monkeypatch.setattr(sys, 'stderr', gt.ThreadLocalStream(sys.stderr))
+    server_end, client_end = socket.socketpair()
+    client_end.sendall(json.dumps({
+        'argv': ['--project=owner/project', '--job=3201'],
+        'isatty': [False, False],
+        'environ': gt.daemon_environ(),
+    }).encode() + b'\n')
+    client_end.close()
+    gt.DaemonHandler(server_end, None, None, daemon=gt.Daemon())
+    assert not hasattr(sys.stdout.local, 'stream')
+
+
+def test_daemon_client_went_away_during_follow(monkeypatch):
+    # a job that never finishes and never writes anything
+    monkeypatch.setattr(FakeGitlabModule.ProjectJob, 'default_trace', b'')
+    monkeypatch.setattr(FakeGitlabModule.ProjectJob, 'refresh',
+                        lambda self: None)
+    monkeypatch.setattr(sys, 'stdout', gt.ThreadLocalStream(sys.stdout))
+    monkeypatch.setattr(sys, 'stderr', gt.ThreadLocalStream(sys.stderr))
+    server_end, client_end = socket.socketpair()
+    client_end.sendall(json.dumps({
+        'argv': ['--project=owner/project', '--job=3201', '--follow'],
+        'isatty': [False, False],
+        'environ': gt.daemon_environ(),
+    }).encode() + b'\n')
+    client_end.close()
+    gt.DaemonHandler(server_end, None, None, daemon=gt.Daemon())
+    assert not hasattr(sys.stdout.local, 'stream')
+
+
+def test_frame_writer_closed():
+    server_end, client_end = socket.socketpair()
+    writer = gt.FrameWriter(server_end, b'1', False)
+    assert not writer.closed
+    client_end.close()
+    assert not writer.closed  # not checked again so soon
+    writer.next_check = 0
+    with pytest.raises(BrokenPipeError):
+        writer.closed
+    writer.close()
+    assert writer.closed
+    server_end.close()
+
+
+@pytest.fixture
+def daemon(monkeypatch, tmp_path):
+    path = str(tmp_path / 'daemon.sock')
+    server = socketserver.ThreadingUnixStreamServer(
+        path, partial(gt.DaemonHandler, daemon=gt.Daemon()))
+    thread = threading.Thread(target=server.serve_forever,
+                              kwargs={'poll_interval': 0.01})
+    thread.start()
+    yield path
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def main_via_daemon(monkeypatch, capsys, path, *args):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', f'--socket={path}',
+                                      *args])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    monkeypatch.setattr(gt, 'determine_branch', lambda: 'main')
+    # (not in the fixture, because pytest replaces them before every test)
+    monkeypatch.setattr(sys, 'stdout', gt.ThreadLocalStream(sys.stdout))
+    monkeypatch.setattr(sys, 'stderr', gt.ThreadLocalStream(sys.stderr))
+    with pytest.raises(SystemExit) as exc_info:
+        gt.main()
+    stdout, stderr = capsys.readouterr()
+    return exc_info.value.code, stdout, stderr
+
+
+def test_main_via_daemon(monkeypatch, capsys, daemon):
+    code, stdout, stderr = main_via_daemon(monkeypatch, capsys, daemon)
+    assert code == 0
+    assert stderr == textwrap.dedent("""\
+        GitLab project: owner/project
+        Current branch: main
+        https://git.example.com/owner/project/pipelines/1005
+    """)
+    assert stdout == textwrap.dedent("""\
+        Available jobs for pipeline #1005:
+           --job=3201 - success - build
+           --job=3202 - failed - test
+    """)
+
+
+def test_main_via_daemon_dash_dash(monkeypatch, capsys, daemon):
+    code, stdout, stderr = main_via_daemon(monkeypatch, capsys, daemon,
+                                           '--', '-1')
+    assert code == 0, stderr
+    assert stdout == textwrap.dedent("""\
+        Available jobs for pipeline #1005:
+           --job=3201 - success - build
+           --job=3202 - failed - test
+    """)
+
+
+def test_main_via_daemon_job(monkeypatch, capsys, daemon, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    code, stdout, stderr = main_via_daemon(
+        monkeypatch, capsys, daemon, '--job=3201', '--stats-json=stats.json')
+    assert code == 0
+    assert stderr == 'GitLab project: owner/project\n'
+    assert stdout == 'Hello, world!\n'
+    assert (tmp_path / 'stats.json').exists()
+
+
+def test_main_via_daemon_error(monkeypatch, capsys, daemon):
+    code, stdout, stderr = main_via_daemon(monkeypatch, capsys, daemon,
+                                           '--job=3201', '--grep=(')
+    assert code == 1
+    assert stderr.startswith('GitLab project: owner/project\n'
+                             'Invalid --grep pattern: ')
+
+
+def test_main_via_daemon_api_error(monkeypatch, capsys, daemon):
+    code, stdout, stderr = main_via_daemon(monkeypatch, capsys, daemon,
+                                           '--project=404', '--job=1')
+    assert code == 1
+
+
+def test_main_via_daemon_bug(monkeypatch, capsys, daemon):
+    def oops(*args, **kwargs):
+        raise ValueError('oops')
+    monkeypatch.setattr(gt, 'run', oops)
+    code, stdout, stderr = main_via_daemon(monkeypatch, capsys, daemon,
+                                           '--job=3201')
+    assert code == 1, stderr
+    assert 'Traceback' in stderr
+    assert 'ValueError: oops' in stderr
+
+
+def test_main_via_daemon_lost_connection(monkeypatch, capsys, daemon):
+    def oops(*args, **kwargs):
+        raise ValueError('oops')
+    monkeypatch.setattr(gt, 'run_command', oops)
+    code, stdout, stderr = main_via_daemon(monkeypatch, capsys, daemon,
+                                           '--job=3201')
+    assert code == 'Lost connection to gitlab-trace --daemon'
+
+
+def test_main_via_daemon_no_project(monkeypatch, capsys, daemon):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', f'--socket={daemon}'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: None)
+    with pytest.raises(SystemExit,
+                       match='Could not determine GitLab project ID'):
+        gt.main()
+
+
+def test_main_not_via_daemon_other_environ(monkeypatch, capsys, daemon,
+                                           tmp_path):
+    monkeypatch.setattr(gt, 'run_command', lambda argv, daemon: 1 / 0)
+    monkeypatch.setenv('PYTHON_GITLAB_CFG', str(tmp_path / 'other.cfg'))
+    code, stdout, stderr = main_via_daemon(monkeypatch, capsys, daemon,
+                                           '--job=3202')
+    assert code in (0, None)
+    assert stderr == 'GitLab project: owner/project\n'
+    assert stdout == 'Hello, world!\n'
+
+
+def test_main_artifacts_not_via_daemon(monkeypatch, capsys, daemon,
+                                       tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', f'--socket={daemon}',
+                                      '--job=3202', '-a'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    with pytest.raises(SystemExit):
+        gt.main()
+    assert (tmp_path / 'artifacts.zip').exists()
+
+
+@pytest.mark.parametrize('kind', ['file', 'stale'])
+def test_main_no_daemon(monkeypatch, capsys, tmp_path, kind):
+    path = str(tmp_path / 'daemon.sock')
+    if kind == 'file':
+        open(path, 'w').close()
+    else:
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.bind(path)
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', f'--socket={path}',
+                                      '--job=3201'])
+    monkeypatch.setattr(gt, 'determine_project', lambda: 'owner/project')
+    with pytest.raises(SystemExit):
+        gt.main()
+    assert capsys.readouterr().out == 'Hello, world!\n'
+
+
+def test_lazy_imports():
+    # a client of the --daemon can do without these
+    code = ("import sys, gitlab_trace;"
+            " print([name for name in ['asyncio', 'gitlab', 'requests']"
+            " if type(sys.modules[name]).__name__ == 'module'])")
+    result = subprocess.run(
+        [sys.executable, '-c', code], stdout=subprocess.PIPE, text=True,
+        cwd=os.path.dirname(os.path.abspath(gt.__file__)))
+    assert result.stdout == '[]\n'
+
+
+def test_main_version(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--no-daemon',
+                                      '--version'])
+    with pytest.raises(SystemExit):
+        gt.main()
+    assert capsys.readouterr().out == (
+        f'gitlab-trace version {gt.__version__},'
+        ' python-gitlab version 0.42.frog-knows\n')
+
+
+def test_main_no_daemon_option(monkeypatch, capsys):
+    monkeypatch.setattr(gt, 'daemon_socket_path', lambda: 1 / 0)
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--no-daemon',
+                                      '-p', 'owner/project', '--job=3201'])
+    with pytest.raises(SystemExit):
+        gt.main()
+    assert capsys.readouterr().out == 'Hello, world!\n'
+
+
+@pytest.mark.parametrize('error', [KeyError, OSError])
+def test_daemon_socket_path_no_user_name(monkeypatch, tmp_path, error):
+    def getuser():
+        raise error('getpwuid(): uid not found')
+    monkeypatch.setattr(getpass, 'getuser', getuser)
+    assert gt.daemon_socket_path() == (
+        f'{tmp_path}/gitlab-trace-{os.getuid()}.sock')
+
+
+def test_main_daemon(monkeypatch, capsys, tmp_path):
+    path = str(tmp_path / 'daemon.sock')
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.bind(path)  # left over from a crashed daemon
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--daemon',
+                                      f'--socket={path}'])
+    # restore these at the end
+    monkeypatch.setattr(sys, 'stdout', sys.stdout)
+    monkeypatch.setattr(sys, 'stderr', sys.stderr)
+    monkeypatch.setattr(socketserver.ThreadingUnixStreamServer,
+                        'serve_forever', raise_keyboard_interrupt)
+    with pytest.raises(SystemExit):
+        gt.main()
+    assert capsys.readouterr().err == (
+        f'gitlab-trace --daemon listening on {path}\n')
+    assert not os.path.exists(path)
+
+
+def test_main_daemon_already_running(monkeypatch, capsys, daemon):
+    monkeypatch.setattr(sys, 'argv', ['gitlab-trace', '--daemon',
+                                      f'--socket={daemon}'])
+    with pytest.raises(SystemExit,
+                       match='gitlab-trace --daemon is already running'):
+        gt.main()